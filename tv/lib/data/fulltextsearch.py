@@ -50,11 +50,13 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
     connection.execute("INSERT INTO item_fts(docid, %s)"
                        "SELECT %s.id, %s FROM %s" %
                        (column_list, table, column_list, table))
-    # make triggers to keep item_fts up to date
+    # make triggers to keep item_fts up to date.  The UPDATE triggers only
+    # fire when one of the indexed columns is set, so updates to things like
+    # watched_time or resume_time don't touch item_fts.
     connection.execute("CREATE TRIGGER item_bu "
-                       "BEFORE UPDATE ON %s BEGIN "
+                       "BEFORE UPDATE OF %s ON %s BEGIN "
                        "DELETE FROM item_fts WHERE docid=old.id; "
-                       "END;" % (table,))
+                       "END;" % (column_list, table))
 
     connection.execute("CREATE TRIGGER item_bd "
                        "BEFORE DELETE ON %s BEGIN "
@@ -62,10 +64,11 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
                        "END;" % (table,))
 
     connection.execute("CREATE TRIGGER item_au "
-                       "AFTER UPDATE ON %s BEGIN "
+                       "AFTER UPDATE OF %s ON %s BEGIN "
                        "INSERT INTO item_fts(docid, %s) "
                        "VALUES(new.id, %s); "
-                       "END;" % (table, column_list, column_list_for_new))
+                       "END;" % (column_list, table, column_list,
+                                 column_list_for_new))
 
     connection.execute("CREATE TRIGGER item_ai "
                        "AFTER INSERT ON %s BEGIN "
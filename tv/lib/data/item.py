@@ -34,6 +34,10 @@ to run a SELECT on the database and pass in the data from one row.
 
 column_info() and join_sql() describe what columns need to be selected and how
 to join the tables together in order to create an ItemInfo.
+
+ItemSelectInfo.column_profiles lists columns that can be left out of the
+SELECT for some uses.  ItemInfos created with a profile fetch those columns
+the first time they are accessed.
 """
 
 import datetime
@@ -41,6 +45,7 @@ import itertools
 import functools
 import logging
 import os
+import sqlite3
 
 from miro import app
 from miro import displaytext
@@ -186,6 +191,26 @@ class ItemSelectInfo(object):
     # name of the column that stores video paths
     path_column = 'filename'
 
+    # Maps profile names to the attr_names of columns that we don't select
+    # up-front for that profile.  We fetch them when they're accessed
+    # instead, with a query for each item.  Only defer columns that are
+    # read for a single item at a time, never for every row we display.
+    #   - list: what a list of item titles needs (the sidebar's recently
+    #     played/downloaded lists)
+    #   - standard: what the item views need to display every row.  The
+    #     renderers show the description and thumbnail, so we keep them.
+    #   - details: everything
+    _single_item_columns = ('license', 'rss_id', 'permalink',
+                            'payment_link', 'comments_link', 'thumbnail_url',
+                            'subtitle_encoding')
+    column_profiles = {
+        'list': _single_item_columns + (
+            'entry_description', 'metadata_description',
+            'feed_thumbnail_path_unicode'),
+        'standard': _single_item_columns,
+        'details': (),
+    }
+
     # how to join the main table to other tables.  Maps table names to
     # (item_column, other_column) tuples
     join_info = {
@@ -196,10 +221,41 @@ class ItemSelectInfo(object):
         'item_fts': ('id', 'docid'),
     }
 
-    def __init__(self):
+    def __init__(self, select_columns=None, deferred_columns=()):
+        """Create an ItemSelectInfo
+
+        :param select_columns: use these SelectColumns instead of the ones
+        from the class attribute.
+        :param deferred_columns: SelectColumns that we will fetch when they
+        are accessed, rather than selecting them.
+        """
+        if select_columns is not None:
+            self.select_columns = select_columns
+        self.deferred_columns = deferred_columns
         self.joined_tables = set(c.table for c in self.select_columns
                                  if c.table != self.table_name)
 
+    def for_profile(self, profile):
+        """Get an ItemSelectInfo that selects the columns for a profile.
+
+        :param profile: key from column_profiles
+        """
+        deferred_names = self.column_profiles[profile]
+        if not deferred_names:
+            return self
+        select_columns = []
+        deferred_columns = []
+        for column in self.select_columns:
+            if column.attr_name in deferred_names:
+                deferred_columns.append(column)
+            else:
+                select_columns.append(column)
+        return self.__class__(select_columns, deferred_columns)
+
+    def deferred_select_info(self):
+        """Get an ItemSelectInfo to select our deferred columns."""
+        return self.__class__(self.deferred_columns)
+
     def can_join_to(self, table):
         """Can we join to a table."""
         return table in self.join_info
@@ -234,12 +290,21 @@ class ItemSelectInfo(object):
 # bunch of class descriptors to implement the attributes by reading from a
 # result row
 class ItemInfoAttributeGetter(object):
-    def __init__(self, index):
+    """Get an attribute from an ItemInfo
+
+    :param index: index of the value in row_data, or None if the column is
+    deferred
+    :param attr_name: name of the attribute
+    """
+    def __init__(self, index, attr_name=None):
         self.index = index
+        self.attr_name = attr_name
 
     def __get__(self, instance, owner):
         if instance is None:
             raise AttributeError("class attribute not supported")
+        if self.index is None:
+            return instance.get_deferred_value(self.attr_name)
         return instance.row_data[self.index]
 
 class ItemInfoMeta(type):
@@ -258,8 +323,15 @@ class ItemInfoMeta(type):
             for select_column in select_info.select_columns:
                 attribute = ItemInfoAttributeGetter(count.next())
                 dct[select_column.attr_name] = attribute
+            for select_column in select_info.deferred_columns:
+                attribute = ItemInfoAttributeGetter(None,
+                                                    select_column.attr_name)
+                dct[select_column.attr_name] = attribute
         return type.__new__(cls, classname, bases, dct)
 
+# maps (ItemInfo class, profile) -> ItemInfo subclass for that profile
+_profile_classes = {}
+
 class ItemInfoBase(object):
     """ItemInfo represents a row in one of the item lists.
 
@@ -274,6 +346,10 @@ class ItemInfoBase(object):
     #: ItemInfoMeta
     select_info = None
     html_stripper = util.HTMLStripper()
+    #: ItemSource that created us.  Used to fetch deferred columns
+    item_source = None
+    #: values for deferred columns, once we've fetched them
+    _deferred_values = None
 
     # default values for columns from the item table.  For DeviceItemInfo and
     # SharingItemInfo, we will use these for columns that don't exist in their
@@ -371,6 +447,57 @@ class ItemInfoBase(object):
         """
         self.row_data = row_data
 
+    @classmethod
+    def profile_class(cls, profile):
+        """Get a version of this class that uses a column profile.
+
+        :param profile: key from ItemSelectInfo.column_profiles
+        """
+        key = (cls, profile)
+        try:
+            return _profile_classes[key]
+        except KeyError:
+            pass
+        select_info = cls.select_info.for_profile(profile)
+        if select_info is cls.select_info:
+            klass = cls
+        else:
+            klass = type(cls)('%s_%s' % (cls.__name__, profile), (cls,),
+                              {'select_info': select_info})
+        _profile_classes[key] = klass
+        return klass
+
+    def get_deferred_value(self, attr_name):
+        """Get the value for a column that wasn't selected up-front.
+
+        The first time this is called, we fetch all deferred columns for the
+        item.
+        """
+        if self._deferred_values is None:
+            values = self._fetch_deferred_values()
+            if values is None:
+                # Error fetching the data, don't cache anything so we try
+                # again next time
+                return None
+            self._deferred_values = values
+        return self._deferred_values[attr_name]
+
+    def _fetch_deferred_values(self):
+        select_info = self.select_info.deferred_select_info()
+        try:
+            with self.item_source.connection_pool.context() as connection:
+                row = _fetch_item_rows(connection, [self.id],
+                                       select_info).fetchone()
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while fetching deferred columns", e,
+                         exc_info=True)
+            return None
+        if row is None:
+            # item was deleted
+            row = (None,) * len(select_info.select_columns)
+        return dict((column.attr_name, value) for column, value in
+                    itertools.izip(select_info.select_columns, row))
+
     def __hash__(self):
         return hash(self.row_data)
 
@@ -950,9 +1077,20 @@ class ItemSource(object):
     """
 
     select_info = ItemSelectInfo()
+    item_info_class = ItemInfo
 
-    def __init__(self):
+    def __init__(self, profile='details'):
+        """Create an ItemSource
+
+        :param profile: key from ItemSelectInfo.column_profiles.  Pick which
+        columns get selected up-front.
+        """
         self.connection_pool = app.connection_pools.get_main_pool()
+        self._set_profile(profile)
+
+    def _set_profile(self, profile):
+        self.item_info_class = self.item_info_class.profile_class(profile)
+        self.select_info = self.item_info_class.select_info
 
     def get_connection(self):
         """Get a database connection to use.
@@ -976,27 +1114,37 @@ class ItemSource(object):
 
     def make_item_info(self, row_data):
         """Create an ItemInfo from a result row."""
-        return ItemInfo(row_data)
+        info = self.item_info_class(row_data)
+        info.item_source = self
+        return info
 
 class DeviceItemSource(ItemSource):
 
     select_info = DeviceItemSelectInfo()
+    item_info_class = DeviceItemInfo
 
-    def __init__(self, device_info):
+    def __init__(self, device_info, profile='details'):
         self.connection_pool = \
                 app.connection_pools.get_device_pool(device_info.id)
         self.device_info = device_info
+        self._set_profile(profile)
 
     def make_item_info(self, row_data):
-        return DeviceItemInfo(self.device_info, row_data)
+        info = self.item_info_class(self.device_info, row_data)
+        info.item_source = self
+        return info
 
 class SharingItemSource(ItemSource):
     select_info = SharingItemSelectInfo()
+    item_info_class = SharingItemInfo
 
-    def __init__(self, share_info):
+    def __init__(self, share_info, profile='details'):
         self.connection_pool = \
                 app.connection_pools.get_sharing_pool(share_info.id)
         self.share_info = share_info
+        self._set_profile(profile)
 
     def make_item_info(self, row_data):
-        return SharingItemInfo(self.share_info, row_data)
+        info = self.item_info_class(self.share_info, row_data)
+        info.item_source = self
+        return info
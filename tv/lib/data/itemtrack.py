@@ -35,6 +35,7 @@ import string
 import sqlite3
 import random
 import re
+import time
 import weakref
 
 from miro import app
@@ -396,6 +397,10 @@ class ItemTracker(signals.SignalEmitter):
 
     - Fetches ids first, then fetches row data when it's requested, or in
       idle callbacks.
+    - Idle callbacks fetch the rows around the last one requested first,
+      since that's what the frontend is displaying.  After that they fetch
+      the rest of the rows in order.  The number of rows fetched by each
+      callback adapts to how long fetching takes.
     - Can efficently tell what's changed in an item list when another process
       modifies the item data
 
@@ -408,6 +413,13 @@ class ItemTracker(signals.SignalEmitter):
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # how long we want each idle callback to spend fetching rows
+    IDLE_FETCH_TIME = 0.02
+    # bounds for how many rows an idle callback fetches
+    IDLE_FETCH_MIN_ROWS = FETCH_ROW_CHUNK_SIZE
+    IDLE_FETCH_MAX_ROWS = 1000
+    # how many rows around the last requested row we fetch before the others
+    IDLE_FETCH_PRIORITY_ROWS = 200
 
     def __init__(self, idle_scheduler, query, item_source):
         """Create an ItemTracker
@@ -424,6 +436,7 @@ class ItemTracker(signals.SignalEmitter):
         self.create_signal("list-changed")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
+        self.idle_fetch_size = self.IDLE_FETCH_MIN_ROWS
         self.item_fetcher = None
         self.item_source = item_source
         self._db_retry_callback_pending = False
@@ -499,6 +512,27 @@ class ItemTracker(signals.SignalEmitter):
             self._make_empty_list_after_db_error()
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
         self.row_data = {}
+        self._reset_idle_fetch()
+
+    def _reset_idle_fetch(self):
+        """Reset the state used to pick rows to fetch in do_idle_work().
+
+        Rows get fetched in this order:
+          - rows in the priority range around the last row requested
+          - rows that were uncached after the fetch cursor passed them
+          - the rest of the rows, in order
+
+        Each cursor only moves forward, so fetching the whole list takes
+        linear time.
+        """
+        # next row for the linear scan
+        self._fetch_cursor = 0
+        # indexes behind _fetch_cursor that need to be fetched again
+        self._rows_to_refetch = set()
+        # last row requested in get_row() and the row it was when we last
+        # calculated the priority range.
+        self._last_requested_row = self._priority_center = None
+        self._priority_cursor = self._priority_end = 0
 
     def _make_empty_list_after_db_error(self):
         self.id_list = []
@@ -519,20 +553,67 @@ class ItemTracker(signals.SignalEmitter):
             # destroy() was called while the idle callback was still
             # scheduled.  Just return.
             return
-        for i in xrange(len(self.id_list)):
-            if not self._row_loaded(i):
-                # row data unloaded, call _ensure_row_loaded to load this row
-                # and adjecent rows then schedule another run later
-                self._ensure_row_loaded(i)
-                self._schedule_idle_work()
-                return
-        # no rows need loading
-        self.item_fetcher.done_fetching()
+        rows_to_load = self._rows_for_idle_fetch(self.idle_fetch_size)
+        if rows_to_load:
+            start = time.time()
+            self._load_rows(rows_to_load)
+            self._adjust_idle_fetch_size(len(rows_to_load),
+                                         time.time() - start)
+            self._schedule_idle_work()
+        else:
+            # no rows need loading
+            self.item_fetcher.done_fetching()
+
+    def _rows_for_idle_fetch(self, count):
+        """Pick up to count unloaded rows to fetch in do_idle_work()."""
+        rows = set()
+        self._update_priority_range()
+        while self._priority_cursor < self._priority_end and len(rows) < count:
+            if not self._row_loaded(self._priority_cursor):
+                rows.add(self._priority_cursor)
+            self._priority_cursor += 1
+        while self._rows_to_refetch and len(rows) < count:
+            index = self._rows_to_refetch.pop()
+            if not self._row_loaded(index):
+                rows.add(index)
+        row_count = len(self.id_list)
+        while self._fetch_cursor < row_count and len(rows) < count:
+            if not self._row_loaded(self._fetch_cursor):
+                rows.add(self._fetch_cursor)
+            self._fetch_cursor += 1
+        return rows
+
+    def _update_priority_range(self):
+        """Recalculate the priority range if a new row has been requested."""
+        center = self._last_requested_row
+        if center is None or center == self._priority_center:
+            return
+        self._priority_center = center
+        self._priority_cursor = max(center - self.IDLE_FETCH_PRIORITY_ROWS // 2,
+                                    0)
+        self._priority_end = min(self._priority_cursor +
+                                 self.IDLE_FETCH_PRIORITY_ROWS,
+                                 len(self.id_list))
+
+    def _adjust_idle_fetch_size(self, row_count, fetch_time):
+        """Adjust idle_fetch_size so that fetches take about IDLE_FETCH_TIME.
+        """
+        if fetch_time <= 0:
+            target = self.IDLE_FETCH_MAX_ROWS
+        else:
+            target = int(self.IDLE_FETCH_TIME * row_count / fetch_time)
+        # move halfway to the target to smooth out noisy timings
+        size = (self.idle_fetch_size + target) // 2
+        self.idle_fetch_size = max(self.IDLE_FETCH_MIN_ROWS,
+                                   min(size, self.IDLE_FETCH_MAX_ROWS))
 
     def _uncache_row_data(self, id_list):
         for id_ in id_list:
             if id_ in self.row_data:
                 del self.row_data[id_]
+                index = self.id_to_index[id_]
+                if index < self._fetch_cursor:
+                    self._rows_to_refetch.add(index)
 
     def _refetch_id_list(self, send_signals=True):
         """Refetch a new id list after we already have one."""
@@ -642,6 +723,7 @@ class ItemTracker(signals.SignalEmitter):
 
         :raises IndexError: index out of range
         """
+        self._last_requested_row = index
         self._ensure_row_loaded(index)
         try:
             id_ = self.id_list[index]
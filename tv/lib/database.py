@@ -29,6 +29,7 @@
 
 import itertools
 import logging
+import re
 import traceback
 import threading
 
@@ -203,6 +204,238 @@ class View(object):
         return ViewTracker(self.fetcher, self.where, self.values, self.joins,
                           self.db_info)
 
+class WhereClauseNotSupported(ValueError):
+    """Raised when WhereClauseCompiler can't handle a WHERE clause."""
+    pass
+
+_where_token_re = re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*') |
+    (?P<number>-?\d+(?:\.\d+)?) |
+    (?P<op>==|!=|<>|=|\(|\)|,|\?) |
+    (?P<word>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)?)
+    )""", re.VERBOSE)
+
+_where_keywords = set(['AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'LIKE',
+                       'GLOB', 'BETWEEN', 'EXISTS', 'SELECT'])
+
+class WhereClauseCompiler(object):
+    """Compiles simple WHERE clauses into python predicates.
+
+    ViewTracker uses this to check if a changed object belongs in its view
+    without running an SQL query.  We support comparing columns to values
+    with "=" and "!=", "IN (...)", "IS [NOT] NULL", using boolean/integer
+    columns by themselves, and combining those with AND, OR, NOT and
+    parentheses.  Anything else raises WhereClauseNotSupported and the caller
+    should fall back to SQL.
+
+    Predicates follow SQL's three-valued logic: they return True, False, or
+    None if the result is NULL.
+    """
+
+    def __init__(self, table_name, column_types):
+        """Create a WhereClauseCompiler
+
+        :param table_name: table the WHERE clause selects from
+        :param column_types: dict mapping column names to the python types
+            that compare the same way in memory as in SQLite.  Only these
+            columns can be used in the WHERE clause.
+        """
+        self.table_name = table_name
+        self.column_types = column_types
+
+    def compile(self, where, values):
+        """Compile a WHERE clause
+
+        :param where: WHERE clause to compile
+        :param values: values for the "?" placeholders in where
+        :returns: function that takes a DDBObject and returns True, False or
+            None
+        :raises WhereClauseNotSupported: where is too complex to compile
+        """
+        self.tokens = self._tokenize(where)
+        self.pos = 0
+        self.values = list(values)
+        predicate = self._parse_or()
+        if self.pos < len(self.tokens):
+            raise WhereClauseNotSupported("extra tokens: %r" %
+                                          (self.tokens[self.pos:],))
+        if self.values:
+            raise WhereClauseNotSupported("too many values")
+        return predicate
+
+    def _tokenize(self, where):
+        tokens = []
+        pos = 0
+        where = where.rstrip()
+        while pos < len(where):
+            m = _where_token_re.match(where, pos)
+            if m is None:
+                raise WhereClauseNotSupported("can't parse %r" % where[pos:])
+            kind = m.lastgroup
+            text = m.group(kind)
+            if kind == 'word' and text.upper() in _where_keywords:
+                kind, text = 'keyword', text.upper()
+            tokens.append((kind, text))
+            pos = m.end()
+        return tokens
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        else:
+            return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise WhereClauseNotSupported("unexpected end of WHERE clause")
+        self.pos += 1
+        return token
+
+    def _accept(self, kind, text):
+        if self._peek() == (kind, text):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, kind, text):
+        if not self._accept(kind, text):
+            raise WhereClauseNotSupported("expected %s, got %r" %
+                                          (text, self._peek()[1]))
+
+    def _parse_or(self):
+        predicates = [self._parse_and()]
+        while self._accept('keyword', 'OR'):
+            predicates.append(self._parse_and())
+        if len(predicates) == 1:
+            return predicates[0]
+        def or_predicate(obj):
+            rv = False
+            for predicate in predicates:
+                result = predicate(obj)
+                if result:
+                    return True
+                elif result is None:
+                    rv = None
+            return rv
+        return or_predicate
+
+    def _parse_and(self):
+        predicates = [self._parse_not()]
+        while self._accept('keyword', 'AND'):
+            predicates.append(self._parse_not())
+        if len(predicates) == 1:
+            return predicates[0]
+        def and_predicate(obj):
+            rv = True
+            for predicate in predicates:
+                result = predicate(obj)
+                if result is None:
+                    rv = None
+                elif not result:
+                    return False
+            return rv
+        return and_predicate
+
+    def _parse_not(self):
+        if self._accept('keyword', 'NOT'):
+            predicate = self._parse_not()
+            def not_predicate(obj):
+                result = predicate(obj)
+                if result is None:
+                    return None
+                return not result
+            return not_predicate
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        if self._accept('op', '('):
+            predicate = self._parse_or()
+            self._expect('op', ')')
+            return predicate
+        column, types = self._parse_column()
+        if self._accept('keyword', 'IS'):
+            negate = self._accept('keyword', 'NOT')
+            self._expect('keyword', 'NULL')
+            if negate:
+                return lambda obj: getattr(obj, column) is not None
+            else:
+                return lambda obj: getattr(obj, column) is None
+        negate = self._accept('keyword', 'NOT')
+        if self._accept('keyword', 'IN'):
+            return self._parse_in(column, types, negate)
+        elif negate:
+            raise WhereClauseNotSupported("NOT %s" % self._peek()[1])
+
+        kind, text = self._peek()
+        if kind == 'op' and text in ('=', '==', '!=', '<>'):
+            self.pos += 1
+            operand = self._parse_operand(types)
+            equal = text in ('=', '==')
+            def compare_predicate(obj):
+                value = getattr(obj, column)
+                if value is None:
+                    return None
+                return (value == operand) == equal
+            return compare_predicate
+        elif int in types:
+            # column by itself (for example "WHERE visible")
+            def column_predicate(obj):
+                value = getattr(obj, column)
+                if value is None:
+                    return None
+                return bool(value)
+            return column_predicate
+        else:
+            raise WhereClauseNotSupported("can't use %s as a boolean" %
+                                          column)
+
+    def _parse_in(self, column, types, negate):
+        self._expect('op', '(')
+        operands = [self._parse_operand(types)]
+        while self._accept('op', ','):
+            operands.append(self._parse_operand(types))
+        self._expect('op', ')')
+        def in_predicate(obj):
+            value = getattr(obj, column)
+            if value is None:
+                return None
+            return (value in operands) != negate
+        return in_predicate
+
+    def _parse_column(self):
+        kind, text = self._next()
+        if kind != 'word':
+            raise WhereClauseNotSupported("expected column, got %r" % text)
+        if '.' in text:
+            table, text = text.split('.')
+            if table != self.table_name:
+                raise WhereClauseNotSupported("column from other table: %s" %
+                                              table)
+        if text not in self.column_types:
+            raise WhereClauseNotSupported("can't compare %s in memory" % text)
+        return text, self.column_types[text]
+
+    def _parse_operand(self, types):
+        kind, text = self._next()
+        if kind == 'op' and text == '?':
+            if not self.values:
+                raise WhereClauseNotSupported("not enough values")
+            value = self.values.pop(0)
+        elif kind == 'string':
+            value = unicode(text[1:-1].replace("''", "'"))
+        elif kind == 'number':
+            if '.' in text:
+                value = float(text)
+            else:
+                value = int(text)
+        else:
+            raise WhereClauseNotSupported("expected value, got %r" % text)
+        if value is None or not isinstance(value, types):
+            raise WhereClauseNotSupported("can't compare %r in memory" %
+                                          (value,))
+        return value
+
 class ViewTrackerManager(object):
     def __init__(self, db):
         self.db = db
@@ -254,6 +487,10 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        # python version of our WHERE clause, compiled when we see our first
+        # object.  None means we have to use SQL to check objects.
+        self._predicate = None
+        self._predicate_compiled = False
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -273,6 +510,11 @@ class ViewTracker(signals.SignalEmitter):
 
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if not self._predicate_compiled:
+            self._predicate = self._compile_predicate(obj.__class__)
+            self._predicate_compiled = True
+        if self._predicate is not None:
+            return bool(self._predicate(obj))
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
@@ -281,6 +523,25 @@ class ViewTracker(signals.SignalEmitter):
         return self.db_info.db.query_count(self.table_name, where, values,
                 self.joins) > 0
 
+    def _compile_predicate(self, klass):
+        """Try to compile our WHERE clause into a python predicate.
+
+        This lets us check objects in memory rather than running a query for
+        each one.
+
+        :returns: predicate function, or None if we need to use SQL
+        """
+        if self.joins:
+            return None
+        if not self.where:
+            return lambda obj: True
+        compiler = WhereClauseCompiler(self.table_name,
+                                       self.db_info.db.column_types(klass))
+        try:
+            return compiler.compile(self.where, self.values)
+        except WhereClauseNotSupported:
+            return None
+
     def _view_object_ids(self):
         """Get all object ids in our view."""
         return set(self.db_info.db.query_ids(self.table_name,
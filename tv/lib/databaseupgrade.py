@@ -4417,3 +4417,38 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+@run_on_both
+def upgrade202(cursor):
+    """Only update item_fts when an indexed column changes."""
+    if is_device_db(cursor):
+        item_table = 'device_item'
+    else:
+        item_table = 'item'
+    columns = ['title', 'description', 'artist', 'album', 'genre', 'filename',
+               'parent_title', 'entry_description', ]
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
+    cursor.execute("DROP TRIGGER item_bu")
+    cursor.execute("CREATE TRIGGER item_bu "
+                   "BEFORE UPDATE OF %s ON %s BEGIN "
+                   "DELETE FROM item_fts WHERE docid=old.id; "
+                   "END;" % (column_list, item_table))
+
+    cursor.execute("DROP TRIGGER item_au")
+    cursor.execute("CREATE TRIGGER item_au "
+                   "AFTER UPDATE OF %s ON %s BEGIN "
+                   "INSERT INTO item_fts(docid, %s) "
+                   "VALUES(new.id, %s); "
+                   "END;" % (column_list, item_table, column_list,
+                             column_list_for_new))
+
+def upgrade203(cursor):
+    """Start storing pythonrepr columns in storedatabase's binary format.
+
+    We don't convert any data here.  LiveStorage can still read the old
+    repr() values and rewrites them as objects get restored.  Bumping the
+    version stops older versions of Miro, which can't read the new format,
+    from opening the database.
+    """
+    pass
@@ -110,14 +110,21 @@ class RemoveHTTPAuthCommand(Command):
         httpauth.remove_by_url_and_realm(*self.args)
 
 class BatchUpdateDownloadStatus(Command):
+    """Send status updates to the controller.
+
+    args[0] is a list of status deltas from the daemon's StatusEncoder.
+    """
     spammy = True
     def action(self):
         from miro.downloader import RemoteDownloader
         from miro.messages import DownloaderSyncCommandComplete
 
         cmd_done = self.args[1]
+        # decode everything first, so the decoder sees every delta
+        statuses = [self.daemon.status_decoder.decode(delta)
+                    for delta in self.args[0]]
         fresh = all(RemoteDownloader.update_status(status, cmd_done=cmd_done)
-                    for status in self.args[0])
+                    for status in statuses)
         if cmd_done and fresh:
             DownloaderSyncCommandComplete().send_to_frontend()
 
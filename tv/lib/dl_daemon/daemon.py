@@ -28,9 +28,9 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro.dl_daemon import command
+from miro.dl_daemon import protocol
 import os
 import cPickle
-from struct import pack, unpack, calcsize
 import tempfile
 from miro import app
 from miro import crashreport
@@ -45,8 +45,6 @@ from miro import trapcall
 from miro.net import ConnectionHandler
 from miro import util
 
-SIZEOF_LONG = calcsize("Q")
-
 class DaemonError(StandardError):
     """Exception while communicating to a daemon (either controller or
     downloader).
@@ -139,9 +137,11 @@ class Daemon(ConnectionHandler):
         global LAST_DAEMON
         LAST_DAEMON = self
         self.size = 0
-        self.states['ready'] = self.on_size
-        self.states['command'] = self.on_command
+        self.states['ready'] = self.on_header
+        self.states['command'] = self.on_frame
         self.queued_commands = []
+        # commands waiting for flush_commands() to send them
+        self.outgoing_commands = []
         self.shutdown = False
         # disable read timeouts for the downloader daemon
         # communication.  Our normal state is to wait for long periods
@@ -162,19 +162,24 @@ class Daemon(ConnectionHandler):
             self.send(comm, callback)
         self.queued_commands = []
 
-    def on_size(self):
-        if self.buffer.length >= SIZEOF_LONG:
-            (self.size,) = unpack("Q", self.buffer.read(SIZEOF_LONG))
+    def on_header(self):
+        if self.buffer.length >= protocol.FRAME_HEADER_SIZE:
+            header = self.buffer.read(protocol.FRAME_HEADER_SIZE)
+            try:
+                self.size = protocol.unpack_frame_header(header)
+            except protocol.ProtocolError, e:
+                self.on_error(DaemonError(str(e)))
             self.change_state('command')
 
-    def on_command(self):
+    def on_frame(self):
         if self.buffer.length >= self.size:
             try:
-                comm = cPickle.loads(self.buffer.read(self.size))
+                commands = cPickle.loads(self.buffer.read(self.size))
             except cPickle.UnpicklingError:
-                logging.exception("WARNING: error unpickling command.")
+                logging.exception("WARNING: error unpickling commands.")
             else:
-                self.process_command(comm)
+                for comm in commands:
+                    self.process_command(comm)
             self.change_state('ready')
 
     def process_command(self, comm):
@@ -192,8 +197,28 @@ class Daemon(ConnectionHandler):
         if self.state == 'initializing':
             self.queued_commands.append((comm, callback))
         else:
-            raw = cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
-            self.send_data(pack("Q", len(raw)) + raw, callback)
+            if not self.outgoing_commands:
+                eventloop.add_idle(self.flush_commands,
+                                   "sending daemon commands")
+            self.outgoing_commands.append((comm, callback))
+
+    def flush_commands(self):
+        """Send all commands from send() in one frame."""
+        if not self.outgoing_commands:
+            return
+        commands = [comm for comm, callback in self.outgoing_commands]
+        callbacks = [callback for comm, callback in self.outgoing_commands
+                     if callback is not None]
+        self.outgoing_commands = []
+        if callbacks:
+            def call_callbacks():
+                for callback in callbacks:
+                    callback()
+        else:
+            call_callbacks = None
+        raw = cPickle.dumps(commands, cPickle.HIGHEST_PROTOCOL)
+        self.send_data(protocol.pack_frame_header(len(raw)) + raw,
+                       call_callbacks)
 
 class DownloaderDaemon(Daemon):
     def __init__(self, host, port, short_app_name):
@@ -201,6 +226,7 @@ class DownloaderDaemon(Daemon):
         write_pid(short_app_name, os.getpid())
         # connect to the controller and start our listen loop
         Daemon.__init__(self)
+        self.status_encoder = protocol.StatusEncoder()
         self.open_connection(host, port, self.on_connection,
                              self.on_error)
         signals.system.connect('error', self.handle_error)
@@ -233,6 +259,7 @@ class DownloaderDaemon(Daemon):
 class ControllerDaemon(Daemon):
     def __init__(self):
         Daemon.__init__(self)
+        self.status_decoder = protocol.StatusDecoder()
         family, addr = util.localhost_family_and_addr()
         self.stream.accept_connection(family, addr, 0, self.on_connection,
                 self.on_error)
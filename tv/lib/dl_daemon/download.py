@@ -30,7 +30,7 @@
 import os
 import stat
 import time
-from threading import RLock
+from threading import Lock, RLock
 from copy import copy
 import sys
 import datetime
@@ -188,6 +188,8 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    logging.info("Writing fast resume data...")
+    FAST_RESUME_WRITER.flush()
     # Flush the status updates.
     logging.info('flushing status updates...')
     DOWNLOAD_UPDATER.flush_update()
@@ -225,6 +227,17 @@ class TorrentSession(object):
         self.dht_on = None
         self.pe_set = None
         self.enc_req = None
+        # True if libtorrent can tell us which torrents changed with
+        # state_update_alert.  If not, we poll every torrent.
+        self.use_state_updates = False
+        self.alert_handlers = {
+            'state_update_alert': self.on_state_update_alert,
+            'torrent_finished_alert': self.on_torrent_finished_alert,
+            'metadata_received_alert': self.on_metadata_received_alert,
+            'save_resume_data_alert': self.on_save_resume_data_alert,
+            'save_resume_data_failed_alert':
+                self.on_save_resume_data_failed_alert,
+        }
 
     def startup(self):
         version = app.config.get(prefs.APP_VERSION).split(".")
@@ -242,6 +255,10 @@ class TorrentSession(object):
         # MR is for Miro.
         fingerprint = lt.fingerprint("MR", major, minor, 0, 0)
         self.session = lt.session(fingerprint)
+        self.session.set_alert_mask(lt.alert.category_t.status_notification |
+                                    lt.alert.category_t.storage_notification |
+                                    lt.alert.category_t.error_notification)
+        self.use_state_updates = hasattr(self.session, 'post_torrent_updates')
         self.listen()
         self.set_upnp()
         self.set_dht()
@@ -300,6 +317,11 @@ class TorrentSession(object):
                 # avoid OverflowErrors by keeping the value an integer
                 limit = sys.maxint
         self.session.set_download_rate_limit(limit)
+        # HTTP downloads share the same limit
+        if limit == -1:
+            httpclient.set_download_rate_limit(None)
+        else:
+            httpclient.set_download_rate_limit(limit)
 
     def set_connection_limit(self):
         limit = -1
@@ -385,10 +407,71 @@ class TorrentSession(object):
             del self.info_hash_to_downloader[info_hash]
 
     def update_torrents(self):
-        # Copy this set into a list in case any of the torrents gets
-        # removed during the iteration.
-        for torrent in [x for x in self.torrents]:
-            torrent.update_status()
+        if self.use_state_updates:
+            # libtorrent will send a state_update_alert with the status of
+            # the torrents that changed since the last call.  We'll handle it
+            # the next time through.
+            self.session.post_torrent_updates()
+        else:
+            # Copy this set into a list in case any of the torrents gets
+            # removed during the iteration.
+            for torrent in [x for x in self.torrents]:
+                torrent.update_status()
+        self.handle_alerts()
+
+    def pop_alerts(self):
+        if hasattr(self.session, 'pop_alerts'):
+            return self.session.pop_alerts()
+        alerts = []
+        alert = self.session.pop_alert()
+        while alert is not None:
+            alerts.append(alert)
+            alert = self.session.pop_alert()
+        return alerts
+
+    def handle_alerts(self):
+        for alert in self.pop_alerts():
+            handler = self.alert_handlers.get(type(alert).__name__)
+            if handler is not None:
+                handler(alert)
+
+    def downloader_for_handle(self, handle):
+        """Get the BTDownloader for a torrent handle.
+
+        :returns: the downloader, or None if the torrent isn't running
+        """
+        try:
+            info_hash = info_hash_to_long(handle.info_hash())
+        except RuntimeError:
+            # the torrent was removed from the session
+            return None
+        return self.info_hash_to_downloader.get(info_hash)
+
+    def on_state_update_alert(self, alert):
+        for status in alert.status:
+            downloader = self.downloader_for_handle(status.handle)
+            if downloader is not None:
+                downloader.update_status(status)
+
+    def on_torrent_finished_alert(self, alert):
+        downloader = self.downloader_for_handle(alert.handle)
+        if downloader is not None:
+            downloader.update_status()
+
+    def on_metadata_received_alert(self, alert):
+        downloader = self.downloader_for_handle(alert.handle)
+        if downloader is not None:
+            downloader.on_metadata_received()
+
+    def on_save_resume_data_alert(self, alert):
+        downloader = self.downloader_for_handle(alert.handle)
+        if downloader is not None:
+            downloader.on_resume_data(alert.resume_data)
+
+    def on_save_resume_data_failed_alert(self, alert):
+        downloader = self.downloader_for_handle(alert.handle)
+        if downloader is not None:
+            downloader.on_resume_data_failed(alert.message())
 
 TORRENT_SESSION = TorrentSession()
 
@@ -433,9 +516,7 @@ class DownloadStatusUpdater(object):
                 statuses.append(downloader.get_status())
             self.to_update = set()
             if statuses or self.cmds_done:
-                command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                                  statuses,
-                                                  self.cmds_done).send()
+                send_status_updates(statuses, self.cmds_done)
                 self.cmds_done = False
         finally:
             if periodic:
@@ -451,6 +532,15 @@ class DownloadStatusUpdater(object):
 
 DOWNLOAD_UPDATER = DownloadStatusUpdater()
 
+def send_status_updates(statuses, cmd_done=False):
+    """Send status dicts to the controller, as deltas from the last ones
+    we sent.
+    """
+    encoder = daemon.LAST_DAEMON.status_encoder
+    deltas = [encoder.encode(status) for status in statuses]
+    command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON, deltas,
+                                      cmd_done).send()
+
 # retry times in seconds.  60 seconds, 5 minutes, ...
 RETRY_TIMES = (
     60,
@@ -504,8 +594,7 @@ class BGDownloader(object):
         if not now:
             DOWNLOAD_UPDATER.queue_update(self)
         else:
-            command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                              [self.get_status()]).send()
+            send_status_updates([self.get_status()])
 
     def pick_initial_filename(self, suffix=".part", torrent=False,
                               is_directory=False, exists=False):
@@ -722,13 +811,120 @@ class BGDownloader(object):
             accept = (size <= available)
         return accept
 
+class HTTPSegment(object):
+    """A byte range of a segmented HTTP download.
+
+    start and end are inclusive offsets into the file.  offset is where the
+    current transfer for the segment started writing.  It's past start if
+    the segment was resumed.
+    """
+    def __init__(self, start, end, position=None):
+        if position is None:
+            position = start
+        self.start = start
+        self.end = end
+        self.offset = position
+        self.written = 0
+        self.finished = position > end
+        self.client = None
+        # False for a segment that we split off another one, until we know
+        # that the server honors its Range header
+        self.confirmed = True
+        # unconfirmed segment that we split off this one
+        self.pending_split = None
+
+    def position(self):
+        return self.offset + self.written
+
+    def remaining(self):
+        return max(self.end + 1 - self.position(), 0)
+
+    def downloaded(self):
+        return min(self.position(), self.end + 1) - self.start
+
+    def update_stats(self, stats):
+        if stats.status_code in (200, 206):
+            self.offset = stats.initial_size
+            self.written = stats.decoded_bytes
+
+    def mark_finished(self):
+        self.finished = True
+        self.written = max(self.end + 1 - self.offset, self.written)
+
+def segment_data_filename(filename):
+    return filename + '.segments'
+
+def save_segment_data(filename, total_size, segments):
+    """Save the state of a segmented download next to the file.
+
+    The first line is the total size, then there is a "start end position"
+    line for each segment.  Errors get logged and otherwise ignored.
+    """
+    lines = ['%d\n' % total_size]
+    for segment in segments:
+        lines.append('%d %d %d\n' % (segment.start, segment.end,
+                                     segment.position()))
+    try:
+        with open(segment_data_filename(filename), 'wb') as f:
+            f.write(''.join(lines))
+    except (OSError, IOError):
+        logging.exception("Error saving segment data")
+
+def load_segment_data(filename):
+    """Load the data that save_segment_data() saved.
+
+    :returns: (total_size, segments) tuple, or None if the data doesn't
+        exist or is corrupt
+    """
+    path = segment_data_filename(filename)
+    if not os.path.exists(path):
+        return None
+    try:
+        f = open(path, 'rb')
+        try:
+            lines = f.read().splitlines()
+        finally:
+            f.close()
+        total_size = int(lines[0])
+        segments = []
+        for line in lines[1:]:
+            start, end, position = [int(value) for value in line.split()]
+            segments.append(HTTPSegment(start, end, position))
+    except (OSError, IOError, ValueError, IndexError):
+        logging.exception("Error loading segment data")
+        return None
+    return total_size, segments
+
+def remove_segment_data(filename):
+    path = segment_data_filename(filename)
+    if os.path.exists(path):
+        try:
+            fileutil.remove(path)
+        except OSError:
+            logging.exception("Error removing segment data")
+
 class HTTPDownloader(BGDownloader):
     CHECK_STATS_TIMEOUT = 1.0
+    # Once we know the size of a download, we split what's left of it into
+    # up to MAX_SEGMENTS byte ranges, and download each of them over its own
+    # connection.
+    MAX_SEGMENTS = 4
+    # Don't split off segments smaller than this.
+    MIN_SEGMENT_SIZE = 1024 * 1024
+    # Our share of the download rate limit, compared to other HTTP
+    # downloads.  All the segments of a download share this.
+    BANDWIDTH_WEIGHT = 1.0
 
     def __init__(self, url=None, dlid=None, restore=None,
                  expected_content_type=None):
         self.retry_dc = None
         self.channel_name = None
+        # list of HTTPSegment objects for a segmented download, or None
+        self.segments = None
+        # set to False if the server ignores our Range headers
+        self.use_segments = True
+        self.segment_url = None
+        self.accept_ranges = None
         self.expected_content_type = expected_content_type
         if restore is not None:
             self.__dict__.update(restore)
@@ -755,15 +951,22 @@ class HTTPDownloader(BGDownloader):
         if self.retry_dc:
             self.retry_dc.cancel()
             self.retry_dc = None
+        self.segments = None
         if resume:
             resume = self._resume_sanity_check()
+        else:
+            remove_segment_data(self.filename)
 
         logging.debug("start_download: %s", self.url)
 
-        self.client = httpclient.grab_url(
-            self.url, self.on_download_finished, self.on_download_error,
-            header_callback=self.on_headers, write_file=self.filename,
-            resume=resume)
+        if self.segments is not None:
+            self.start_segments()
+        else:
+            self.client = httpclient.grab_url(
+                self.url, self.on_download_finished, self.on_download_error,
+                header_callback=self.on_headers, write_file=self.filename,
+                resume=resume, bandwidth_weight=self.BANDWIDTH_WEIGHT,
+                bandwidth_group=self.dlid)
         self.update_stats()
 
     def _resume_sanity_check(self):
@@ -773,6 +976,8 @@ class HTTPDownloader(BGDownloader):
         """
         if not os.path.exists(self.filename):
             return False
+        if os.path.exists(segment_data_filename(self.filename)):
+            return self._segment_resume_sanity_check()
         # sanity check that the file we're resuming from is the right
         # size.  In particular, before the libcurl change, we would
         # preallocate the entire file, so we need to undo this.
@@ -792,6 +997,223 @@ class HTTPDownloader(BGDownloader):
             return False
         return True
 
+    def _segment_resume_sanity_check(self):
+        """Load the segments for a segmented download we are resuming.
+
+        The file for a segmented download is preallocated, so we can't
+        resume it with a single connection.  If the segment data is bad, we
+        start over.
+        """
+        segment_data = load_segment_data(self.filename)
+        file_size = os.stat(self.filename)[stat.ST_SIZE]
+        if segment_data is None or segment_data[0] != file_size:
+            logging.warn("Bad segment data, restarting download.  "
+                         "url: %s, path: %s.", self.url, self.filename)
+            remove_segment_data(self.filename)
+            return False
+        self.total_size, self.segments = segment_data
+        return True
+
+    def start_segments(self):
+        """Start transfers for the unfinished segments in self.segments."""
+        for segment in self.segments:
+            if not segment.finished:
+                self.start_segment(segment)
+        if not [s for s in self.segments if s.client is not None]:
+            # every segment was already finished
+            self.finish_segmented_download()
+        else:
+            self.split_segments()
+
+    def start_segment(self, segment):
+        def callback(info):
+            self.on_segment_finished(segment)
+        def errback(error):
+            self.on_segment_error(segment, error)
+        def header_callback(info):
+            self.on_segment_headers(segment, info)
+        segment.offset = segment.position()
+        segment.written = 0
+        # use the URL that we got redirected to, if we know it.
+        url = self.segment_url or self.url
+        segment.client = httpclient.grab_url(url, callback, errback,
+                header_callback=header_callback, write_file=self.filename,
+                byte_range=(segment.offset, segment.end),
+                bandwidth_weight=self.BANDWIDTH_WEIGHT,
+                bandwidth_group=self.dlid)
+
+    def start_segmenting(self, stats):
+        """Turn a single connection download into a segmented one.
+
+        The current transfer becomes the first segment.  It keeps going
+        until another segment takes over the rest of the file.
+        """
+        if (not self.use_segments or self.total_size is None or
+                self.accept_ranges == 'none' or
+                self.total_size - stats.initial_size - stats.decoded_bytes <
+                2 * self.MIN_SEGMENT_SIZE):
+            return
+        try:
+            # preallocate the file, so the other segments can write their
+            # data to it.
+            f = open(self.filename, 'r+b')
+            try:
+                f.truncate(self.total_size)
+            finally:
+                f.close()
+        except (OSError, IOError):
+            logging.exception("Error preallocating %s", self.filename)
+            return
+        segment = HTTPSegment(0, self.total_size - 1)
+        segment.update_stats(stats)
+        segment.client = self.client
+        self.segments = [segment]
+        self.save_segments()
+        self.split_segments()
+
+    def split_segments(self):
+        """Split segments until we have MAX_SEGMENTS transfers going.
+
+        We always split the segment with the most data left, and give the
+        second half of it to a new segment.  The old segment keeps all its
+        data until the server starts sending the new one, so nothing gets
+        lost if the server ignores the Range header.
+        """
+        if not self.use_segments:
+            return
+        running = [s for s in self.segments if s.client is not None]
+        while len(running) < self.MAX_SEGMENTS:
+            candidates = [s for s in running
+                          if s.confirmed and s.pending_split is None]
+            if not candidates:
+                return
+            segment = max(candidates, key=lambda s: s.remaining())
+            remaining = segment.remaining()
+            if remaining < 2 * self.MIN_SEGMENT_SIZE:
+                return
+            new_segment = HTTPSegment(segment.end + 1 - remaining // 2,
+                                      segment.end)
+            new_segment.confirmed = False
+            segment.pending_split = new_segment
+            self.segments.insert(self.segments.index(segment) + 1,
+                                 new_segment)
+            self.start_segment(new_segment)
+            running.append(new_segment)
+
+    def find_split_parent(self, segment):
+        for parent in self.segments:
+            if parent.pending_split is segment:
+                return parent
+        return None
+
+    def is_current_segment(self, segment):
+        """Check if segment is part of the download and still running.
+
+        Transfers can call back after we cancel them, so we check this
+        before handling a callback.
+        """
+        return (segment.client is not None and self.segments is not None and
+                segment in self.segments)
+
+    def on_segment_headers(self, segment, info):
+        if not self.is_current_segment(segment) or info['status'] != 206:
+            return
+        segment.confirmed = True
+        parent = self.find_split_parent(segment)
+        if parent is not None:
+            # The server is sending the range, so the parent segment can
+            # stop where this one starts.
+            parent.pending_split = None
+            parent.end = segment.start - 1
+            if parent.client is not None:
+                parent.client.set_range_end(parent.end)
+        self.save_segments()
+
+    def on_segment_finished(self, segment):
+        if not self.is_current_segment(segment):
+            return
+        self.update_segment_stats()
+        if segment.client is self.client:
+            self.client = None
+        segment.client = None
+        segment.mark_finished()
+        if segment.pending_split is not None:
+            # we got to the end before the server started sending the
+            # segment that we split off, so we don't need it.
+            unneeded = segment.pending_split
+            segment.pending_split = None
+            unneeded.client.cancel()
+            self.segments.remove(unneeded)
+        if not [s for s in self.segments if not s.finished]:
+            self.finish_segmented_download()
+        else:
+            self.save_segments()
+            # give the connection to the segment with the most data left
+            self.split_segments()
+
+    def on_segment_error(self, segment, error):
+        if not self.is_current_segment(segment):
+            return
+        if segment.client is self.client:
+            self.client = None
+        segment.client = None
+        if not segment.confirmed:
+            # The server ignored the Range header for a new segment, or
+            # doesn't want us to open another connection.  Let the segment
+            # we split it from download the data, and don't try again.
+            logging.info("Error starting download segment, not splitting "
+                         "%s any more: %s", self.url, error)
+            self.use_segments = False
+            parent = self.find_split_parent(segment)
+            if parent is not None:
+                parent.pending_split = None
+            self.segments.remove(segment)
+            self.save_segments()
+            return
+        # stop the other segments and handle the error like we would for a
+        # single connection download.
+        self.cancel_request()
+        self.handle_download_error(error)
+
+    def update_segment_stats(self):
+        rate = 0
+        for segment in self.segments:
+            if segment.client is not None:
+                stats = segment.client.get_stats()
+                segment.update_stats(stats)
+                rate += stats.download_rate
+        self.current_size = sum(s.downloaded() for s in self.segments)
+        self.rate = rate
+
+    def save_segments(self):
+        # unconfirmed segments overlap their parent, so don't save them.  If
+        # we restart, the parent will download their data.
+        save_segment_data(self.filename, self.total_size,
+                          [s for s in self.segments if s.confirmed])
+
+    def cancel_segments(self, remove_file):
+        self.update_segment_stats()
+        for segment in self.segments:
+            if segment.client is not None:
+                segment.client.cancel()
+                segment.client = None
+        self.client = None
+        if remove_file:
+            remove_segment_data(self.filename)
+            try:
+                fileutil.remove(self.filename)
+            except OSError:
+                pass
+        else:
+            self.save_segments()
+        self.segments = None
+
+    def finish_segmented_download(self):
+        self.update_segment_stats()
+        self.segments = None
+        remove_segment_data(self.filename)
+        self.finish_download()
+
     def destroy_client(self):
         """update the stats before we throw away the client.
         """
@@ -799,6 +1221,8 @@ class HTTPDownloader(BGDownloader):
         self.client = None
 
     def cancel_request(self, remove_file=False):
+        if self.segments is not None:
+            self.cancel_segments(remove_file)
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
@@ -815,6 +1239,7 @@ class HTTPDownloader(BGDownloader):
                 fileutil.remove(self.filename)
             except OSError:
                 pass
+        remove_segment_data(self.filename)
         self.current_size = 0
         self.total_size = None
 
@@ -850,8 +1275,19 @@ class HTTPDownloader(BGDownloader):
             ext_content_type = info.get('content-type')
         self.short_filename = check_filename_extension(self.short_filename,
                 ext_content_type)
+        # remember what we need to split the download into segments
+        self.accept_ranges = info.get('accept-ranges')
+        self.segment_url = info['redirected-url']
 
     def on_download_error(self, error):
+        if self.segments is not None:
+            # self.client is the first segment of the download
+            if self.client is self.segments[0].client:
+                self.on_segment_error(self.segments[0], error)
+        else:
+            self.handle_download_error(error)
+
+    def handle_download_error(self, error):
         if isinstance(error, httpclient.ResumeFailed):
             # try starting from scratch
             self.current_size = 0
@@ -868,7 +1304,15 @@ class HTTPDownloader(BGDownloader):
             self.handle_network_error(error)
 
     def on_download_finished(self, response):
+        if self.segments is not None:
+            # self.client is the first segment of the download
+            if self.client is self.segments[0].client:
+                self.on_segment_finished(self.segments[0])
+            return
         self.destroy_client()
+        self.finish_download()
+
+    def finish_download(self):
         self.state = u"finished"
         self.end_time = int(clock())
         self.rate = None
@@ -896,15 +1340,24 @@ class HTTPDownloader(BGDownloader):
         """Update the download rate and eta based on receiving length
         bytes.
         """
-        if self.client is None or self.state != u'downloading':
+        if self.state != u'downloading':
+            return
+        if self.segments is not None:
+            self.update_segment_stats()
+        elif self.client is not None:
+            stats = self.client.get_stats()
+            if stats.status_code in (200, 206):
+                # Only upload current_size/rate if we are currently
+                # downloading something.  Don't change them before the
+                # transfer starts, while we are handling redirects, etc.
+                self.current_size = stats.downloaded + stats.initial_size
+                self.rate = stats.download_rate
+                if stats.decoded_bytes > 0:
+                    # Now that the body is coming in we know the request
+                    # works, so we can try to speed it up.
+                    self.start_segmenting(stats)
+        else:
             return
-        stats = self.client.get_stats()
-        if stats.status_code in (200, 206):
-            # Only upload current_size/rate if we are currently
-            # downloading something.  Don't change them before the
-            # transfer starts, while we are handling redirects, etc.
-            self.current_size = stats.downloaded + stats.initial_size
-            self.rate = stats.download_rate
         eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
                 'update http downloader stats')
         self.update_client()
@@ -934,6 +1387,7 @@ class HTTPDownloader(BGDownloader):
             # Cancel the request, don't keep around partially
             # downloaded data
             self.cancel_request(remove_file=True)
+            remove_segment_data(self.filename)
         self.current_size = 0
         self.state = u"stopped"
         self.update_client()
@@ -1030,6 +1484,107 @@ def remove_fast_resume_data(info_hash):
         except OSError:
             logging.exception("remove_fast_resume_data kicked up exception")
 
+class FastResumeWriter(object):
+    """Writes fast resume data to disk from a worker thread.
+
+    save() just remembers the data.  A while later, we write all the data
+    that was saved in the meantime in one batch, so that writing doesn't
+    block the event loop.
+
+    lock protects our dicts and is never held while accessing files.
+    write_lock is held while accessing a file, so writes for a torrent
+    always happen in order and remove() waits for a write in progress
+    instead of having the file recreated after it's deleted.
+    """
+    WRITE_DELAY = 5
+
+    def __init__(self):
+        self.lock = Lock()
+        self.write_lock = Lock()
+        # maps info hash -> data to write
+        self.pending = {}
+        # maps info hash -> data that flush() is about to write
+        self.writing = {}
+        self.write_scheduled = False
+
+    def save(self, info_hash, fast_resume_data):
+        self.lock.acquire()
+        try:
+            self.pending[info_hash] = fast_resume_data
+            schedule_write = not self.write_scheduled
+            self.write_scheduled = True
+        finally:
+            self.lock.release()
+        if schedule_write:
+            eventloop.add_timeout(self.WRITE_DELAY, self.start_write,
+                                  "write fast resume data")
+
+    def start_write(self):
+        eventloop.call_in_thread(self.on_write_done, self.on_write_error,
+                                 self.flush, "write fast resume data")
+
+    def on_write_done(self, result):
+        pass
+
+    def on_write_error(self, error):
+        logging.warn("Error writing fast resume data: %s", error)
+
+    def load(self, info_hash):
+        """Get fast resume data, including data we haven't written yet."""
+        self.lock.acquire()
+        try:
+            if info_hash in self.pending:
+                return self.pending[info_hash]
+            if info_hash in self.writing:
+                return self.writing[info_hash]
+        finally:
+            self.lock.release()
+        self.write_lock.acquire()
+        try:
+            return load_fast_resume_data(info_hash)
+        finally:
+            self.write_lock.release()
+
+    def remove(self, info_hash):
+        self.lock.acquire()
+        try:
+            self.pending.pop(info_hash, None)
+            self.writing.pop(info_hash, None)
+        finally:
+            self.lock.release()
+        self.write_lock.acquire()
+        try:
+            remove_fast_resume_data(info_hash)
+        finally:
+            self.write_lock.release()
+
+    def flush(self):
+        """Write all pending data now."""
+        self.lock.acquire()
+        try:
+            self.writing.update(self.pending)
+            info_hashes = self.pending.keys()
+            self.pending = {}
+            self.write_scheduled = False
+        finally:
+            self.lock.release()
+        for info_hash in info_hashes:
+            self.write_lock.acquire()
+            try:
+                # Get the data now, in case remove() was called or another
+                # flush() already wrote it.
+                self.lock.acquire()
+                try:
+                    fast_resume_data = self.writing.pop(info_hash, None)
+                finally:
+                    self.lock.release()
+                if fast_resume_data is not None:
+                    save_fast_resume_data(info_hash, fast_resume_data)
+            finally:
+                self.write_lock.release()
+
+FAST_RESUME_WRITER = FastResumeWriter()
+
 # update fast resume data every 5 seconds
 FRD_UPDATE_LIMIT = 5
 
@@ -1126,7 +1681,7 @@ class BTDownloader(BGDownloader):
                 params["storage_mode"] = lt.storage_mode_t.storage_mode_compact
 
             if self.info_hash:
-                self.fast_resume_data = load_fast_resume_data(self.info_hash)
+                self.fast_resume_data = FAST_RESUME_WRITER.load(self.info_hash)
                 if self.fast_resume_data:
                     params["resume_data"] = lt.bencode(self.fast_resume_data)
 
@@ -1253,8 +1808,11 @@ class BTDownloader(BGDownloader):
                       self.leechers,
                       self.current_size)
 
-    def update_status(self):
-        """
+    def update_status(self, status=None):
+        """Update our attributes from a libtorrent torrent_status.
+
+        If status is None, we ask libtorrent for it.
+
         activity -- string specifying what's currently happening or None for
                 normal operations.
         upload_rate -- upload rate in B/s
@@ -1268,7 +1826,8 @@ class BTDownloader(BGDownloader):
         leechers -- number of leechers for this torrent
         connecting -- nummber of peers we're connected to
         """
-        status = self.torrent.status()
+        if status is None:
+            status = self.torrent.status()
         self.total_size = status.total_wanted
         self.rate = int(status.download_payload_rate)
         self.upload_rate = int(status.upload_payload_rate)
@@ -1340,10 +1899,13 @@ class BTDownloader(BGDownloader):
             return
         self._last_frd_update = time_now
 
+        if not force and TORRENT_SESSION.use_state_updates:
+            # libtorrent will send us the data in a save_resume_data_alert
+            self.torrent.save_resume_data()
+            return
+
+        # We're about to remove the torrent, so we need the data now.
         try:
-            # FIXME - we should switch to save_resume_data which uses
-            # an alert to save resume data rather than
-            # write_resume_data which looks deprecated in 0.15.5.
             self.fast_resume_data = lt.bencode(
                 self.torrent.write_resume_data())
         except RuntimeError, rte:
@@ -1356,7 +1918,20 @@ class BTDownloader(BGDownloader):
                 "RuntimeError kicked up in update_fast_resume_data: %s", rte)
             return
 
-        save_fast_resume_data(self.info_hash, self.fast_resume_data)
+        FAST_RESUME_WRITER.save(self.info_hash, self.fast_resume_data)
+
+    def on_resume_data(self, resume_data):
+        self.fast_resume_data = lt.bencode(resume_data)
+        FAST_RESUME_WRITER.save(self.info_hash, self.fast_resume_data)
+
+    def on_resume_data_failed(self, message):
+        BTDownloader.FRD_PROBLEMS += 1
+        logging.warning("Error saving fast resume data: %s", message)
+
+    def on_metadata_received(self):
+        if self.get_delayed_metainfo:
+            self.got_delayed_metainfo()
+            self.get_delayed_metainfo = False
 
     def handle_error(self, short_reason, reason):
         self._shutdown_torrent()
@@ -1431,7 +2006,7 @@ class BTDownloader(BGDownloader):
                 pass
 
             if self.info_hash:
-                remove_fast_resume_data(self.info_hash)
+                FAST_RESUME_WRITER.remove(self.info_hash)
 
     def stop_upload(self):
         self.state = u"finished"
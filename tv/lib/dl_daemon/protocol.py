@@ -0,0 +1,176 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.dl_daemon.protocol`` -- Wire format for talking to the
+downloader daemon.
+
+Commands are sent in frames.  Each frame starts with a header that holds
+the protocol version and the length of the body.  The body is a pickled
+list of commands, so that all the commands queued up during one pass
+through the event loop only cost one pickle and one socket write.
+
+Download status updates are sent as deltas.  The downloader remembers the
+last status it sent for each download and only sends the fields that
+changed since then, packed according to STATUS_FIELDS.  The controller
+keeps the full statuses and fills in the rest.  The socket delivers
+frames in order, so every status that the downloader sent is one that the
+controller has seen by the time the next one arrives.  Both sides start
+from scratch on each connection.
+"""
+
+from struct import pack, unpack, calcsize
+
+# Change this whenever the frame format or STATUS_FIELDS changes.
+PROTOCOL_VERSION = 1
+
+FRAME_HEADER = "<BQ"
+FRAME_HEADER_SIZE = calcsize(FRAME_HEADER)
+
+class ProtocolError(StandardError):
+    """The other side of the connection sent a frame we can't handle."""
+    pass
+
+def pack_frame_header(body_length):
+    return pack(FRAME_HEADER, PROTOCOL_VERSION, body_length)
+
+def unpack_frame_header(data):
+    """Unpack a frame header.
+
+    :returns: the length of the frame body
+    :raises ProtocolError: if the frame is for another protocol version
+    """
+    version, body_length = unpack(FRAME_HEADER, data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError("Unknown protocol version: %s" % version)
+    return body_length
+
+# Fields in the status dicts from the downloader.  A status delta has a
+# bitmask with bit N set if it includes the value for STATUS_FIELDS[N].
+# Don't reorder these without changing PROTOCOL_VERSION.
+STATUS_FIELDS = (
+    'url',
+    'state',
+    'total_size',
+    'current_size',
+    'eta',
+    'rate',
+    'upload_size',
+    'filename',
+    'start_time',
+    'end_time',
+    'short_filename',
+    'reason_failed',
+    'short_reason_failed',
+    'type',
+    'retry_time',
+    'retry_count',
+    'upload_rate',
+    'activity',
+    'seeders',
+    'leechers',
+    'connections',
+    'info_hash',
+    'metainfo',
+)
+STATUS_FIELD_BITS = dict((name, 1 << i) for i, name in
+                         enumerate(STATUS_FIELDS))
+
+# Fields that only get sent when they change, and that the controller
+# shouldn't remember.  The downloader only includes metainfo in a status
+# when there's new metainfo.
+TRANSIENT_STATUS_FIELDS = frozenset(['metainfo'])
+
+class StatusEncoder(object):
+    """Turns download status dicts into deltas on the downloader side.
+
+    A delta is a (dlid, mask, values, extra) tuple.  values contains the
+    changed values from STATUS_FIELDS, in order.  extra is a dict holding
+    any fields that aren't in STATUS_FIELDS, or None.
+    """
+    def __init__(self):
+        # maps dlid -> the last values we sent for it
+        self.last_sent = {}
+
+    def encode(self, status):
+        dlid = status['dlid']
+        last_sent = self.last_sent.setdefault(dlid, {})
+        mask = 0
+        values = []
+        extra = None
+        field_count = 0
+        for name in STATUS_FIELDS:
+            if name not in status:
+                continue
+            field_count += 1
+            value = status[name]
+            if name in TRANSIENT_STATUS_FIELDS:
+                pass
+            elif name in last_sent and last_sent[name] == value:
+                continue
+            else:
+                last_sent[name] = value
+            mask |= STATUS_FIELD_BITS[name]
+            values.append(value)
+        if len(status) > field_count + 1:
+            for name, value in status.iteritems():
+                if name != 'dlid' and name not in STATUS_FIELD_BITS:
+                    if extra is None:
+                        extra = {}
+                    extra[name] = value
+        return (dlid, mask, tuple(values), extra)
+
+class StatusDecoder(object):
+    """Turns deltas from StatusEncoder back into status dicts on the
+    controller side.
+    """
+    def __init__(self):
+        # maps dlid -> the full status for it
+        self.statuses = {}
+
+    def decode(self, delta):
+        dlid, mask, values, extra = delta
+        status = self.statuses.setdefault(dlid, {'dlid': dlid})
+        rv = None
+        values = iter(values)
+        for name in STATUS_FIELDS:
+            if mask & STATUS_FIELD_BITS[name]:
+                if name in TRANSIENT_STATUS_FIELDS:
+                    if rv is None:
+                        rv = {}
+                    rv[name] = values.next()
+                else:
+                    status[name] = values.next()
+        if extra:
+            status.update(extra)
+        # Return a copy, since RemoteDownloader.update_status() changes the
+        # dict that it gets.
+        if rv is None:
+            return status.copy()
+        rv.update(status)
+        return rv
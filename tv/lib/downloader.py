@@ -273,6 +273,26 @@ class RemoteDownloader(DDBObject):
         'current_size',
         'upload_size',
     ])
+    # status attributes that ItemInfo displays.  If a status update doesn't
+    # change any of these, we don't need to tell our items about it.
+    item_status_attributes = set([
+        'state',
+        'reason_failed',
+        'short_reason_failed',
+        'type',
+        'retry_time',
+        'retry_count',
+        'eta',
+        'rate',
+        'upload_rate',
+        'current_size',
+        'total_size',
+        'upload_size',
+        'activity',
+        'seeders',
+        'leechers',
+        'connections',
+    ])
 
     def setup_new(self, url, item, content_type=None, channel_name=None):
         check_u(url)
@@ -283,6 +303,7 @@ class RemoteDownloader(DDBObject):
         self.child_deleted = False
         self.main_item_id = None
         self.dlid = generate_dlid()
+        self._add_to_cache()
         if content_type is None:
             # HACK: Some servers report the wrong content-type for
             # torrent files.  We try to work around that by assuming
@@ -315,6 +336,19 @@ class RemoteDownloader(DDBObject):
         if self.dlid == 'noid':
             # this won't happen nowadays, but it can for old databases
             self.dlid = generate_dlid()
+        self._add_to_cache()
+
+    def _add_to_cache(self):
+        self.db_info.db.cache.set('downloader-dlid', self.dlid, self)
+
+    def _remove_from_cache(self):
+        try:
+            self.db_info.db.cache.remove('downloader-dlid', self.dlid)
+        except KeyError:
+            pass
+
+    def insert_into_db_failed(self):
+        self._remove_from_cache()
 
     def reset_status_attributes(self):
         """Reset the attributes that track downloading info."""
@@ -323,7 +357,11 @@ class RemoteDownloader(DDBObject):
             setattr(self, attr_name, default)
 
     def update_status_attributes(self, status_dict):
-        """Reset the attributes that track downloading info."""
+        """Reset the attributes that track downloading info.
+
+        :returns: set of attribute names that changed
+        """
+        changed = set()
         for attr_name in self.status_attributes:
             if attr_name in status_dict:
                 value = status_dict[attr_name]
@@ -333,6 +371,8 @@ class RemoteDownloader(DDBObject):
             # UPDATE statments contain less data
             if getattr(self, attr_name) != value:
                 setattr(self, attr_name, value)
+                changed.add(attr_name)
+        return changed
 
     def get_status_for_downloader(self):
         status = dict((name, getattr(self, name))
@@ -355,8 +395,19 @@ class RemoteDownloader(DDBObject):
         return cls.make_view("state == 'uploading' AND NOT manualUpload")
 
     @classmethod
-    def get_by_dlid(cls, dlid):
-        return cls.make_view('dlid=?', (dlid,)).get_singleton()
+    def get_by_dlid(cls, dlid, db_info=None):
+        """Get a downloader by its dlid attribute.
+
+        We use the DatabaseObjectCache to cache downloaders by dlid, since
+        we look them up for every status update from the downloader.
+        """
+        if db_info is None:
+            db_info = app.db_info
+        try:
+            return db_info.db.cache.get('downloader-dlid', dlid)
+        except KeyError:
+            return cls.make_view('dlid=?', (dlid,),
+                                 db_info=db_info).get_singleton()
 
     @classmethod
     def get_by_url(cls, url):
@@ -514,7 +565,7 @@ class RemoteDownloader(DDBObject):
             old_filename = self.get_filename()
 
             self.before_changing_rates()
-            self.update_status_attributes(data)
+            changed = self.update_status_attributes(data)
             self.after_changing_rates()
 
             # Store the time the download finished
@@ -528,9 +579,12 @@ class RemoteDownloader(DDBObject):
                       and self.get_upload_ratio() > app.config.get(prefs.UPLOAD_RATIO)))):
                 self.stop_upload()
 
-            self.signal_change()
-
-            self.update_item_list(finished, file_migrated, old_filename)
+            if changed:
+                # Our items only need to know if the user can see the change
+                needs_signal_item = not changed.isdisjoint(
+                    self.item_status_attributes)
+                self.signal_change(needs_signal_item=needs_signal_item)
+                self.update_item_list(finished, file_migrated, old_filename)
         return True
 
     def update_item_list(self, finished, file_migrated, old_filename):
@@ -662,7 +716,9 @@ class RemoteDownloader(DDBObject):
             # For failed downloads, don't trust the redirected URL (#14232)
             self.url = self.orig_url
             app.download_state_manager.delete_download(self.dlid)
+            self._remove_from_cache()
             self.dlid = generate_dlid()
+            self._add_to_cache()
             self.before_changing_rates()
             self.reset_status_attributes()
             self.after_changing_rates()
@@ -770,6 +826,7 @@ class RemoteDownloader(DDBObject):
                              "but state is %s", self.get_state())
         self.stop(self.delete_files)
         self.after_changing_rates()
+        self._remove_from_cache()
         DDBObject.remove(self)
 
     def get_type(self):
@@ -177,7 +177,8 @@ class _EchonestQuery(object):
         url = 'http://echonest.pculture.org/api/v4/song/identify?'
         httpclient.grab_url(url,
                             self.echonest_callback, self.echonest_errback,
-                            post_vars=post_vars)
+                            post_vars=post_vars,
+                            priority=httpclient.TRANSFER_PRIORITY_LOW)
 
     def query_echonest_with_tags(self, metadata):
         url_data = [
@@ -195,7 +196,8 @@ class _EchonestQuery(object):
         url = ('http://echonest.pculture.org/api/v4/song/search?' +
                 urllib.urlencode(url_data))
         httpclient.grab_url(url, self.echonest_callback,
-                            self.echonest_errback)
+                            self.echonest_errback,
+                            priority=httpclient.TRANSFER_PRIORITY_LOW)
 
     def query_echonest_with_echonest_id(self, echonest_id):
         url_data = [
@@ -207,7 +209,8 @@ class _EchonestQuery(object):
         url = ('http://echonest.pculture.org/api/v4/song/profile?' +
                 urllib.urlencode(url_data))
         httpclient.grab_url(url,
-                            self.echonest_callback, self.echonest_errback)
+                            self.echonest_callback, self.echonest_errback,
+                            priority=httpclient.TRANSFER_PRIORITY_LOW)
 
     def _make_echonest_query(self, code, version, metadata):
         echonest_metadata = {'version': version}
@@ -291,7 +294,8 @@ class _EchonestQuery(object):
             seven_digital_url = self._make_7digital_url(release_id)
             httpclient.grab_url(seven_digital_url,
                                 self.seven_digital_callback,
-                                self.seven_digital_errback)
+                                self.seven_digital_errback,
+                                priority=httpclient.TRANSFER_PRIORITY_LOW)
         else:
             self.handle_7digital_cache_hit(release_id)
 
@@ -433,7 +437,8 @@ class _EchonestQuery(object):
         httpclient.grab_url(self.cover_art_url,
                             self.cover_art_callback,
                             self.cover_art_errback,
-                            write_file=self.grab_url_dest)
+                            write_file=self.grab_url_dest,
+                            priority=httpclient.TRANSFER_PRIORITY_LOW)
 
     def cover_art_callback(self, data):
         # we don't care about the data sent back, since grab_url wrote our
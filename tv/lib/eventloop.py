@@ -35,9 +35,11 @@ network requests and scheduling.
 TODO: handle user setting clock back
 """
 
+import collections
 import errno
 import heapq
 import logging
+import math
 import Queue
 import select
 import socket
@@ -46,6 +48,7 @@ import traceback
 
 from miro import app
 from miro import config
+from miro import latencystats
 from miro import trapcall
 from miro import signals
 from miro import util
@@ -54,6 +57,29 @@ from miro.plat.utils import thread_body
 
 cumulative = {}
 
+# Priorities for idle callbacks.  Use HIGH for work that the user is waiting
+# to see and LOW for background maintenance.
+IDLE_PRIORITY_HIGH = 0
+IDLE_PRIORITY_NORMAL = 1
+IDLE_PRIORITY_LOW = 2
+IDLE_PRIORITIES = (IDLE_PRIORITY_HIGH, IDLE_PRIORITY_NORMAL,
+                   IDLE_PRIORITY_LOW)
+# An idle callback gets bumped up one priority level for each IDLE_AGING_TIME
+# seconds it waits.  This ensures that low priority callbacks still make
+# progress when there's a steady stream of higher priority ones.
+IDLE_AGING_TIME = 1.0
+# Max time to spend running idle callbacks in one iteration of the event
+# loop.  Once it's used up, we go back to checking sockets and timeouts.
+IDLE_TIME_BUDGET = 0.05
+
+# Compact the timeout heap once it has at least this many cancelled
+# DelayedCalls and they make up more than SCHEDULER_COMPACT_RATIO of it.
+SCHEDULER_COMPACT_MIN = 100
+SCHEDULER_COMPACT_RATIO = 0.5
+# Timeouts with a delay at least this long go in the timer wheel, if the
+# Scheduler has one.
+TIMER_WHEEL_MIN_DELAY = 5.0
+
 class DelayedCall(object):
     def __init__(self, function, name, args, kwargs):
         self.function = function
@@ -61,6 +87,8 @@ class DelayedCall(object):
         self.args = args
         self.kwargs = kwargs
         self.canceled = False
+        # Scheduler or TimerWheel that's holding on to us
+        self.container = None
 
     def _unlink(self):
         """Removes the references that this object has to the outside
@@ -70,6 +98,18 @@ class DelayedCall(object):
         self.function = self.args = self.kwargs = None
 
     def cancel(self):
+        container = self.container
+        if container is not None:
+            # cancel() can be called from any thread.  The Scheduler and its
+            # TimerWheel share a lock, so self.container can't change while
+            # we hold it.
+            container.lock.acquire()
+            try:
+                if not self.canceled and self.container is not None:
+                    self.container.cancelled_count += 1
+                self.canceled = True
+            finally:
+                container.lock.release()
         self.canceled = True
         self._unlink()
 
@@ -81,6 +121,7 @@ class DelayedCall(object):
             success = trapcall.trap_call(when, self.function, *self.args,
                     **self.kwargs)
             end = clock()
+            latencystats.record('eventloop', self.name, end-start)
             if end-start > 0.5:
                 logging.timing("%s too slow (%.3f secs)",
                                self.name, end-start)
@@ -97,9 +138,141 @@ class DelayedCall(object):
         self._unlink()
         return success
 
+class TimerWheel(object):
+    """Hashed timer wheel used by Scheduler for long timeouts.
+
+    Adding and cancelling timeouts is O(1), no matter how many are pending.
+    Each slot holds the timeouts for one tick of slot_time seconds, with
+    timeouts more than slot_count ticks away sharing slots with closer
+    ones.  Once a timeout's tick comes up, advance() returns it so the
+    Scheduler can move it to its heap, which handles the exact timing.
+
+    TimerWheel doesn't do any locking itself, lock should be the lock of
+    the Scheduler that uses it.
+    """
+    def __init__(self, lock, slot_time=1.0, slot_count=512):
+        self.lock = lock
+        self.slot_time = slot_time
+        self.slots = [[] for i in xrange(slot_count)]
+        # next tick that advance() needs to look at
+        self.next_tick = None
+        self.count = 0
+        self.cancelled_count = 0
+        # cached result for next_check_time()
+        self._next_check_time = None
+
+    def _tick(self, when):
+        return int(when / self.slot_time)
+
+    def add(self, scheduled_time, dc):
+        """Add a DelayedCall to the wheel
+
+        :returns: True if it was added, False if its tick has already been
+        processed and the caller should schedule it some other way.
+        """
+        tick = self._tick(scheduled_time)
+        if self.next_tick is None:
+            self.next_tick = self._tick(clock())
+        if tick < self.next_tick:
+            return False
+        self.slots[tick % len(self.slots)].append((scheduled_time, dc))
+        dc.container = self
+        self.count += 1
+        if (self._next_check_time is not None and
+                scheduled_time < self._next_check_time):
+            self._next_check_time = scheduled_time
+        return True
+
+    def advance(self, now):
+        """Remove the timeouts whose tick has come up.
+
+        Cancelled timeouts get dropped.
+
+        :returns: list of (scheduled_time, DelayedCall) tuples
+        """
+        if not self.count:
+            self.next_tick = None
+            return []
+        now_tick = self._tick(now)
+        if now_tick < self.next_tick:
+            return []
+        if now_tick - self.next_tick >= len(self.slots):
+            ticks = xrange(len(self.slots))
+        else:
+            ticks = xrange(self.next_tick, now_tick + 1)
+        due = []
+        for tick in ticks:
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                if entry[1].canceled:
+                    self.cancelled_count -= 1
+                elif self._tick(entry[0]) <= now_tick:
+                    due.append(entry)
+                else:
+                    remaining.append(entry)
+            self.count -= len(slot) - len(remaining)
+            self.slots[index] = remaining
+        self.next_tick = now_tick + 1
+        self._next_check_time = None
+        return due
+
+    def compact(self):
+        """Remove cancelled timeouts from all slots."""
+        for index, slot in enumerate(self.slots):
+            if slot:
+                self.slots[index] = [entry for entry in slot
+                                     if not entry[1].canceled]
+        self.count = sum(len(slot) for slot in self.slots)
+        self.cancelled_count = 0
+
+    def next_check_time(self):
+        """Get the next time that advance() could return something.
+
+        This is the earliest deadline on the wheel, or the start of the next
+        turn of the wheel if all the timeouts are further away than that.
+        """
+        if not self.count:
+            return None
+        if self._next_check_time is None:
+            self._next_check_time = self._calc_next_check_time()
+        return self._next_check_time
+
+    def _calc_next_check_time(self):
+        slot_count = len(self.slots)
+        for tick in xrange(self.next_tick, self.next_tick + slot_count):
+            deadlines = [scheduled_time
+                         for (scheduled_time, dc)
+                         in self.slots[tick % slot_count]
+                         if self._tick(scheduled_time) == tick and
+                         not dc.canceled]
+            if deadlines:
+                return min(deadlines)
+        return (self.next_tick + slot_count) * self.slot_time
+
 class Scheduler(object):
-    def __init__(self):
+    """Runs DelayedCalls after a timeout.
+
+    Timeouts are stored in a heap.  Cancelled timeouts stay there until
+    they reach the top, unless they pile up, in which case we compact the
+    heap (see SCHEDULER_COMPACT_MIN).
+
+    If use_timer_wheel is True, timeouts of at least TIMER_WHEEL_MIN_DELAY
+    are stored in a TimerWheel until they're close to running.
+    """
+    def __init__(self, use_timer_wheel=False):
         self.heap = []
+        self.cancelled_count = 0
+        self.compaction_count = 0
+        # add_timeout() can be called from any thread
+        self.lock = threading.Lock()
+        if use_timer_wheel:
+            self.timer_wheel = TimerWheel(self.lock)
+        else:
+            self.timer_wheel = None
 
     def add_timeout(self, delay, function, name, args=None, kwargs=None):
         if args is None:
@@ -108,22 +281,118 @@ class Scheduler(object):
             kwargs = {}
         scheduled_time = clock() + delay
         dc = DelayedCall(function,  "timeout (%s)" % (name,), args, kwargs)
+        self.lock.acquire()
+        try:
+            if (self.timer_wheel is None or delay < TIMER_WHEEL_MIN_DELAY or
+                    not self.timer_wheel.add(scheduled_time, dc)):
+                self._push(scheduled_time, dc)
+        finally:
+            self.lock.release()
+        return dc
+
+    def _push(self, scheduled_time, dc):
+        dc.container = self
         heapq.heappush(self.heap, (scheduled_time, dc))
+
+    def _update_heap(self):
+        """Prepare our heap before looking at the next timeout.
+
+        Call this with the lock held.  We move timeouts from the timer wheel
+        to the heap, compact it if needed and drop cancelled timeouts from
+        the top.
+        """
+        if self.timer_wheel is not None:
+            if self._should_compact(self.timer_wheel.cancelled_count,
+                                    self.timer_wheel.count):
+                self.timer_wheel.compact()
+                self.compaction_count += 1
+            for scheduled_time, dc in self.timer_wheel.advance(clock()):
+                self._push(scheduled_time, dc)
+        if self._should_compact(self.cancelled_count, len(self.heap)):
+            self._compact()
+        while self.heap and self.heap[0][1].canceled:
+            self._pop()
+
+    def _should_compact(self, cancelled_count, size):
+        return (cancelled_count >= SCHEDULER_COMPACT_MIN and
+                cancelled_count > size * SCHEDULER_COMPACT_RATIO)
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if not entry[1].canceled]
+        heapq.heapify(self.heap)
+        self.cancelled_count = 0
+        self.compaction_count += 1
+
+    def _pop(self):
+        scheduled_time, dc = heapq.heappop(self.heap)
+        if dc.canceled:
+            self.cancelled_count -= 1
+        dc.container = None
         return dc
 
     def next_timeout(self):
-        if len(self.heap) == 0:
+        self.lock.acquire()
+        try:
+            self._update_heap()
+            next_times = []
+            if self.heap:
+                next_times.append(self.heap[0][0])
+            if self.timer_wheel is not None:
+                wheel_time = self.timer_wheel.next_check_time()
+                if wheel_time is not None:
+                    next_times.append(wheel_time)
+        finally:
+            self.lock.release()
+        if not next_times:
             return None
         else:
-            return max(0, self.heap[0][0] - clock())
+            return max(0, min(next_times) - clock())
 
     def has_pending_timeout(self):
-        return len(self.heap) > 0 and self.heap[0][0] < clock()
+        self.lock.acquire()
+        try:
+            self._update_heap()
+            return len(self.heap) > 0 and self.heap[0][0] < clock()
+        finally:
+            self.lock.release()
 
     def process_next_timeout(self):
-        time, dc = heapq.heappop(self.heap)
+        self.lock.acquire()
+        try:
+            dc = self._pop()
+        finally:
+            self.lock.release()
         return dc.dispatch()
 
+    def get_stats(self):
+        """Get statistics about pending timeouts.
+
+        :returns: dict with heap_size, cancelled, cancelled_ratio,
+        compactions, timer_wheel_size and timer_wheel_cancelled keys
+        """
+        self.lock.acquire()
+        try:
+            heap_size = len(self.heap)
+            if self.timer_wheel is not None:
+                timer_wheel_size = self.timer_wheel.count
+                timer_wheel_cancelled = self.timer_wheel.cancelled_count
+            else:
+                timer_wheel_size = timer_wheel_cancelled = 0
+            if heap_size:
+                cancelled_ratio = float(self.cancelled_count) / heap_size
+            else:
+                cancelled_ratio = 0.0
+            return {
+                'heap_size': heap_size,
+                'cancelled': self.cancelled_count,
+                'cancelled_ratio': cancelled_ratio,
+                'compactions': self.compaction_count,
+                'timer_wheel_size': timer_wheel_size,
+                'timer_wheel_cancelled': timer_wheel_cancelled,
+            }
+        finally:
+            self.lock.release()
+
 class CallQueue(object):
     def __init__(self):
         self.queue = Queue.Queue()
@@ -164,6 +433,65 @@ class CallQueue(object):
         while self.has_pending_idle() and not self.quit_flag:
             self.process_next_idle()
 
+class IdleQueue(CallQueue):
+    """CallQueue that runs idle callbacks in priority order.
+
+    Callbacks with the same priority run in FIFO order.  Callbacks waiting
+    in a lower priority queue are aged, see IDLE_AGING_TIME.
+    """
+    def __init__(self):
+        CallQueue.__init__(self)
+        # Each queue stores (time added, DelayedCall) tuples.  add_idle()
+        # can be called from any thread, so access them with the lock held.
+        self.queues = [collections.deque() for p in IDLE_PRIORITIES]
+        self.lock = threading.Lock()
+
+    def add_idle(self, function, name, args=None, kwargs=None,
+                 priority=IDLE_PRIORITY_NORMAL):
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        dc = DelayedCall(function, "idle (%s)" % (name,), args, kwargs)
+        self.lock.acquire()
+        try:
+            self.queues[priority].append((clock(), dc))
+            size = sum(len(queue) for queue in self.queues)
+        finally:
+            self.lock.release()
+        # See CallQueue.add_idle() for why we only warn a few times
+        if self.queue_size_warning_count < 5 and size > 1000:
+            logging.stacktrace("Queued called size too large")
+            self.queue_size_warning_count += 1
+        return dc
+
+    def _pop_next(self):
+        """Remove the next DelayedCall to run from our queues."""
+        self.lock.acquire()
+        try:
+            now = clock()
+            best_queue = best_priority = None
+            for priority, queue in enumerate(self.queues):
+                if not queue:
+                    continue
+                time_added = queue[0][0]
+                priority -= int((now - time_added) / IDLE_AGING_TIME)
+                if best_queue is None or priority < best_priority:
+                    best_queue = queue
+                    best_priority = priority
+            return best_queue.popleft()[1]
+        finally:
+            self.lock.release()
+
+    def process_next_idle(self):
+        return self._pop_next().dispatch()
+
+    def has_pending_idle(self):
+        for queue in self.queues:
+            if queue:
+                return True
+        return False
+
 
 class ThreadPool(object):
     """The thread pool is used to handle calls like gethostbyname()
@@ -233,6 +561,214 @@ class ThreadPool(object):
                 pass
         self.threads = []
 
+class SelectPoller(object):
+    """Waits for sockets to become ready using select.select().
+
+    Pollers keep track of which file descriptors we want to read from/write
+    to, then wait for them to become ready with poll().  select() works
+    everywhere, but it costs O(fds) per call and can't handle file
+    descriptors past FD_SETSIZE.
+    """
+    name = 'select'
+
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+
+    def update(self, fd, read, write):
+        """Set the events that we want to wait for on a file descriptor.
+
+        :param fd: file descriptor
+        :param read: should we wait for the fd to be readable?
+        :param write: should we wait for the fd to be writable?
+        """
+        if read:
+            self.read_fds.add(fd)
+        else:
+            self.read_fds.discard(fd)
+        if write:
+            self.write_fds.add(fd)
+        else:
+            self.write_fds.discard(fd)
+
+    def poll(self, timeout):
+        """Wait for file descriptors to become ready.
+
+        :param timeout: max time to wait in seconds, or None to wait forever
+        :returns: (read_fds_ready, write_fds_ready) tuple
+        """
+        try:
+            read_fds_ready, write_fds_ready, exc_fds_ready = \
+                    select.select(self.read_fds, self.write_fds, [], timeout)
+        except select.error, (err, detail):
+            if err == errno.EINTR:
+                logging.warning ("eventloop: %s", detail)
+                return [], []
+            raise
+        return read_fds_ready, write_fds_ready
+
+    def close(self):
+        pass
+
+class _MaskPoller(SelectPoller):
+    """Base class for pollers that register an event mask for each fd.
+
+    Subclasses define the READ_MASK/WRITE_MASK used for registering and the
+    READY_READ_MASK/READY_WRITE_MASK that we check returned events against.
+    Errors and hangups count as ready for both, which matches select().
+    """
+
+    def __init__(self):
+        self.masks = {}
+        self.poll_object = self.make_poll_object()
+
+    def update(self, fd, read, write):
+        mask = 0
+        if read:
+            mask |= self.READ_MASK
+        if write:
+            mask |= self.WRITE_MASK
+        old_mask = self.masks.get(fd)
+        if not mask:
+            if old_mask is not None:
+                del self.masks[fd]
+                self.unregister(fd)
+        elif old_mask is None:
+            self.masks[fd] = mask
+            self.register(fd, mask)
+        else:
+            # Call modify() even if the mask is the same, in case the fd was
+            # closed and a new socket got the same fd.
+            self.masks[fd] = mask
+            self.modify(fd, mask)
+
+    def poll(self, timeout):
+        read_fds_ready = []
+        write_fds_ready = []
+        try:
+            events = self.wait(timeout)
+        except (select.error, IOError, OSError), e:
+            if e.args[0] == errno.EINTR:
+                logging.warning ("eventloop: %s", e.args[1])
+                return read_fds_ready, write_fds_ready
+            raise
+        for fd, event in events:
+            mask = self.masks.get(fd, 0)
+            if mask & self.READ_MASK and event & self.READY_READ_MASK:
+                read_fds_ready.append(fd)
+            if mask & self.WRITE_MASK and event & self.READY_WRITE_MASK:
+                write_fds_ready.append(fd)
+        return read_fds_ready, write_fds_ready
+
+class PollPoller(_MaskPoller):
+    """Waits for sockets to become ready using select.poll()."""
+    name = 'poll'
+
+    if hasattr(select, 'poll'):
+        READ_MASK = select.POLLIN | select.POLLPRI
+        WRITE_MASK = select.POLLOUT
+        _ERROR_MASK = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        READY_READ_MASK = READ_MASK | _ERROR_MASK
+        READY_WRITE_MASK = WRITE_MASK | _ERROR_MASK
+
+    def make_poll_object(self):
+        return select.poll()
+
+    def register(self, fd, mask):
+        self.poll_object.register(fd, mask)
+
+    def modify(self, fd, mask):
+        # for poll objects, registering an fd again modifies it
+        self.poll_object.register(fd, mask)
+
+    def unregister(self, fd):
+        try:
+            self.poll_object.unregister(fd)
+        except KeyError:
+            pass
+
+    def wait(self, timeout):
+        if timeout is not None:
+            # round up to avoid spinning when the timeout is less than 1ms
+            timeout = int(math.ceil(timeout * 1000))
+        return self.poll_object.poll(timeout)
+
+class EpollPoller(_MaskPoller):
+    """Waits for sockets to become ready using select.epoll().
+
+    Only available on Linux.
+    """
+    name = 'epoll'
+
+    if hasattr(select, 'epoll'):
+        READ_MASK = select.EPOLLIN | select.EPOLLPRI
+        WRITE_MASK = select.EPOLLOUT
+        _ERROR_MASK = select.EPOLLERR | select.EPOLLHUP
+        READY_READ_MASK = READ_MASK | _ERROR_MASK
+        READY_WRITE_MASK = WRITE_MASK | _ERROR_MASK
+
+    def make_poll_object(self):
+        return select.epoll()
+
+    def register(self, fd, mask):
+        try:
+            self.poll_object.register(fd, mask)
+        except IOError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            # The fd was closed without being unregistered, and its number
+            # was reused.
+            self.poll_object.modify(fd, mask)
+
+    def modify(self, fd, mask):
+        try:
+            self.poll_object.modify(fd, mask)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # The fd was closed and re-opened, which removed it from the
+            # epoll set.
+            self.poll_object.register(fd, mask)
+
+    def unregister(self, fd):
+        try:
+            self.poll_object.unregister(fd)
+        except (IOError, ValueError):
+            # fd was already closed, which removes it from the epoll set
+            pass
+
+    def wait(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return self.poll_object.poll(timeout)
+
+    def close(self):
+        self.poll_object.close()
+
+# maps poller names to classes, best first.
+POLLERS = [
+    ('epoll', EpollPoller),
+    ('poll', PollPoller),
+    ('select', SelectPoller),
+]
+
+def available_pollers():
+    """Get the names of the pollers that this platform supports."""
+    return [name for name, klass in POLLERS
+            if name == 'select' or hasattr(select, name)]
+
+def make_poller(name=None):
+    """Create a poller
+
+    :param name: name of the poller to use, or None to use the best
+    available one
+    """
+    if name is None:
+        name = available_pollers()[0]
+    if name not in available_pollers():
+        raise ValueError("Poller not available: %s" % name)
+    return dict(POLLERS)[name]()
+
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
         signals.SignalEmitter.__init__(self, 'thread-will-start',
@@ -253,17 +789,12 @@ class SimpleEventLoop(signals.SignalEmitter):
         while not self.quit_flag:
             self.emit('begin-loop')
             timeout = self.calc_timeout()
-            readfds, writefds, excfds = self.calc_fds()
-            readfds.append(self.wake_receiver.fileno())
             try:
                 read_fds_ready, write_fds_ready, exc_fds_ready = \
-                        select.select(readfds, writefds, excfds, timeout)
-            except select.error, (err, detail):
-                if err == errno.EINTR:
-                    logging.warning ("eventloop: %s", detail)
-                else:
-                    self.emit('end-loop')
-                    raise
+                        self.wait_for_events(timeout)
+            except:
+                self.emit('end-loop')
+                raise
             if self.quit_flag:
                 self.emit('end-loop')
                 break
@@ -272,6 +803,21 @@ class SimpleEventLoop(signals.SignalEmitter):
             self.process_events(read_fds_ready, write_fds_ready, exc_fds_ready)
             self.emit('end-loop')
 
+    def wait_for_events(self, timeout):
+        """Wait for the fds from calc_fds() to become ready.
+
+        :returns: (read_fds_ready, write_fds_ready, exc_fds_ready) tuple
+        """
+        readfds, writefds, excfds = self.calc_fds()
+        readfds.append(self.wake_receiver.fileno())
+        try:
+            return select.select(readfds, writefds, excfds, timeout)
+        except select.error, (err, detail):
+            if err == errno.EINTR:
+                logging.warning ("eventloop: %s", detail)
+                return [], [], []
+            raise
+
     def wakeup(self):
         try:
             self.wake_sender.send("b")
@@ -282,44 +828,85 @@ class SimpleEventLoop(signals.SignalEmitter):
         self.wake_receiver.recv(1024)
 
 class EventLoop(SimpleEventLoop):
-    def __init__(self):
+    """Main event loop.
+
+    Unlike SimpleEventLoop, we don't call calc_fds() for each loop.  We keep
+    a poller up to date as read/write callbacks are added and removed.
+    """
+    def __init__(self, poller_name=None):
         SimpleEventLoop.__init__(self)
         self.create_signal('event-finished')
         self.scheduler = Scheduler()
-        self.idle_queue = CallQueue()
+        self.idle_queue = IdleQueue()
         self.urgent_queue = CallQueue()
         self.threadpool = ThreadPool(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
+        self.poller = None
+        self.set_poller(poller_name)
         self.clear_removed_callbacks()
         self.idles_for_next_loop = []
 
+    def set_poller(self, poller_name):
+        """Change the poller used to wait for sockets.
+
+        This should only be called from the event loop thread, or before the
+        loop is started.
+
+        :param poller_name: name of the poller, or None for the best one
+        available.  See available_pollers().
+        """
+        if self.poller is not None:
+            self.poller.close()
+        self.poller = make_poller(poller_name)
+        self.poller.update(self.wake_receiver.fileno(), True, False)
+        for fd in set(self.read_callbacks).union(self.write_callbacks):
+            self._update_poller(fd)
+
+    def _update_poller(self, fd):
+        self.poller.update(fd, fd in self.read_callbacks,
+                           fd in self.write_callbacks)
+
     def clear_removed_callbacks(self):
         self.removed_read_callbacks = set()
         self.removed_write_callbacks = set()
 
     def add_read_callback(self, sock, callback):
-        self.read_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.read_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_read_callback(self, sock):
-        del self.read_callbacks[sock.fileno()]
-        self.removed_read_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.read_callbacks[fd]
+        self.removed_read_callbacks.add(fd)
+        self._update_poller(fd)
 
     def add_write_callback(self, sock, callback):
-        self.write_callbacks[sock.fileno()] = callback
+        fd = sock.fileno()
+        self.write_callbacks[fd] = callback
+        self._update_poller(fd)
 
     def remove_write_callback(self, sock):
-        del self.write_callbacks[sock.fileno()]
-        self.removed_write_callbacks.add(sock.fileno())
+        fd = sock.fileno()
+        del self.write_callbacks[fd]
+        self.removed_write_callbacks.add(fd)
+        self._update_poller(fd)
+
+    def wait_for_events(self, timeout):
+        read_fds_ready, write_fds_ready = self.poller.poll(timeout)
+        return read_fds_ready, write_fds_ready, []
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
         self.threadpool.queue_call(callback, errback, function, name,
                                   *args, **kwargs)
 
-    def run_idle_next_loop(self, function, name, args=None, kwargs=None):
+    def run_idle_next_loop(self, function, name, args=None, kwargs=None,
+                           priority=IDLE_PRIORITY_NORMAL):
         """Add an idle callback to be called on the next event loop."""
-        self.idles_for_next_loop.append((function, name, args, kwargs))
+        self.idles_for_next_loop.append((function, name, args, kwargs,
+                                         priority))
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
         self._process_urgent_events()
@@ -338,6 +925,9 @@ class EventLoop(SimpleEventLoop):
         return (self.read_callbacks.keys(), self.write_callbacks.keys(), [])
 
     def calc_timeout(self):
+        if self.idle_queue.has_pending_idle():
+            # We ran out of time for idles last loop, don't block
+            return 0
         return self.scheduler.next_timeout()
 
     def do_begin_loop(self):
@@ -347,8 +937,8 @@ class EventLoop(SimpleEventLoop):
     def _add_idles_for_next_loop(self):
         if not self.idles_for_next_loop:
             return
-        for func, name, args, kwargs in self.idles_for_next_loop:
-            self.idle_queue.add_idle(func, name, args, kwargs)
+        for func, name, args, kwargs, priority in self.idles_for_next_loop:
+            self.idle_queue.add_idle(func, name, args, kwargs, priority)
         self.idles_for_next_loop = []
         # call wakeup() to make sure we process the idles we just
         # added
@@ -378,8 +968,13 @@ class EventLoop(SimpleEventLoop):
             yield callback
         while self.scheduler.has_pending_timeout():
             yield self.scheduler.process_next_timeout
+        # Run idles until we use up IDLE_TIME_BUDGET.  Anything left over
+        # runs on the next loop, after we check the sockets again.
+        deadline = clock() + IDLE_TIME_BUDGET
         while self.idle_queue.has_pending_idle():
             yield self.idle_queue.process_next_idle
+            if clock() >= deadline:
+                break
 
     def generate_callbacks(self, ready_list, map_, removed):
         for fd in ready_list:
@@ -397,6 +992,7 @@ class EventLoop(SimpleEventLoop):
                     success = trapcall.trap_call(when, function)
                     if not success:
                         del map_[fd]
+                        self._update_poller(fd)
                     return success
                 yield callback_event
 
@@ -433,6 +1029,14 @@ def remove_write_callback(sock):
     """
     _eventloop.remove_write_callback(sock)
 
+def set_poller(poller_name):
+    """Change the poller that the event loop uses to wait for sockets.
+
+    :param poller_name: "epoll", "poll", "select" or None to pick the best
+    one available.
+    """
+    _eventloop.set_poller(poller_name)
+
 def stop_handling_socket(sock):
     """Convience function to that removes both the read and write
     callback for a socket if they exist.
@@ -455,12 +1059,16 @@ def add_timeout(delay, function, name, args=None, kwargs=None):
     _eventloop.wakeup()
     return dc
 
-def add_idle(function, name, args=None, kwargs=None):
+def add_idle(function, name, args=None, kwargs=None,
+             priority=IDLE_PRIORITY_NORMAL):
     """Schedule a function to be called when we get some spare time.
     Returns a ``DelayedCall`` object that can be used to cancel the
     call.
+
+    priority should be one of the IDLE_PRIORITY_* constants.
     """
-    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs)
+    dc = _eventloop.idle_queue.add_idle(function, name, args, kwargs,
+                                        priority)
     _eventloop.wakeup()
     return dc
 
@@ -519,6 +1127,13 @@ def shutdown():
     _eventloop.quit()
     _eventloop.wakeup()
 
+def wakeup():
+    """Wake up the eventloop if it's waiting for events.
+
+    This doesn't take any locks, so it's safe to call from a signal handler.
+    """
+    _eventloop.wakeup()
+
 def connect(signal, callback):
     _eventloop.connect(signal, callback)
 
@@ -563,13 +1178,15 @@ def as_urgent(func):
                                args=args, kwargs=kwargs)
     return queuer
 
-def idle_iterate(func, name, args=None, kwargs=None):
+def idle_iterate(func, name, args=None, kwargs=None,
+                 priority=IDLE_PRIORITY_NORMAL):
     """Iterate over a generator function using add_idle for each
     iteration.
 
     This allows long running functions to be split up into distinct
     steps, after each step other idle functions will have a chance to
-    run.
+    run.  Each step runs on a separate iteration of the event loop, using
+    priority for its idle callback.
 
     For example::
 
@@ -588,9 +1205,10 @@ def idle_iterate(func, name, args=None, kwargs=None):
     if kwargs is None:
         kwargs = {}
     iterator = func(*args, **kwargs)
-    add_idle(_idle_iterate_step, name, args=(iterator, name))
+    add_idle(_idle_iterate_step, name, args=(iterator, name, priority),
+             priority=priority)
 
-def _idle_iterate_step(iterator, name):
+def _idle_iterate_step(iterator, name, priority):
     try:
         retval = iterator.next()
     except StopIteration:
@@ -600,7 +1218,7 @@ def _idle_iterate_step(iterator, name):
             logging.warn("idle_iterate yield value ignored: %s (%s)",
                          retval, name)
         _eventloop.run_idle_next_loop(_idle_iterate_step, name,
-                args=(iterator, name))
+                args=(iterator, name, priority), priority=priority)
 
 def idle_iterator(func):
     """Decorator to wrap a generator function in a ``idle_iterate()``
@@ -617,20 +1235,22 @@ class DelayedFunctionCaller(object):
     This class also tracks whether a function has been scheduled and avoids
     scheduling it twice.
     """
-    def __init__(self, func):
+    def __init__(self, func, priority=IDLE_PRIORITY_NORMAL):
         """Create a DelayedFunctionCaller
 
         :param func: function to call.
+        :param priority: priority to use for call_when_idle()
         """
         self.dc = None
         self.func = func
         self.name = 'delayed call to %s' % func
+        self.priority = priority
 
     def call_when_idle(self, *args, **kwargs):
         """Call our function when we're idle."""
         if self.dc is None:
             self.dc = add_idle(self.call_now, self.name, args=args,
-                               kwargs=kwargs)
+                               kwargs=kwargs, priority=self.priority)
 
     def call_after_timeout(self, timeout, *args, **kwargs):
         """Call our function after a timeout."""
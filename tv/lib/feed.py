@@ -48,7 +48,8 @@ from miro.xhtmltools import (unescape, xhtmlify, fix_xml_header,
                              fix_html_header)
 
 from miro.database import DDBObject, ObjectNotFoundError
-from miro.httpclient import grab_url
+from miro.httpclient import (grab_url, TRANSFER_PRIORITY_HIGH,
+                             TRANSFER_PRIORITY_NORMAL)
 from miro import app
 from miro import autodler
 from miro import iconcache
@@ -108,6 +109,101 @@ class _RateLimiter(object):
         # get ready for the next check() call
         self.last_time = time.time()
 
+class FeedItemCounts(object):
+    """Counts items in each feed.
+
+    We calculate the downloaded, downloading, unwatched and available counts
+    for every feed with a single GROUP BY query, instead of running separate
+    COUNT queries for each feed.  When items change, Feed.invalidate_counts()
+    marks the feed as dirty.  The next time a count is needed, we recalculate
+    all dirty feeds with one query.
+    """
+
+    # SUM() expressions for each count.  These match the WHERE clauses of
+    # Item.feed_downloaded_view(), feed_downloading_view(),
+    # feed_available_view(), feed_auto_pending_view() and
+    # feed_unwatched_view().
+    COUNT_EXPRESSIONS = [
+        ('downloaded', "item.is_file_item OR "
+         "rd.state IN ('finished', 'uploading', 'uploading-paused')"),
+        ('downloading', "rd.state IN ('downloading', 'uploading') AND "
+         "rd.main_item_id=item.id"),
+        ('available', "item.new"),
+        ('auto_pending', "feed.autoDownloadable AND "
+         "NOT item.was_downloaded AND "
+         "(item.eligible_for_autodownload OR feed.getEverything)"),
+        ('unwatched', "item.watched_time IS NULL AND "
+         "item.file_type IN ('audio', 'video') AND "
+         "(item.is_file_item OR "
+         "rd.state IN ('finished', 'uploading', 'uploading-paused'))"),
+    ]
+    COUNT_NAMES = [name for name, expression in COUNT_EXPRESSIONS]
+    EMPTY_COUNTS = dict((name, 0) for name in COUNT_NAMES)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.db = None
+        # maps feed ids to dicts of counts.  None means we haven't run the
+        # query for all feeds yet.
+        self.counts = None
+        self.dirty_feed_ids = set()
+
+    def invalidate(self, feed_id):
+        self.dirty_feed_ids.add(feed_id)
+
+    def forget(self, feed_id):
+        self.dirty_feed_ids.discard(feed_id)
+        if self.counts is not None:
+            self.counts.pop(feed_id, None)
+
+    def get_counts(self, feed_id):
+        """Get the counts for a feed.
+
+        :returns: dict mapping count names to values
+        """
+        if self.db is not app.db:
+            self.reset()
+            self.db = app.db
+        if self.counts is None:
+            self.counts = self._calc_counts(None)
+            self.dirty_feed_ids = set()
+        elif self.dirty_feed_ids:
+            dirty_feed_ids = self.dirty_feed_ids
+            self.dirty_feed_ids = set()
+            for dirty_id in dirty_feed_ids:
+                self.counts.pop(dirty_id, None)
+            self.counts.update(self._calc_counts(dirty_feed_ids))
+        return self.counts.get(feed_id, self.EMPTY_COUNTS)
+
+    def _calc_counts(self, feed_ids):
+        """Run the GROUP BY query.
+
+        :param feed_ids: feeds to calculate, or None to calculate all feeds
+        :returns: dict mapping feed ids to count dicts
+        """
+        sql = StringIO()
+        sql.write("SELECT item.feed_id")
+        for name, expression in self.COUNT_EXPRESSIONS:
+            sql.write(", SUM(CASE WHEN %s THEN 1 ELSE 0 END)" % expression)
+        sql.write("\nFROM item\n"
+                  "LEFT JOIN remote_downloader AS rd "
+                  "ON item.downloader_id=rd.id\n"
+                  "LEFT JOIN feed ON item.feed_id=feed.id\n")
+        if feed_ids is None:
+            sql.write("WHERE item.feed_id IS NOT NULL\n")
+        else:
+            sql.write("WHERE item.feed_id IN (%s)\n" %
+                      ', '.join(str(feed_id) for feed_id in feed_ids))
+        sql.write("GROUP BY item.feed_id")
+        counts = {}
+        for row in app.db.execute(sql.getvalue()):
+            counts[row[0]] = dict(zip(self.COUNT_NAMES, row[1:]))
+        return counts
+
+item_counts = FeedItemCounts()
+
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -146,7 +242,7 @@ def add_feed_from_web_page(url):
             Feed(url)
     def errback(error):
         logging.warning("unhandled error in add_feed_from_web_page: %s", error)
-    grab_url(url, callback, errback)
+    grab_url(url, callback, errback, priority=TRANSFER_PRIORITY_HIGH)
 
 FILE_MATCH_RE = re.compile(r"^file://.")
 SEARCH_URL_MATCH_RE = re.compile('^dtv:savedsearch/(.*)\?q=(.*)')
@@ -227,7 +323,7 @@ def _on_config_change(obj, key, value):
 def run_feedparser(html, callback, errback):
     if _RUN_FEED_PARSER_INLINE:
         try:
-            rv = feedparserutil.parse(html)
+            rv = feedparserutil.strip_entries(feedparserutil.parse(html))
         except StandardError, e:
             errback(e)
         else:
@@ -237,6 +333,60 @@ def run_feedparser(html, callback, errback):
                            lambda msg, result: callback(result),
                            lambda msg, error: errback(error))
 
+def run_feedparser_on_file(path, charset, callback, errback):
+    """Parse a feed from a file.
+
+    The worker process reads the file, so we don't have to send the data
+    through the pipe.  The file is deleted once the parse is done.
+
+    :param path: path to the feed data
+    :param charset: charset from the HTTP headers, or None
+    """
+    if _RUN_FEED_PARSER_INLINE:
+        try:
+            html = open(path, 'rb').read()
+            if charset is not None:
+                html = fix_xml_header(html, charset)
+        except IOError, e:
+            _remove_feed_body_file(path)
+            errback(e)
+            return
+        _remove_feed_body_file(path)
+        run_feedparser(html, callback, errback)
+    else:
+        def task_callback(msg, result):
+            _remove_feed_body_file(path)
+            callback(result)
+        def task_errback(msg, error):
+            _remove_feed_body_file(path)
+            errback(error)
+        msg = workerprocess.FeedparserTask(path=path, charset=charset)
+        workerprocess.send(msg, task_callback, task_errback)
+
+def _remove_feed_body_file(path):
+    try:
+        fileutil.remove(path)
+    except OSError:
+        logging.warn("Error removing feed body file: %s", path)
+
+def _feed_body_from_info(info):
+    """Get the feed data from the info dict of a grab_url() callback.
+
+    :returns: (html, path) tuple.  One of them will be None, depending on
+        if the body was spooled to disk.
+    """
+    if 'body-path' in info:
+        return None, info['body-path']
+    html = info['body']
+    if info.has_key('charset'):
+        html = fix_xml_header(html, info['charset'])
+    return html, None
+
+def _discard_feed_body(info):
+    """Remove the spooled body for a grab_url() callback we won't use."""
+    if 'body-path' in info:
+        _remove_feed_body_file(info['body-path'])
+
 # Wait X seconds before updating the feeds at startup
 INITIAL_FEED_UPDATE_DELAY = 5.0
 
@@ -450,6 +600,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.inlineSearchTerm = None
         self.type = u'feed'
         self.calc_item_list()
+        self.invalidate_counts()
 
     def _get_actual_feed(self):
         # first try to load from actualFeed from the DB
@@ -561,10 +712,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             return self.actualFeed.clean_old_items()
 
     def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
+        item_counts.invalidate(self.id)
 
     def recalc_counts(self):
         self.invalidate_counts()
@@ -575,49 +723,30 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return item_counts.get_counts(self.id)['downloaded']
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return item_counts.get_counts(self.id)['downloading']
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return item_counts.get_counts(self.id)['unwatched']
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        counts = item_counts.get_counts(self.id)
+        return counts['available'] - counts['auto_pending']
 
     def mark_as_viewed(self):
         """Sets the last time the feed was viewed to now
         """
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         for item in list(self.available_items):
             item.unset_new()
+        self.invalidate_counts()
         if self.in_folder():
             self.get_folder().signal_change()
         self.signal_change()
@@ -867,7 +996,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.download = grab_url(self.orig_url,
                     lambda info: self._generate_feed_callback(info, removeOnError),
                     lambda error: self._generate_feed_errback(error, removeOnError),
-                    default_mime_type=u'application/rss+xml')
+                    default_mime_type=u'application/rss+xml',
+                    priority=TRANSFER_PRIORITY_HIGH)
             logging.debug("added async callback to create feed %s",
                           self.orig_url)
         if newFeed:
@@ -1156,6 +1286,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
         DDBObject.remove(self)
+        item_counts.forget(self.id)
         self.actualFeed.remove()
         if self.in_folder():
             self.get_folder().signal_change()
@@ -1458,6 +1589,11 @@ class RSSFeedImpl(RSSFeedImplBase):
         run_feedparser(html, self.feedparser_callback,
                 self.feedparser_errback)
 
+    def call_feedparser_on_file(self, path, charset):
+        self.ufeed.confirm_db_thread()
+        run_feedparser_on_file(path, charset, self.feedparser_callback,
+                self.feedparser_errback)
+
     def update(self):
         """Updates a feed
         """
@@ -1485,7 +1621,8 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.debug("updating %s", self.url)
             self.download = grab_url(self.url, self._update_callback,
                     self._update_errback, etag=etag, modified=modified,
-                                    default_mime_type=u'application/rss+xml')
+                    default_mime_type=u'application/rss+xml',
+                    priority=TRANSFER_PRIORITY_NORMAL, spool_body=True)
 
     def _update_errback(self, error):
         if not self.ufeed.id_exists():
@@ -1498,17 +1635,17 @@ class RSSFeedImpl(RSSFeedImplBase):
 
     def _update_callback(self, info):
         if not self.ufeed.id_exists():
+            _discard_feed_body(info)
             return
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            _discard_feed_body(info)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
+        html, path = _feed_body_from_info(info)
 
         # FIXME HTML can be non-unicode here --NN
         self.url = unicodify(info['updated-url'])
@@ -1520,7 +1657,10 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
-        self.call_feedparser(html)
+        if path is not None:
+            self.call_feedparser_on_file(path, info.get('charset'))
+        else:
+            self.call_feedparser(html)
 
     @returns_unicode
     def get_license(self):
@@ -1622,6 +1762,12 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             lambda parsed, url=url: self.feedparser_callback(parsed, url),
             lambda e, url=url: self.feedparser_errback(e, url))
 
+    def call_feedparser_on_file(self, path, charset, url):
+        self.ufeed.confirm_db_thread()
+        run_feedparser_on_file(path, charset,
+            lambda parsed, url=url: self.feedparser_callback(parsed, url),
+            lambda e, url=url: self.feedparser_errback(e, url))
+
     def update(self):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists():
@@ -1637,7 +1783,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
                 lambda x, url=url: self._update_callback(x, url),
                 lambda x, url=url: self._update_errback(x, url),
                 etag=etag, modified=modified,
-                default_mime_type=u'application/rss+xml',)
+                default_mime_type=u'application/rss+xml',
+                priority=TRANSFER_PRIORITY_NORMAL, spool_body=True)
             self.updating += 1
         self.ufeed.signal_change(needs_save=False)
 
@@ -1653,18 +1800,18 @@ class RSSMultiFeedBase(RSSFeedImplBase):
 
     def _update_callback(self, info, url):
         if not self.ufeed.id_exists():
+            _discard_feed_body(info)
             return
         if info.get('status') == 304:
             logging.debug("RSSMultiFeedBase: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            _discard_feed_body(info)
             self.schedule_update_events(-1)
             self.updating -= 1
             self.check_update_finished()
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
+        html, path = _feed_body_from_info(info)
 
         # FIXME HTML can be non-unicode here --NN
         if info.get('updated-url') and url in self.urls:
@@ -1679,7 +1826,10 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             self.modified[url] = unicodify(info['last-modified'])
         else:
             self.modified[url] = None
-        self.call_feedparser(html, url)
+        if path is not None:
+            self.call_feedparser_on_file(path, info.get('charset'), url)
+        else:
+            self.call_feedparser(html, url)
 
     def on_remove(self):
         self._cancel_all_downloads()
@@ -1782,7 +1932,8 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
                             error)
             self.check_done()
         download = grab_url(url, callback, errback, etag=etag,
-                modified=modified, default_mime_type='text/html')
+                modified=modified, default_mime_type='text/html',
+                priority=TRANSFER_PRIORITY_NORMAL)
         self.downloads.add(download)
 
     def process_downloaded_html(self, info, urlList, depth, link_number,
@@ -30,6 +30,7 @@
 """feedparserutil.py -- Utility functions to handle feedparser.
 """
 
+import copy_reg
 from datetime import datetime
 from time import struct_time
 from types import NoneType
@@ -127,3 +128,49 @@ def convert_datetime(elem):
     return elem
 
 FeedParserDict = feedparser.FeedParserDict
+
+def _reduce_feedparser_dict(fp_dict):
+    """Pickle FeedParserDicts as their underlying dict.
+
+    With binary pickle protocols, the default is to rebuild the dict by
+    calling FeedParserDict.__setitem__() for every key, which is slow, since
+    it checks the key against keymap.  The keys we store are already
+    remapped, so we can use the base dict methods to save and restore them.
+    This matters for the results of the worker process's FeedparserTask.
+    """
+    return (_rebuild_feedparser_dict, (dict.copy(fp_dict),))
+
+def _rebuild_feedparser_dict(items):
+    fp_dict = FeedParserDict()
+    dict.update(fp_dict, items)
+    return fp_dict
+
+copy_reg.pickle(FeedParserDict, _reduce_feedparser_dict)
+
+# Keys from feedparser entries that the backend uses.  These are the raw
+# keys, not the aliases from FeedParserDict.keymap (for example "summary"
+# and "subtitle" rather than "description").  See item.FeedParserValues and
+# feed.FeedImpl._create_items_for_parsed().
+BACKEND_ENTRY_KEYS = ('id', 'title', 'link', 'summary', 'subtitle',
+                      'comments', 'license', 'payment_url', 'enclosures',
+                      'thumbnail', 'updated_parsed', 'published_parsed')
+
+def strip_entries(parsed):
+    """Remove the entry values that the backend doesn't use.
+
+    Entries can have large values that we never look at, like the content
+    list and the *_detail dicts.  Removing them makes the result of parse()
+    much smaller to send from the worker process and to keep around.
+    """
+    # Use the base class methods, since FeedParserDict remaps keys
+    base_class = feedparser.UserDict
+    stripped_entries = []
+    for entry in parsed['entries']:
+        stripped = FeedParserDict()
+        for key in BACKEND_ENTRY_KEYS:
+            if base_class.has_key(entry, key):
+                base_class.__setitem__(stripped, key,
+                                       base_class.__getitem__(entry, key))
+        stripped_entries.append(stripped)
+    parsed['entries'] = stripped_entries
+    return parsed
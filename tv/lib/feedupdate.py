@@ -31,14 +31,19 @@
 
 Our basic strategy is to limit the number of feeds that are
 simultaniously updating at any given time.  Right now the limit is set
-to 3.
+to 12.
+
+The HTTP requests for the updates go through httpclient's TransferScheduler,
+which limits the number of requests per host.  MAX_UPDATES is larger than
+that limit, so that feeds on other hosts can update while a slow host has
+its requests queued.
 """
 
 import collections
 
 from miro import eventloop
 
-MAX_UPDATES = 3
+MAX_UPDATES = 12
 
 class FeedUpdateQueue(object):
     def __init__(self):
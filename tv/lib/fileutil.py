@@ -241,11 +241,11 @@ def delete(path, retry_after=10, retry_for=60, firsttime=True):
                     "Delete File Retry", args=(path, retry_after,
                         retry_for - retry_after, False))
             if firsttime:
-                from miro.workerprocess import _subprocess_manager
-                if _subprocess_manager.is_running:
-                    logging.debug('restarting subprocess_manager to hopefully '
+                from miro.workerprocess import _worker_pool
+                if _worker_pool.is_running:
+                    logging.debug('restarting worker processes to hopefully '
                                   'free file references')
-                    _subprocess_manager.restart(clean=True)
+                    _worker_pool.restart(clean=True)
 
     else:
         deletes_in_progress.discard(path)
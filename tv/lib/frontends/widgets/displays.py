@@ -371,7 +371,7 @@ class RecentlyActiveTracker(object):
         query.set_order_by(['-downloaded_time'])
         query.set_limit(self.ITEM_LIMIT)
         return itemtrack.ItemTracker(call_on_ui_thread, query,
-                                     item.ItemSource())
+                                     item.ItemSource(profile='list'))
 
     def _recently_played_tracker(self, file_type):
         query = itemtrack.ItemTrackerQuery()
@@ -380,7 +380,7 @@ class RecentlyActiveTracker(object):
         query.set_order_by(['-last_watched'])
         query.set_limit(self.ITEM_LIMIT)
         return itemtrack.ItemTracker(call_on_ui_thread, query,
-                                     item.ItemSource())
+                                     item.ItemSource(profile='list'))
 
     def on_list_changed(self, set_recent_method, tracker):
         set_recent_method(tracker.get_items())
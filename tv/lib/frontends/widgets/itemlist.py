@@ -227,15 +227,17 @@ class ItemList(itemtrack.ItemTracker):
         query.add_complex_condition(columns, sql)
 
     def _make_item_source(self):
+        # Use the standard profile, which leaves out the columns that we
+        # only need for the selected item.
         if self.is_for_device():
             device_info = app.tabs['connect'].get_tab(self.device_id())
-            return item.DeviceItemSource(device_info)
+            return item.DeviceItemSource(device_info, profile='standard')
         elif self.is_for_share():
             share_info = app.tabs['connect'].get_tab('sharing-%s' %
                                                      self.share_id())
-            return item.SharingItemSource(share_info)
+            return item.SharingItemSource(share_info, profile='standard')
         else:
-            return item.ItemSource()
+            return item.ItemSource(profile='standard')
 
     def _make_query(self):
         query = self.base_query.copy()
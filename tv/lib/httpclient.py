@@ -35,11 +35,14 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import collections
 import logging
 import os
 import stat
+import tempfile
 import threading
 import urllib
+import zlib
 import Queue
 from cStringIO import StringIO
 
@@ -54,19 +57,35 @@ from miro import net
 from miro import prefs
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
 from miro.plat import utils
 from miro.plat.resources import get_osname
 from miro.net import NetworkError, ConnectionError, ConnectionTimeout
 
-try:
-    import gzip
-except:
-    gzip = None
-
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# Max number of idle libcurl easy handles LibCURLManager keeps for reuse
+HANDLE_POOL_SIZE = 8
+# Limits for transfers that go through the TransferScheduler
+MAX_SCHEDULED_TRANSFERS = 8
+MAX_TRANSFERS_PER_HOST = 2
+
+# Priorities for scheduled transfers.  Lower values run first.
+TRANSFER_PRIORITY_HIGH = 0
+TRANSFER_PRIORITY_NORMAL = 1
+TRANSFER_PRIORITY_LOW = 2
+TRANSFER_PRIORITIES = (TRANSFER_PRIORITY_HIGH, TRANSFER_PRIORITY_NORMAL,
+                       TRANSFER_PRIORITY_LOW)
+
+# Rate limited transfers can save up this many seconds worth of their
+# bandwidth to use in a burst.
+BANDWIDTH_BURST_TIME = 0.5
+# How often we hand out bandwidth to paused transfers, in seconds.
+BANDWIDTH_TICK = 0.05
+# Pausing transfers needs libcurl 7.18.0 or later
+CAN_PAUSE_TRANSFERS = hasattr(pycurl, 'WRITEFUNC_PAUSE')
 
 _logged_noproxy_error = False
 
@@ -209,8 +228,14 @@ class TransferOptions(object):
 
     def __init__(self, url, etag=None, modified=None, resume=False,
             post_vars=None, post_files=None, write_file=None,
-                 extra_headers=None):
+                 extra_headers=None, priority=None, spool_body=False,
+                 byte_range=None, bandwidth_weight=None,
+                 bandwidth_group=None):
         self.url = url
+        # priority is one of the TRANSFER_PRIORITY_* constants, or None to
+        # start the transfer right away, without going through the
+        # TransferScheduler
+        self.priority = priority
         self.etag = etag
         self.modified = modified
         self.extra_headers = extra_headers
@@ -218,7 +243,24 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        # (start, end) tuple to request only part of the resource.  The
+        # range is inclusive, like the HTTP Range header.  The data gets
+        # written to write_file starting at start.
+        self.byte_range = byte_range
+        # If bandwidth_weight is set, the transfer shares the download rate
+        # limit with the other weighted transfers.  Transfers with the same
+        # bandwidth_group split their weight between them.
+        self.bandwidth_weight = bandwidth_weight
+        self.bandwidth_group = bandwidth_group
+        # write the body to a temporary file rather than keeping it in
+        # memory
+        self.spool_body = spool_body
         self.requires_cookies = False
+        # Ask the server to gzip/deflate the response.  We do this for
+        # transfers that we keep in memory (feeds, guides, API calls, etc).
+        # Transfers that go to a file are mostly media files, which are
+        # already compressed.
+        self.accept_compressed = write_file is None
         self.head_request = False
         self.invalid_url = False
         # _cancel_on_body_data is an internal attribute used for grab_headers.
@@ -244,24 +286,30 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
+    def build_handle(self, out_headers, handle=None):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: pycurl.Curl object to set up.  It should be either
+            new or reset.  If None, we create a new one.
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
+        if self.accept_compressed:
+            out_headers['Accept-Encoding'] = 'gzip, deflate'
         if self.extra_headers is not None:
             out_headers.update(self.extra_headers)
 
-        handle = self._init_handle()
+        handle = self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle=None):
+        if handle is None:
+            handle = pycurl.Curl()
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -327,6 +375,56 @@ class TransferOptions(object):
             self.post_data = data
             self.post_length = len(data)
 
+class ContentDecoder(object):
+    """Decompresses a response body as we receive it.
+
+    The decompression method is picked from the content-encoding header.
+    Unknown encodings are passed through as-is.
+    """
+    def __init__(self, content_encoding, url):
+        self.url = url
+        self.encoding = (content_encoding or '').strip().lower()
+        if self.encoding in ('gzip', 'x-gzip'):
+            # 16 + MAX_WBITS makes zlib expect a gzip header
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+        self.saw_data = False
+
+    def decompress(self, data):
+        if self.decompressor is None:
+            return data
+        try:
+            rv = self.decompressor.decompress(data)
+        except zlib.error:
+            if not self.saw_data and self.encoding == 'deflate':
+                # some servers send raw deflate data without the zlib
+                # header.  Set saw_data so we only try this once.
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.saw_data = True
+                return self.decompress(data)
+            self._give_up()
+            return data
+        self.saw_data = True
+        return rv
+
+    def flush(self):
+        if self.decompressor is None:
+            return ''
+        try:
+            return self.decompressor.flush()
+        except zlib.error:
+            self._give_up()
+            return ''
+
+    def _give_up(self):
+        logging.warning("Received header with content-encoding %s, but "
+                "content is not %s encoded (%s)", self.encoding,
+                self.encoding, self.url)
+        self.decompressor = None
+
 class CurlTransfer(object):
     """A in-progress CURL download.
 
@@ -345,6 +443,7 @@ class CurlTransfer(object):
         :param errback: function to call when the transfer fails
         """
         self.options = options
+        self.spool_path = None
         self._reset_transfer_data()
         self.callback = callback
         self.header_callback = header_callback
@@ -354,11 +453,17 @@ class CurlTransfer(object):
         self.canceled = False
         self.last_url = None
 
+        self.handle_reused = False
+        if options.byte_range is not None:
+            self.range_end = options.byte_range[1]
+        else:
+            self.range_end = None
         self.stats = TransferStats()
         self._lookup_auth()
         self.lock = threading.Lock()
 
     def _reset_transfer_data(self):
+        self._remove_spool_file()
         self.headers = {}
         self.handle = None
         self.current_auth_type = None
@@ -371,6 +476,9 @@ class CurlTransfer(object):
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        self.decoder = None
+        self.decoded_bytes = 0
+        self.range_complete = False
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -393,6 +501,15 @@ class CurlTransfer(object):
         curl_manager.remove_transfer(self, remove_file)
         self.canceled = True
 
+    def set_range_end(self, end):
+        """Stop the transfer once it has written byte end of write_file.
+
+        This can be called from any thread.  The transfer finishes
+        successfully when it gets there, or right away if it's already past
+        that point.
+        """
+        self.range_end = end
+
     def handle_http_auth(self):
         url = self.options.url
         location = (_("Website"), url)
@@ -464,7 +581,8 @@ class CurlTransfer(object):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        handle, self.handle_reused = curl_manager.get_handle()
+        self.handle = self.options.build_handle(self.out_headers, handle)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -473,20 +591,24 @@ class CurlTransfer(object):
         if self.options._cancel_on_body_data:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
         elif self.options.write_file is not None:
-            if not self.saw_head_success:
+            if (not self.saw_head_success and
+                    self.options.byte_range is None):
                 # try a HEAD request first to see if the request will work.
                 # It avoids the issue of RESUME_FROM being applied to the 
                 # error response.
                 self.handle.setopt(pycurl.NOBODY, 1)
                 self.trying_head_request = True
             else:
-                self.handle.setopt(pycurl.URL, self.last_url)
+                if self.last_url is not None:
+                    self.handle.setopt(pycurl.URL, self.last_url)
                 self._open_file()
                 self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
         elif self.content_check_callback is not None:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
         else:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
+            if self.options.spool_body:
+                self._open_spool_file()
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_body)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
         if self.should_debug_request():
             logging.warn("debugging request: %s", self.options.url)
@@ -494,8 +616,76 @@ class CurlTransfer(object):
             self.handle.setopt(pycurl.DEBUGFUNCTION, self.debug_func)
 
     def _write_file(self, buf):
-        if self.check_response_code(self.status_code):
-            self._filehandle.write(buf)
+        if self.range_complete:
+            return
+        if not self.check_response_code(self.status_code):
+            if (self.options.byte_range is not None and
+                    self.status_code == 200):
+                # The server ignored our Range header and is sending the
+                # whole file.
+                self.range_complete = True
+                curl_manager.remove_transfer(self)
+                self.call_errback(ResumeFailed(self.options.host))
+            return
+        if (self.options.bandwidth_weight is not None and
+                curl_manager.bandwidth.should_pause(self, len(buf))):
+            # libcurl will give us the same data again when we unpause
+            return pycurl.WRITEFUNC_PAUSE
+        # range_end can change at any time, so only read it once
+        range_end = self.range_end
+        if range_end is not None:
+            position = self.resume_from + self.decoded_bytes
+            buf = buf[:max(range_end + 1 - position, 0)]
+        self._filehandle.write(buf)
+        self.decoded_bytes += len(buf)
+        if (range_end is not None and self._range_trimmed(range_end) and
+                self.resume_from + self.decoded_bytes > range_end):
+            # We wrote everything up to a range end from set_range_end().
+            # Don't wait for the rest of the response.
+            self.range_complete = True
+            curl_manager.remove_transfer(self)
+            curl_manager.call_after_perform(self._on_range_complete)
+
+    def _range_trimmed(self, range_end):
+        return (self.options.byte_range is None or
+                range_end < self.options.byte_range[1])
+
+    def _on_range_complete(self):
+        self.update_stats()
+        self.on_finished()
+
+    def _write_body(self, buf):
+        self.buffer.write(self._decode(buf))
+
+    def _decode(self, buf):
+        if self.decoder is None:
+            # we only get body data after the headers for the final
+            # response, so we can check content-encoding now.
+            self.decoder = ContentDecoder(self.headers.get('content-encoding'),
+                    self.options.url)
+        data = self.decoder.decompress(buf)
+        self.decoded_bytes += len(data)
+        return data
+
+    def _open_spool_file(self):
+        fd, self.spool_path = tempfile.mkstemp(prefix='miro-', suffix='.body')
+        self.buffer = os.fdopen(fd, 'wb')
+
+    def _remove_spool_file(self):
+        if self.spool_path is None:
+            return
+        self.buffer.close()
+        try:
+            fileutil.remove(self.spool_path)
+        except OSError:
+            pass
+        self.spool_path = None
+
+    def _flush_decoder(self):
+        if self.decoder is not None:
+            data = self.decoder.flush()
+            self.decoded_bytes += len(data)
+            self.buffer.write(data)
 
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
@@ -535,29 +725,40 @@ class CurlTransfer(object):
                     str(app.config.get(prefs.HTTP_PROXY_AUTHORIZATION_PASSWORD))))
 
     def _call_content_check(self, data):
-        self.buffer.write(data)
+        self.buffer.write(self._decode(data))
         rv = trap_call('content check callback', self.content_check_callback,
                 self.buffer.getvalue())
         if rv == False or isinstance(rv, Exception):
             curl_manager.remove_transfer(self)
 
     def _open_file(self):
-        if self.options.resume:
-            mode = 'ab'
+        path = self.options.write_file
+        if self.options.byte_range is not None:
+            start, end = self.options.byte_range
+            self.resume_from = start
+            self.handle.setopt(pycurl.RANGE, '%d-%d' % (start, end))
+        elif self.options.resume:
             try:
-                path = self.options.write_file
                 self.resume_from = int(os.stat(path)[stat.ST_SIZE])
             except OSError:
                 # file doesn't exist, just skip resuming
                 pass
             else:
                 self.handle.setopt(pycurl.RESUME_FROM, self.resume_from)
+        # Open the file for update and seek, rather than appending.  Other
+        # transfers may be writing to later parts of the same file, so it
+        # can be bigger than resume_from.
+        if ((self.resume_from > 0 or self.options.byte_range is not None)
+                and os.path.exists(path)):
+            mode = 'r+b'
         else:
             mode = 'wb'
         try:
-            self._filehandle = fileutil.open_file(self.options.write_file, mode)
+            self._filehandle = fileutil.open_file(path, mode)
+            if self.resume_from > 0:
+                self._filehandle.seek(self.resume_from)
         except IOError:
-            raise WriteError(self.options.write_file)
+            raise WriteError(path)
 
     def should_debug_request(self):
         # return True here to debug HTTP requests in the log file
@@ -644,6 +845,8 @@ class CurlTransfer(object):
                     args=(self._make_callback_info(),))
 
     def check_response_code(self, code):
+        if self.options.byte_range is not None:
+            return code == 206
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
@@ -676,15 +879,12 @@ class CurlTransfer(object):
         info = self._make_callback_info()
         self.last_url = self.handle.getinfo(pycurl.EFFECTIVE_URL)
         if self.options.write_file is None:
-            if gzip and info.get('content-encoding', '') == 'gzip':
-                try:
-                    self.buffer.seek(0)
-                    info['body'] = gzip.GzipFile(
-                                       fileobj=self.buffer).read()
-                except IOError, e:
-                    info['body'] = self.buffer.getvalue()
-                    logging.warning("Received header with content-encoding "
-                                    "gzip, but content is not gzip encoded")
+            self._flush_decoder()
+            # include the flushed data in the final stats
+            self.update_stats()
+            if self.spool_path is not None:
+                self.buffer.close()
+                info['body-path'] = self.spool_path
             else:
                 info['body'] = self.buffer.getvalue()
 
@@ -728,6 +928,7 @@ class CurlTransfer(object):
 
     def on_cancel(self, remove_file):
         self._cleanup_filehandle()
+        self._remove_spool_file()
         if remove_file and self.options.write_file:
             try:
                 fileutil.remove(self.options.write_file)
@@ -807,11 +1008,14 @@ class CurlTransfer(object):
 
     def call_callback(self, info):
         self._cleanup_filehandle()
+        # the callback is responsible for the spooled file now
+        self.spool_path = None
         msg = 'curl transfer callback: %s' % (self.callback,)
         eventloop.add_idle(self.callback, msg, args=(info,))
 
     def call_errback(self, error):
         self._cleanup_filehandle()
+        self._remove_spool_file()
         msg = 'curl transfer errback: %s' % (self.errback,)
         eventloop.add_idle(self.errback, msg, args=(error,))
 
@@ -834,6 +1038,14 @@ class CurlTransfer(object):
         stats.upload_rate = int(getinfo(pycurl.SPEED_UPLOAD))
         stats.status_code = self.status_code
         stats.initial_size = self.resume_from
+        stats.wire_bytes = (stats.downloaded +
+                int(getinfo(pycurl.HEADER_SIZE)))
+        stats.decoded_bytes = self.decoded_bytes
+        stats.handle_reused = self.handle_reused
+        # NUM_CONNECTS is the number of new connections libcurl made for the
+        # transfer.  0 means that it used one from the connection cache.
+        stats.connection_reused = (self.status_code is not None and
+                getinfo(pycurl.NUM_CONNECTS) == 0)
 
         return stats
 
@@ -864,6 +1076,12 @@ class TransferStats(object):
         download_rate -- download rate in bytes/second
         upload_rate -- upload rate in bytes/second
         initial_size -- bytes that we starting downloading from
+        handle_reused -- True if the transfer used a pooled libcurl handle
+        connection_reused -- True if the transfer used a cached connection
+            instead of opening a new one
+        wire_bytes -- bytes received from the server, including headers.
+            For compressed responses this is the compressed size.
+        decoded_bytes -- body bytes after decompression
     """
     def __init__(self):
         self.downloaded = self.download_total = 0
@@ -871,6 +1089,216 @@ class TransferStats(object):
         self.download_rate = self.upload_rate = 0
         self.initial_size = 0
         self.status_code = None
+        self.handle_reused = self.connection_reused = False
+        self.wire_bytes = self.decoded_bytes = 0
+
+class TransferScheduler(object):
+    """Decides when scheduled CurlTransfers get started.
+
+    Transfers are queued by priority, then by host.  We start transfers as
+    long as there are less than max_transfers running and their host has
+    less than max_per_host running.  Hosts with the same priority take turns,
+    so a slow host with lots of transfers queued doesn't hold up the others.
+
+    This class is only used inside the LibCURLManager thread.
+    """
+    def __init__(self, max_transfers=None, max_per_host=None):
+        if max_transfers is None:
+            max_transfers = MAX_SCHEDULED_TRANSFERS
+        if max_per_host is None:
+            max_per_host = MAX_TRANSFERS_PER_HOST
+        self.max_transfers = max_transfers
+        self.max_per_host = max_per_host
+        # maps priority -> deque of hosts with pending transfers.  The order
+        # of the deque is the round-robin order.
+        self.host_queues = dict((p, collections.deque())
+                                for p in TRANSFER_PRIORITIES)
+        # maps (priority, host) -> deque of pending transfers
+        self.pending = {}
+        # maps host -> number of running transfers
+        self.running_per_host = collections.defaultdict(int)
+        self.running = set()
+
+    def add(self, transfer):
+        key = (transfer.options.priority, transfer.options.host)
+        try:
+            self.pending[key].append(transfer)
+        except KeyError:
+            self.pending[key] = collections.deque([transfer])
+            self.host_queues[key[0]].append(key[1])
+
+    def remove(self, transfer):
+        """Remove a transfer that is pending or running."""
+        if transfer in self.running:
+            self.transfer_done(transfer)
+            return
+        key = (transfer.options.priority, transfer.options.host)
+        try:
+            transfers = self.pending[key]
+            transfers.remove(transfer)
+        except (KeyError, ValueError):
+            return
+        if not transfers:
+            del self.pending[key]
+            self.host_queues[key[0]].remove(key[1])
+
+    def transfer_done(self, transfer):
+        """Free up the slot that a running transfer was using.
+
+        It's safe to call this for transfers that aren't running.
+        """
+        if transfer not in self.running:
+            return
+        self.running.remove(transfer)
+        host = transfer.options.host
+        self.running_per_host[host] -= 1
+        if self.running_per_host[host] <= 0:
+            del self.running_per_host[host]
+
+    def pending_count(self):
+        return sum(len(transfers) for transfers in self.pending.values())
+
+    def next_transfers(self):
+        """Get the transfers that should be started now.
+
+        The transfers returned are considered running until transfer_done()
+        is called for them.
+        """
+        rv = []
+        for priority in TRANSFER_PRIORITIES:
+            hosts = self.host_queues[priority]
+            # go through the hosts in round-robin order until we start
+            # everything we can.  skipped counts hosts in a row that were
+            # already at their limit.
+            skipped = 0
+            while hosts and skipped < len(hosts):
+                if len(self.running) >= self.max_transfers:
+                    return rv
+                host = hosts.popleft()
+                if self.running_per_host[host] >= self.max_per_host:
+                    hosts.append(host)
+                    skipped += 1
+                    continue
+                skipped = 0
+                transfers = self.pending[(priority, host)]
+                transfer = transfers.popleft()
+                if transfers:
+                    hosts.append(host)
+                else:
+                    del self.pending[(priority, host)]
+                self.running.add(transfer)
+                self.running_per_host[host] += 1
+                rv.append(transfer)
+        return rv
+
+class BandwidthAllocator(object):
+    """Shares a download rate limit between transfers.
+
+    Each rate limited transfer has a token bucket.  Writing body data uses
+    up tokens, and a transfer that runs out is paused from its write
+    callback, which stops libcurl from reading its socket.  refill() hands
+    out rate * elapsed time tokens in proportion to the transfer weights.
+    Tokens that don't fit in a full bucket go to the other transfers, so
+    the limit still gets used when some transfers are slow.
+
+    This class is only used inside the LibCURLManager thread.
+    """
+    def __init__(self):
+        # bytes per second, or None for no limit
+        self.rate = None
+        # maps transfer -> tokens
+        self.tokens = {}
+        self.paused = set()
+        self.last_refill = None
+
+    def set_rate(self, rate):
+        """Change the rate limit.
+
+        :returns: list of transfers to unpause
+        """
+        self.rate = rate
+        if rate is not None:
+            return []
+        rv = list(self.paused)
+        self.paused = set()
+        return rv
+
+    def add(self, transfer):
+        self.tokens[transfer] = 0
+
+    def remove(self, transfer):
+        self.tokens.pop(transfer, None)
+        self.paused.discard(transfer)
+
+    def should_pause(self, transfer, size):
+        """Use tokens to write size bytes for a transfer.
+
+        We let a transfer's tokens go negative rather than splitting up
+        writes, so a transfer can go ahead as long as it has any tokens.
+
+        :returns: True if the transfer should pause instead of writing
+        """
+        if (self.rate is None or transfer not in self.tokens or
+                not CAN_PAUSE_TRANSFERS):
+            return False
+        if self.tokens[transfer] <= 0:
+            self.paused.add(transfer)
+            return True
+        self.tokens[transfer] -= size
+        return False
+
+    def calc_timeout(self):
+        """Get how long until refill() should be called, or None."""
+        if self.rate is not None and self.paused:
+            return BANDWIDTH_TICK
+        return None
+
+    def calc_weights(self):
+        group_sizes = collections.defaultdict(int)
+        for transfer in self.tokens:
+            group_sizes[transfer.options.bandwidth_group] += 1
+        weights = {}
+        for transfer in self.tokens:
+            group = transfer.options.bandwidth_group
+            weight = float(transfer.options.bandwidth_weight)
+            if group is not None:
+                weight /= group_sizes[group]
+            weights[transfer] = weight
+        return weights
+
+    def refill(self, now):
+        """Hand out tokens for the time since the last refill.
+
+        :returns: list of paused transfers that have tokens again
+        """
+        last_refill, self.last_refill = self.last_refill, now
+        if (self.rate is None or last_refill is None or not self.tokens or
+                now <= last_refill):
+            return []
+        burst = self.rate * BANDWIDTH_BURST_TIME
+        to_give = self.rate * (now - last_refill)
+        weights = self.calc_weights()
+        hungry = [t for t in self.tokens if self.tokens[t] < burst]
+        while hungry and to_give > 0:
+            total_weight = sum(weights[t] for t in hungry)
+            if total_weight <= 0:
+                break
+            left_over = 0
+            still_hungry = []
+            for transfer in hungry:
+                tokens = (self.tokens[transfer] +
+                          to_give * weights[transfer] / total_weight)
+                if tokens >= burst:
+                    left_over += tokens - burst
+                    tokens = burst
+                else:
+                    still_hungry.append(transfer)
+                self.tokens[transfer] = tokens
+            hungry = still_hungry
+            to_give = left_over
+        ready = [t for t in self.paused if self.tokens[t] > 0]
+        self.paused.difference_update(ready)
+        return ready
 
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
@@ -880,15 +1308,98 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Limits scheduled transfers with a TransferScheduler
+      - Pools libcurl handles and shares the DNS, SSL session and
+        connection caches between them, so that keep-alive connections get
+        reused across transfers
+      - Applies the download rate limit with a BandwidthAllocator
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self.share = self._make_share()
+        self.handle_pool = []
+        self.scheduler = TransferScheduler()
+        self.bandwidth = BandwidthAllocator()
+        # set from other threads, then passed to self.bandwidth
+        self.download_rate_limit = None
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
         self.after_perform_callbacks = []
+        self.handles_created = self.handles_reused = 0
+        self.connections_created = self.connections_reused = 0
+
+    def _make_share(self):
+        # all handles are used from the libcurl thread, so we don't need to
+        # setup lock callbacks
+        share = pycurl.CurlShare()
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        try:
+            # Sharing the connection cache needs libcurl 7.57
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+        except (AttributeError, pycurl.error):
+            logging.info("libcurl can't share connections between handles")
+        return share
+
+    def get_handle(self):
+        """Get a libcurl handle for a transfer.
+
+        This should only be called inside the LibCURLManager thread.
+
+        :returns: (handle, reused) tuple.  reused is True if handle came from
+            the handle pool.
+        """
+        if self.handle_pool:
+            self.handles_reused += 1
+            return self.handle_pool.pop(), True
+        handle = pycurl.Curl()
+        handle.setopt(pycurl.SHARE, self.share)
+        self.handles_created += 1
+        return handle, False
+
+    def release_handle(self, transfer, handle):
+        """Return the handle of a finished transfer to the handle pool."""
+        if transfer.handle is handle:
+            # make sure that the transfer doesn't touch the handle once
+            # another transfer is using it
+            transfer.handle = None
+        if (len(self.handle_pool) >= HANDLE_POOL_SIZE or
+                transfer.options.requires_cookies):
+            # reset() keeps the cookies in the handle, so don't let other
+            # transfers send them
+            handle.close()
+            return
+        handle.reset()
+        self.handle_pool.append(handle)
+
+    def get_stats(self):
+        """Get statistics about handle and connection reuse.
+
+        :returns: dict with handles_created, handles_reused,
+        handle_reuse_rate, connections_created, connections_reused,
+        connection_reuse_rate, handle_pool_size, scheduled_running and
+        scheduled_pending keys
+        """
+        def rate(reused, created):
+            if reused + created == 0:
+                return 0.0
+            return float(reused) / (reused + created)
+        return {
+            'handles_created': self.handles_created,
+            'handles_reused': self.handles_reused,
+            'handle_reuse_rate': rate(self.handles_reused,
+                self.handles_created),
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'connection_reuse_rate': rate(self.connections_reused,
+                self.connections_created),
+            'handle_pool_size': len(self.handle_pool),
+            'scheduled_running': len(self.scheduler.running),
+            'scheduled_pending': self.scheduler.pending_count(),
+        }
 
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
@@ -906,7 +1417,11 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        for handle in self.handle_pool:
+            handle.close()
+        self.handle_pool = []
         self.multi.close()
+        self.share.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -919,6 +1434,23 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
+    def set_download_rate_limit(self, rate):
+        self.download_rate_limit = rate
+        self.wakeup()
+
+    def update_bandwidth(self):
+        rate = self.download_rate_limit
+        if rate != self.bandwidth.rate:
+            self.unpause_transfers(self.bandwidth.set_rate(rate))
+        self.unpause_transfers(self.bandwidth.refill(clock()))
+
+    def unpause_transfers(self, transfers):
+        for transfer in transfers:
+            if transfer.handle is not None:
+                # This may call the write callback right away, which may
+                # pause the transfer again.
+                transfer.handle.pause(pycurl.PAUSE_CONT)
+
     def calc_fds(self):
         return self.multi.fdset()
 
@@ -927,12 +1459,17 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         if timeout < 0:
             # libcurl documentation says this means to wait "not too long"
             # Let's try 2 seconds
-            return 2.0
+            timeout = 2.0
         else:
-            return timeout / 1000.0
+            timeout = timeout / 1000.0
+        bandwidth_timeout = self.bandwidth.calc_timeout()
+        if bandwidth_timeout is not None:
+            timeout = min(timeout, bandwidth_timeout)
+        return timeout
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
+        self.update_bandwidth()
         while True:
             rv, num_handles = self.multi.perform()
             self.update_stats()
@@ -954,13 +1491,10 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 transfer = self.transfers_to_add.get_nowait()
             except Queue.Empty:
                 break
-            try:
-                transfer.build_handle()
-            except NetworkError, e:
-                transfer.call_errback(e)
-                continue
-            self.transfer_map[transfer.handle] = transfer
-            self.multi.add_handle(transfer.handle)
+            if transfer.options.priority is not None:
+                self.scheduler.add(transfer)
+            else:
+                self.start_transfer(transfer)
 
         while True:
             try:
@@ -968,28 +1502,68 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
+            self.scheduler.remove(transfer)
+            self.bandwidth.remove(transfer)
+            handle = transfer.handle
             try:
-                del self.transfer_map[transfer.handle]
+                del self.transfer_map[handle]
             except KeyError:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            self.multi.remove_handle(handle)
+            self.release_handle(transfer, handle)
+
+        self.start_scheduled_transfers()
+
+    def start_scheduled_transfers(self):
+        for transfer in self.scheduler.next_transfers():
+            self.start_transfer(transfer)
+
+    def start_transfer(self, transfer):
+        try:
+            transfer.build_handle()
+        except NetworkError, e:
+            self.scheduler.transfer_done(transfer)
+            transfer.call_errback(e)
+            return
+        self.transfer_map[transfer.handle] = transfer
+        if transfer.options.bandwidth_weight is not None:
+            self.bandwidth.add(transfer)
+        self.multi.add_handle(transfer.handle)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                transfer.on_finished()
             except StandardError:
                 logging.warning("Error calling on_finished()", exc_info=True)
+            else:
+                self.release_handle(transfer, handle)
         for handle, code, message in errors:
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.warning("Error calling on_error()", exc_info=True)
+            else:
+                self.release_handle(transfer, handle)
+        if finished or errors:
+            # start transfers that were waiting for a free slot
+            self.start_scheduled_transfers()
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
         self.multi.remove_handle(handle)
+        self.scheduler.transfer_done(transfer)
+        self.bandwidth.remove(transfer)
+        # get the final stats before the handle gets reused
+        transfer.update_stats()
+        stats = transfer.get_stats()
+        if stats.connection_reused:
+            self.connections_reused += 1
+        elif stats.status_code is not None:
+            self.connections_created += 1
         return transfer
 
 class HTTPClient(object):
@@ -1013,6 +1587,13 @@ class HTTPClient(object):
 
         return self.transfer.get_stats()
 
+    def set_range_end(self, end):
+        """Stop the transfer after it writes byte end of the file.
+
+        See CurlTransfer.set_range_end().
+        """
+        self.transfer.set_range_end(end)
+
 
 def sanitize_url(url):
     """Fix poorly constructed URLs.
@@ -1024,7 +1605,8 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None, extra_headers=None):
+        post_files=None, extra_headers=None, priority=None, spool_body=False,
+        byte_range=None, bandwidth_weight=None, bandwidth_group=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1046,11 +1628,32 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
     :param extra_headers: an option dictionary of extra headers to send
+    :param priority: one of the TRANSFER_PRIORITY_* constants to run the
+        transfer through the TransferScheduler, which limits how many
+        transfers run at once, both in total and per host.  If None, the
+        transfer starts right away.
+    :param spool_body: if True, write the body to a temporary file instead
+        of keeping it in memory.  The callback info will have a 'body-path'
+        key instead of 'body', and the callback is responsible for deleting
+        the file.  file:// URLs still use 'body'.
+    :param byte_range: (start, end) tuple to download part of the resource
+        with a HTTP Range request.  write_file must be given.  The data is
+        written to write_file starting at start, and the transfer fails with
+        ResumeFailed if the server ignores the range.
+    :param bandwidth_weight: if given, the transfer is subject to the
+        download rate limit from set_download_rate_limit(), and gets a share
+        of it in proportion to its weight.  Only used with write_file.
+    :param bandwidth_group: transfers with the same bandwidth_group split
+        their weight between them.  Use this for several transfers that are
+        part of one download.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
         'status': HTTP response code
-        'body': The request body (if write_file is not given)
+        'body': The request body (if write_file and spool_body are not
+            given)
+        'body-path': Path to a file with the request body (if spool_body is
+            given)
         'content-length': Length of the downloads as an int
         'total-size': Total size of the download (this is different from
             content-length because it includes the data we are resuming from)
@@ -1069,7 +1672,8 @@ def grab_url(url, callback, errback, header_callback=None,
         return _grab_file_url(url, callback, errback, default_mime_type)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file, extra_headers)
+                post_files, write_file, extra_headers, priority, spool_body,
+                byte_range, bandwidth_weight, bandwidth_group)
         transfer = CurlTransfer(options, callback, errback, header_callback,
                 content_check_callback)
         transfer.start()
@@ -1146,3 +1750,11 @@ def stop_thread():
     global curl_manager
     curl_manager.stop()
     curl_manager = None
+
+def set_download_rate_limit(rate):
+    """Limit the download rate of transfers that have a bandwidth_weight.
+
+    :param rate: limit in bytes per second, or None for no limit
+    """
+    if curl_manager is not None:
+        curl_manager.set_download_rate_limit(rate)
@@ -62,7 +62,8 @@ class IconCacheUpdater:
                    and item.url == item.dbItem.get_thumbnail_url()):
                 is_vital = False
         if self.started and self.running_count < RUNNING_MAX:
-            eventloop.add_idle(item.request_icon, "Icon Request")
+            eventloop.add_idle(item.request_icon, "Icon Request",
+                               priority=eventloop.IDLE_PRIORITY_LOW)
             self.running_count += 1
         else:
             if is_vital:
@@ -86,7 +87,8 @@ class IconCacheUpdater:
             self.running_count -= 1
             return
 
-        eventloop.add_idle(item.request_icon, "Icon Request")
+        eventloop.add_idle(item.request_icon, "Icon Request",
+                           priority=eventloop.IDLE_PRIORITY_LOW)
 
     @eventloop.as_idle
     def clear_vital(self):
@@ -300,7 +302,8 @@ class IconCache(DDBObject):
 
         # Last try, get the icon from HTTP.
         httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+                lambda error: self.error_callback(url, error),
+                priority=httpclient.TRANSFER_PRIORITY_LOW)
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
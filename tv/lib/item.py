@@ -345,6 +345,7 @@ class _ItemsForPathCountTracker(object):
         # Use a raw DB query for this one, since we want to be as fast as
         # possible
         counts = collections.defaultdict(int)
+        app.db.flush_pending_updates()
         app.db.cursor.execute("SELECT filename, COUNT(*) "
                               "FROM item "
                               "WHERE filename IS NOT NULL "
@@ -2451,7 +2452,8 @@ class DeletedFileChecker(object):
         it only schedules one callback.
         """
         if self.started and not self.check_scheduled:
-            eventloop.add_idle(self.run_checks, 'checking items deleted')
+            eventloop.add_idle(self.run_checks, 'checking items deleted',
+                               priority=eventloop.IDLE_PRIORITY_LOW)
             self.check_scheduled = True
 
     def run_checks(self):
@@ -0,0 +1,258 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.latencystats`` -- Always-on latency histograms.
+
+We record how long event loop callbacks, backend message handlers and SQL
+statements take, keyed by callback name, message class and SQL template.
+The histograms use fixed log-scale buckets, so recording a time is cheap
+and memory use doesn't grow with the number of samples.
+
+Use report() to get a text summary with counts and percentiles.  It can be
+requested with the DumpLatencyStats backend message, or by sending the
+process SIGUSR1 on platforms that have it.
+"""
+
+import bisect
+import logging
+import re
+import threading
+
+# Upper bounds for our histogram buckets in seconds.  They start at 0.1ms
+# and double each time, going up to about 52 seconds.  Anything slower goes
+# in the last bucket.
+BUCKET_BOUNDS = [0.0001 * (2 ** i) for i in xrange(20)]
+# Max number of keys we track for a category.  Keys past this get lumped
+# together, so that callbacks with generated names can't use up memory.
+MAX_KEYS_PER_CATEGORY = 500
+OTHER_KEY = '<other>'
+PERCENTILES = (50, 90, 99)
+
+class Histogram(object):
+    """Tracks the distribution of times for a single key."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, percent):
+        """Get an approximate percentile.
+
+        We return the upper bound of the bucket the percentile falls in (or
+        our max time if that's lower).
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                if index < len(BUCKET_BOUNDS):
+                    return min(BUCKET_BOUNDS[index], self.max)
+                break
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+class LatencyStats(object):
+    """Stores histograms for each category/key pair.
+
+    record() can be called from any thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+    def record(self, category, key, duration):
+        self.lock.acquire()
+        try:
+            try:
+                category_map = self.histograms[category]
+            except KeyError:
+                category_map = self.histograms[category] = {}
+            try:
+                histogram = category_map[key]
+            except KeyError:
+                if len(category_map) >= MAX_KEYS_PER_CATEGORY:
+                    key = OTHER_KEY
+                histogram = category_map.setdefault(key, Histogram())
+            histogram.add(duration)
+        finally:
+            self.lock.release()
+
+    def get_histogram(self, category, key):
+        """Get a histogram, or None if nothing has been recorded for it."""
+        return self.histograms.get(category, {}).get(key)
+
+    def report(self):
+        """Get a text report for all histograms.
+
+        Keys are sorted by total time spent, slowest first.
+        """
+        self.lock.acquire()
+        try:
+            lines = []
+            for category in sorted(self.histograms):
+                category_map = self.histograms[category]
+                lines.append('%s (%d keys)' % (category, len(category_map)))
+                lines.append('  %8s %9s %9s %s %9s  %s' % (
+                    'count', 'total', 'mean',
+                    ' '.join('%9s' % ('p%d' % p) for p in PERCENTILES),
+                    'max', 'key'))
+                by_total = sorted(category_map.items(),
+                                  key=lambda (key, h): h.total,
+                                  reverse=True)
+                for key, histogram in by_total:
+                    lines.append('  %8d %9s %9s %s %9s  %s' % (
+                        histogram.count, _format_time(histogram.total),
+                        _format_time(histogram.mean()),
+                        ' '.join(_format_time(histogram.percentile(p))
+                                 for p in PERCENTILES),
+                        _format_time(histogram.max), key))
+                lines.append('')
+            return '\n'.join(lines)
+        finally:
+            self.lock.release()
+
+def _format_time(seconds):
+    return '%8.1fms' % (seconds * 1000)
+
+_SQL_NUMBER_RE = re.compile(r"\b\d+\b")
+_SQL_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_sql_template_cache = {}
+
+def sql_template(sql):
+    """Get the key that we use for an SQL statement.
+
+    Numbers are replaced with "?" and lists of parameters are collapsed, so
+    that "WHERE id IN (1, 2, 3)" becomes "WHERE id IN (...)".
+    """
+    try:
+        return _sql_template_cache[sql]
+    except KeyError:
+        pass
+    template = _SQL_NUMBER_RE.sub('?', sql)
+    template = _SQL_LIST_RE.sub('(...)', template)
+    template = ' '.join(template.split())
+    if len(_sql_template_cache) > 1000:
+        _sql_template_cache.clear()
+    _sql_template_cache[sql] = template
+    return template
+
+_stats = LatencyStats()
+
+def record(category, key, duration):
+    """Record a time for a histogram
+
+    :param category: type of thing that we're timing, for example
+    "eventloop" or "sql"
+    :param key: what we're timing in that category
+    :param duration: time in seconds
+    """
+    _stats.record(category, key, duration)
+
+def get_histogram(category, key):
+    return _stats.get_histogram(category, key)
+
+def report():
+    """Get a text report for all histograms."""
+    return _stats.report()
+
+def reset():
+    """Forget all recorded times."""
+    _stats.reset()
+
+def dump_to_file(path):
+    """Write report() to a file."""
+    f = open(path, 'w')
+    try:
+        f.write(report())
+    finally:
+        f.close()
+    logging.info("latency stats written to %s", path)
+
+# Set by our SIGUSR1 handler to ask the eventloop to write out our stats
+_dump_requested = False
+# Where to write our stats, set by install_signal_handler()
+_dump_path = None
+
+def install_signal_handler(path):
+    """Dump our stats to path when we get SIGUSR1.
+
+    The stats are written from the eventloop thread, not the signal handler.
+    The signal can interrupt a thread that holds our lock in record(), so
+    the handler just sets a flag and wakes up the eventloop.
+
+    This is a no-op on platforms without SIGUSR1.  It must be called from
+    the main thread.
+    """
+    global _dump_path
+    import signal
+    from miro import eventloop
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    _dump_path = path
+    eventloop.connect('begin-loop', _on_begin_loop)
+    signal.signal(signal.SIGUSR1, _signal_handler)
+
+def _signal_handler(signum, frame):
+    # Don't do anything that needs a lock here.
+    global _dump_requested
+    from miro import eventloop
+    _dump_requested = True
+    eventloop.wakeup()
+
+def _on_begin_loop(eventloop_obj):
+    global _dump_requested
+    if not _dump_requested:
+        return
+    _dump_requested = False
+    try:
+        dump_to_file(_dump_path)
+    except (IOError, OSError), e:
+        logging.warn("error writing latency stats: %s", e)
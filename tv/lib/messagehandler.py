@@ -48,6 +48,7 @@ from miro import fileutil
 from miro import commandline
 from miro import item
 from miro import itemsource
+from miro import latencystats
 from miro import messages
 from miro import filetypes
 from miro import prefs
@@ -55,7 +56,6 @@ from miro import singleclick
 from miro import subscription
 from miro import tabs
 from miro import opml
-from miro.data.item import fetch_item_infos
 from miro.widgetstate import DisplayState, ViewState, GlobalState
 from miro.feed import Feed, lookup_feed
 from miro.gtcache import gettext as _
@@ -459,9 +459,19 @@ class BackendMessageHandler(messages.MessageHandler):
         search_feed.connect('update-finished', self._search_update_finished)
 
     def call_handler(self, method, message):
-        name = 'handling backend message: %s' % message
+        # use the class name so that the event loop latency stats get one
+        # key per message type
+        message_name = message.__class__.__name__
+        name = 'handling backend message: %s' % message_name
         logging.debug("handling backend %s", message)
-        eventloop.add_urgent_call(method, name, args=(message,))
+        def timed_method(message):
+            start = time.time()
+            try:
+                method(message)
+            finally:
+                latencystats.record('backend message', message_name,
+                                    time.time() - start)
+        eventloop.add_urgent_call(timed_method, name, args=(message,))
 
     def folder_class_for_type(self, typ):
         if typ == 'feed':
@@ -1520,8 +1530,7 @@ New ids: %s""", playlist_item_ids, message.item_ids)
 
     def handle_device_sync_media(self, message):
         try:
-            item_infos = fetch_item_infos(app.db.connection,
-                                          message.item_ids)
+            item_infos = app.db.fetch_item_infos(message.item_ids)
         except database.ObjectNotFoundError:
             logging.warn("HandleDeviceSyncMedia: Items not found -- %s",
                          message.item_ids)
@@ -1625,6 +1634,12 @@ New ids: %s""", playlist_item_ids, message.item_ids)
     def handle_force_device_dbsave_error(self, message):
         app.device_manager.force_db_save_error(message.device_info)
 
+    def handle_dump_latency_stats(self, message):
+        if message.path is None:
+            logging.info("latency stats:\n%s", latencystats.report())
+        else:
+            latencystats.dump_to_file(message.path)
+
     def handle_set_net_lookup_enabled(self, message):
         paths = set()
         if message.item_ids is None:
@@ -890,6 +890,14 @@ class ForceDeviceDBSaveError(BackendMessage):
     def __init__(self, device_info):
         self.device_info = device_info
 
+class DumpLatencyStats(BackendMessage):
+    """Dump the backend latency histograms.
+
+    If path is None, the report gets logged, otherwise it's written to path.
+    """
+    def __init__(self, path=None):
+        self.path = path
+
 # Frontend Messages
 class DownloaderSyncCommandComplete(FrontendMessage):
     """Tell the frontend that the pause/resume all command are complete,
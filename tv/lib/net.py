@@ -115,40 +115,65 @@ def trap_call(object, function, *args, **kwargs):
 
 class NetworkBuffer(object):
     """Responsible for storing incomming network data and doing some basic
-    parsing of it.  I think this is about as fast as we can do things in pure
-    python, someday we may want to make it C...
+    parsing of it.
+
+    Data is kept in a single bytearray.  Reads advance a start offset rather
+    than slicing off the front of the buffer, and the space in front of the
+    offset is only reclaimed once it makes up at least half of the buffer.
+    readline() remembers how far it has already searched for a newline, so a
+    long line that arrives in many small pieces is only scanned once.  This
+    keeps read(), readline() and unread() amortized O(1) per byte, no matter
+    how the data is chunked.
     """
+
+    # Don't bother compacting the buffer until at least this many bytes have
+    # been read out of it.
+    COMPACT_THRESHOLD = 4096
+
     def __init__(self):
-        self.chunks = []
+        self.data = bytearray()
+        self.start = 0
+        # position in self.data before which there are no newlines
+        self.scan_pos = 0
         self.length = 0
 
     def addData(self, data):
-        self.chunks.append(data)
+        self.data.extend(data)
         self.length += len(data)
 
-    def _mergeChunks(self):
-        self.chunks = [''.join(self.chunks)]
-
     def has_data(self):
         return self.length > 0
 
     def discard_data(self):
-        self.chunks = []
-        self.length = 0
+        self.data = bytearray()
+        self.start = self.scan_pos = self.length = 0
+
+    def _consume(self, end):
+        """Remove the data before end and return it as a string."""
+        rv = str(self.data[self.start:end])
+        self.start = end
+        self.length = len(self.data) - end
+        if self.length == 0:
+            del self.data[:]
+            self.start = self.scan_pos = 0
+        elif (self.start >= self.COMPACT_THRESHOLD and
+              self.start * 2 >= len(self.data)):
+            del self.data[:self.start]
+            self.scan_pos -= self.start
+            self.start = 0
+        if self.scan_pos < self.start:
+            self.scan_pos = self.start
+        return rv
 
     def read(self, size=None):
         """Read at most size bytes from the data that has been added to the
         buffer.  """
 
-        self._mergeChunks()
-        if size is not None:
-            rv = self.chunks[0][:size]
-            self.chunks[0] = self.chunks[0][len(rv):]
+        if size is None or size > self.length:
+            end = len(self.data)
         else:
-            rv = self.chunks[0]
-            self.chunks = []
-        self.length -= len(rv)
-        return rv
+            end = self.start + size
+        return self._consume(end)
 
     def readline(self):
         """Like a file readline, with several difference:  
@@ -157,28 +182,35 @@ class NetworkBuffer(object):
         * Both "\r\n" and "\n" act as a line ender
         """
 
-        self._mergeChunks()
-        split = self.chunks[0].split("\n", 1)
-        if len(split) == 2:
-            self.chunks[0] = split[1]
-            self.length = len(self.chunks[0])
-            if split[0].endswith("\r"):
-                return split[0][:-1]
-            else:
-                return split[0]
-        else:
+        pos = self.data.find('\n', self.scan_pos)
+        if pos < 0:
+            self.scan_pos = len(self.data)
             return None
+        line = self._consume(pos + 1)
+        if line.endswith("\r\n"):
+            return line[:-2]
+        else:
+            return line[:-1]
 
     def unread(self, data):
         """Put back read data.  This make is like the data was never read at
         all.
         """
-        self.chunks.insert(0, data)
-        self.length += len(data)
+        size = len(data)
+        if size <= self.start:
+            # data usually gets put back right after it was read, so there's
+            # room for it in front of the start offset.
+            self.start -= size
+            self.data[self.start:self.start + size] = data
+        else:
+            self.data[:self.start] = data
+            self.start = 0
+        # we don't know where the newlines in data are
+        self.scan_pos = self.start
+        self.length += size
 
     def getValue(self):
-        self._mergeChunks()
-        return self.chunks[0]
+        return str(self.data[self.start:])
 
 class _Packet(object):
     """A packet of data for the AsyncSocket class
@@ -66,6 +66,7 @@ from miro import httpauth
 from miro import httpclient
 from miro import iconcache
 from miro import item
+from miro import latencystats
 from miro import itemsource
 from miro import feed
 from miro import folder
@@ -192,6 +193,8 @@ def initialize(themeName):
                  main_process=True)
     # this is portable general
     util.setup_logging()
+    latencystats.install_signal_handler(os.path.join(
+        app.config.get(prefs.SUPPORT_DIRECTORY), 'latency-stats.txt'))
     app.controller = controller.Controller()
     config.set_theme(themeName)
 
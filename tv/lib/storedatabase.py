@@ -40,10 +40,12 @@ separate column.
 Most columns are stored using SQLite datatypes (``INTEGER``, ``REAL``,
 ``TEXT``, ``DATETIME``, etc.).  However some of our python values,
 don't have an equivalent (lists, dicts and timedelta objects).  For
-those, we store the python representation of the object.  This makes
-the column look similar to a JSON value, although not quite the same.
-The hope is that it will be human readable.  We use the type
-``pythonrepr`` to label these columns.
+those, we use the type ``pythonrepr`` to label the columns.  We store
+them as a ``BLOB`` containing a format byte followed by the marshalled
+value (see SQLiteConverter).  Older databases stored the python
+representation of the object as ``TEXT`` and read it back with eval().
+We can still read those values, and rewrite them in the new format
+when the object gets restored.
 """
 
 import glob
@@ -51,6 +53,7 @@ import shutil
 import cPickle
 import itertools
 import logging
+import marshal
 import datetime
 import traceback
 import time
@@ -73,6 +76,7 @@ from miro import eventloop
 from miro import fileutil
 from miro import messages
 from miro import schema
+from miro import latencystats
 from miro import signals
 from miro import prefs
 from miro import util
@@ -90,6 +94,11 @@ class UpgradeErrorSendCrashReport(UpgradeError):
         UpgradeError.__init__(self)
         self.report = report
 
+# Number of rows a transaction can change before we stop keeping its
+# statements around to re-run after an error.  This bounds the memory that
+# takes for very large transactions.
+TRANSACTION_REPLAY_LIMIT = 1000
+
 # Which SQLITE type should we use to store SchemaItem subclasses?
 _sqlite_type_map = {
         schema.SchemaBool: 'integer',
@@ -108,6 +117,17 @@ _sqlite_type_map = {
         schema.SchemaStringSet: 'text',
 }
 
+# Python types that compare the same way in memory as they do in SQLite for
+# each SchemaItem subclass.  ViewTracker uses these to check objects without
+# running a query.
+_comparable_types_map = {
+        schema.SchemaBool: (bool, int, long),
+        schema.SchemaInt: (int, long),
+        schema.SchemaFloat: (float, int, long),
+        schema.SchemaString: (unicode,),
+        schema.SchemaURL: (unicode,),
+}
+
 VERSION_KEY = "Democracy Version"
 
 class DatabaseObjectCache(object):
@@ -385,6 +405,12 @@ class LiveStorage(signals.SignalEmitter):
 
     - transaction-finished(success) -- We committed or rolled back a
     transaction
+
+    Transactions last until the end of the current eventloop event.  We
+    keep the statements for the current transaction so that we can re-run
+    them if the user retries after an error.  If a transaction changes more
+    than transaction_replay_limit rows, we stop keeping them, and an error
+    drops the changes made so far in the event instead.
     """
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
@@ -432,7 +458,6 @@ class LiveStorage(signals.SignalEmitter):
         self.cache = DatabaseObjectCache()
         self.raise_load_errors = False # only gets set in unittests
         self.force_directory_creation = True # False for device databases
-        self._query_times = {}
         self.path = path
         self._quitting_from_operational_error = False
         self._object_schemas = object_schemas
@@ -442,7 +467,28 @@ class LiveStorage(signals.SignalEmitter):
         self._all_schemas = []
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
+        # statements run since the last COMMIT.  We re-run them if we get an
+        # error and the user asks us to retry.
         self._statements_in_transaction = []
+        self._rows_in_transaction = 0
+        self._in_transaction = False
+        self._transaction_replayable = True
+        self.transaction_replay_limit = TRANSACTION_REPLAY_LIMIT
+        # maps (table_name, id) -> (DDBObject, set of column names) for
+        # UPDATE statements that we haven't sent yet.  See update_obj()
+        self._pending_updates = {}
+        # maps (table_name, id) -> dict mapping column names to the SQL
+        # value last written for that column.  We only track columns that
+        # aren't SchemaSimpleItems, since changed_attributes can't tell us
+        # when their values get modified in-place.  See update_obj()
+        self._saved_sql_values = {}
+        # maps schemas -> list of (index, name) for columns that aren't
+        # SchemaSimpleItems
+        self._mutable_columns = {}
+        # maps keys describing a statement -> SQL string.  Building the
+        # strings once keeps them identical, which lets sqlite3's statement
+        # cache find them.
+        self._sql_cache = {}
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -452,7 +498,11 @@ class LiveStorage(signals.SignalEmitter):
                     klass.track_attribute_changes(field_name)
             for name, schema_item in oschema.fields:
                 self._schema_column_map[oschema, name] = schema_item
-        self._converter = SQLiteConverter()
+            self._mutable_columns[oschema] = [
+                (i, name)
+                for i, (name, schema_item) in enumerate(oschema.fields)
+                if not isinstance(schema_item, schema.SchemaSimpleItem)]
+        self._converter = self.make_converter()
 
         self.open_connection(start_in_temp_mode=start_in_temp_mode)
 
@@ -869,7 +919,8 @@ class LiveStorage(signals.SignalEmitter):
         self._ids_loaded.add(key)
 
     def forget_object(self, obj):
-        key = (obj.id, obj.db_info.db.table_name(obj.__class__))
+        table_name = obj.db_info.db.table_name(obj.__class__)
+        key = (obj.id, table_name)
         try:
             del self._object_map[key]
         except KeyError:
@@ -878,15 +929,55 @@ class LiveStorage(signals.SignalEmitter):
                        (obj.id, obj))
             logging.error(details)
         self._ids_loaded.discard(key)
+        self._saved_sql_values.pop((table_name, obj.id), None)
 
     def forget_all_objects(self):
         self._object_map = {}
         self._ids_loaded = set()
+        self._saved_sql_values = {}
 
     def _insert_sql_for_schema(self, obj_schema):
-        return "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
-                ', '.join(name for name, schema_item in obj_schema.fields),
-                ', '.join('?' for i in xrange(len(obj_schema.fields))))
+        key = ('insert', obj_schema.table_name)
+        try:
+            return self._sql_cache[key]
+        except KeyError:
+            sql = "INSERT INTO %s (%s) VALUES(%s)" % (obj_schema.table_name,
+                    ', '.join(name for name, schema_item in obj_schema.fields),
+                    ', '.join('?' for i in xrange(len(obj_schema.fields))))
+            self._sql_cache[key] = sql
+            return sql
+
+    def _update_sql(self, table_name, names):
+        key = ('update', table_name, names)
+        try:
+            return self._sql_cache[key]
+        except KeyError:
+            sql = "UPDATE %s SET %s WHERE id=?" % (table_name,
+                    ', '.join('%s=?' % name for name in names))
+            self._sql_cache[key] = sql
+            return sql
+
+    def _restore_sql(self, obj_schema, id_count):
+        key = ('restore', obj_schema.table_name)
+        try:
+            sql_start = self._sql_cache[key]
+        except KeyError:
+            sql_start = "SELECT %s FROM %s WHERE id IN " % (
+                    ', '.join('%s.%s' % (obj_schema.table_name, name)
+                              for name, schema_item in obj_schema.fields),
+                    obj_schema.table_name)
+            self._sql_cache[key] = sql_start
+        return "%s(%s)" % (sql_start, ', '.join('?' for i in xrange(id_count)))
+
+    def _remember_sql_values(self, obj_schema, obj_id, values):
+        """Remember the SQL values for columns that can change in-place.
+
+        :param values: list of SQL values for each column in obj_schema
+        """
+        mutable_columns = self._mutable_columns[obj_schema]
+        if mutable_columns:
+            self._saved_sql_values[obj_schema.table_name, obj_id] = dict(
+                (name, values[i]) for i, name in mutable_columns)
 
     def _values_for_obj(self, obj_schema, obj):
         values = []
@@ -908,6 +999,7 @@ class LiveStorage(signals.SignalEmitter):
         values = self._values_for_obj(obj_schema, obj)
         sql = self._insert_sql_for_schema(obj_schema)
         self.execute(sql, values, is_update=True)
+        self._remember_sql_values(obj_schema, obj.id, values)
         obj.reset_changed_attributes()
 
     def bulk_insert(self, objects):
@@ -926,47 +1018,127 @@ class LiveStorage(signals.SignalEmitter):
             value_list.append(self._values_for_obj(obj_schema, obj))
         sql = self._insert_sql_for_schema(obj_schema)
         self.execute(sql, value_list, is_update=True, many=True)
-        for obj in objects:
+        for obj, values in itertools.izip(objects, value_list):
+            self._remember_sql_values(obj_schema, obj.id, values)
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+        """Update a DDBObject on disk.
+
+        We don't send the UPDATE statement right away.  Instead we remember
+        which columns have changed and send them with the rest of the pending
+        updates in flush_pending_updates().  This means that if an object is
+        changed many times during an event, we only write it once.
+
+        Columns that aren't SchemaSimpleItems (lists, dicts, etc) can be
+        changed in-place, so we always queue them.  flush_pending_updates()
+        skips them if their SQL value is the same as the last one we wrote.
+        """
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
-        values = []
+        columns = set()
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
-            value = getattr(obj, name)
             try:
-                schema_item.validate(value)
+                schema_item.validate(getattr(obj, name))
             except schema.ValidationError:
                 logging.warn("error validating %s for %s", name, obj)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
+            columns.add(name)
         obj.reset_changed_attributes()
-        if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
-            self.execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
+        if not columns:
+            return
+        key = (obj_schema.table_name, obj.id)
+        try:
+            pending_obj, pending_columns = self._pending_updates[key]
+        except KeyError:
+            self._pending_updates[key] = (obj, columns)
+        else:
+            pending_columns.update(columns)
+
+    def flush_pending_updates(self):
+        """Send the UPDATE statements queued up by update_obj().
+
+        Updates are grouped by the table and set of columns they change, so
+        that each group can be sent using a single executemany() call.  The
+        values are read from the objects now, so the last write wins.
+
+        This gets called before we commit the transaction and before any
+        query that might need to see the new data.
+        """
+        if not self._pending_updates:
+            return
+        pending_updates = self._pending_updates
+        self._pending_updates = {}
+
+        value_lists = {}
+        for obj, columns in pending_updates.itervalues():
+            obj_schema = self._schema_map[obj.__class__]
+            table_name = obj_schema.table_name
+            saved_values = self._saved_sql_values.get((table_name, obj.id))
+            names = []
+            values = []
+            for name, schema_item in obj_schema.fields:
+                if name not in columns:
+                    continue
+                value = self._converter.to_sql(obj_schema, name, schema_item,
+                        getattr(obj, name))
+                if not isinstance(schema_item, schema.SchemaSimpleItem):
+                    if saved_values is None:
+                        saved_values = {}
+                        self._saved_sql_values[table_name, obj.id] = \
+                                saved_values
+                    elif (name in saved_values and
+                            saved_values[name] == value):
+                        continue
+                    saved_values[name] = value
+                names.append(name)
+                values.append(value)
+            if not names:
+                continue
+            values.append(obj.id)
+            key = (table_name, tuple(names))
+            value_lists.setdefault(key, []).append(values)
+
+        for (table_name, names), value_list in value_lists.iteritems():
+            sql = self._update_sql(table_name, names)
+            self.execute(sql, value_list, is_update=True, many=True)
+            if (self.cursor.rowcount != len(value_list) and not
                     self._quitting_from_operational_error):
-                if self.cursor.rowcount == 0:
-                    raise KeyError("Updating non-existent row (id: %s)" %
-                            obj.id)
-                else:
-                    raise ValueError("Update changed multiple rows "
-                            "(id: %s, count: %s)" %
-                            (obj.id, self.cursor.rowcount))
+                self._report_bad_update(table_name, value_list,
+                                        self.cursor.rowcount)
+
+    def _report_bad_update(self, table_name, value_list, rowcount):
+        """Report UPDATE statements that didn't change exactly one row.
+
+        Since we send updates with executemany(), we only know how many rows
+        changed in total, so we look up which ids are missing.
+        """
+        ids = [values[-1] for values in value_list]
+        existing_ids = set()
+        for ids_chunk in util.split_values_for_sqlite(ids):
+            commas = ','.join('?' for x in xrange(len(ids_chunk)))
+            sql = "SELECT id FROM %s WHERE id IN (%s)" % (table_name, commas)
+            existing_ids.update(row[0] for row in self.execute(sql, ids_chunk))
+        missing_ids = [id_ for id_ in ids if id_ not in existing_ids]
+        if missing_ids:
+            details = ("Updating non-existent rows in %s (ids: %s)" %
+                       (table_name, missing_ids))
+        else:
+            details = ("Update changed multiple rows in %s (ids: %s, "
+                       "count: %s)" % (table_name, ids, rowcount))
+        app.controller.failed_soft("flushing pending updates", details)
+
+    def _forget_pending_update(self, obj_schema, obj):
+        self._pending_updates.pop((obj_schema.table_name, obj.id), None)
 
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
 
         schema = self._schema_map[obj.__class__]
+        self._forget_pending_update(schema, obj)
         sql = "DELETE FROM %s WHERE id=?" % (schema.table_name)
         self.execute(sql, (obj.id,), is_update=True)
         self.forget_object(obj)
@@ -984,6 +1156,7 @@ class LiveStorage(signals.SignalEmitter):
         for obj in objects:
             if obj_schema != self._schema_map[obj.__class__]:
                 raise ValueError("Incompatible types for bulk remove")
+            self._forget_pending_update(obj_schema, obj)
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         for objects_chunk in util.split_values_for_sqlite(objects):
@@ -1022,6 +1195,7 @@ class LiveStorage(signals.SignalEmitter):
         return (id_, self.table_name(klass)) in self._object_map
 
     def fetch_item_infos(self, item_ids):
+        self.flush_pending_updates()
         return item.fetch_item_infos(self.connection, item_ids)
 
     def table_name(self, klass):
@@ -1030,6 +1204,20 @@ class LiveStorage(signals.SignalEmitter):
     def schema_fields(self, klass):
         return self._schema_map[klass].fields
 
+    def column_types(self, klass):
+        """Get the columns for klass that can be compared in memory.
+
+        :returns: dict mapping column names to python types that compare the
+            same way as SQLite would compare the column.
+        """
+        rv = {}
+        for name, schema_item in self._schema_map[klass].fields:
+            try:
+                rv[name] = _comparable_types_map[schema_item.__class__]
+            except KeyError:
+                pass
+        return rv
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
@@ -1066,6 +1254,7 @@ class LiveStorage(signals.SignalEmitter):
 
     def query_ids(self, table_name, where, values=None, order_by=None,
             joins=None, limit=None):
+        self.flush_pending_updates()
         sql = StringIO()
         sql.write("SELECT %s.id " % table_name)
         sql.write(self._get_query_bottom(table_name, where, joins,
@@ -1074,28 +1263,26 @@ class LiveStorage(signals.SignalEmitter):
         return (row[0] for row in self.cursor.fetchall())
 
     def _restore_objects(self, schema, id_set, db_info):
-        column_names = ['%s.%s' % (schema.table_name, f[0])
-                for f in schema.fields]
-
         # we can only feed sqlite so many variables at once, send it chunks of
         # 900 ids at once
         id_list = tuple(id_set)
         for id_list_chunk in util.split_values_for_sqlite(id_list):
-            sql = StringIO()
-            sql.write("SELECT %s " % (', '.join(column_names),))
-            sql.write("FROM %s WHERE id IN (%s)" % (schema.table_name, 
-                ', '.join('?' for i in xrange(len(id_list_chunk)))))
-
-            self.cursor.execute(sql.getvalue(), id_list_chunk)
+            sql = self._restore_sql(schema, len(id_list_chunk))
+            self.cursor.execute(sql, id_list_chunk)
             for row in self.cursor.fetchall():
                 self._restore_object_from_row(schema, row, db_info)
 
+    def make_converter(self):
+        """Create the SQLiteConverter that we use to store our columns."""
+        return SQLiteConverter()
+
     def _restore_object_from_row(self, schema, db_row, db_info):
         restored_data = {}
         columns_to_update = []
         values_to_update = []
         for (name, schema_item), value in \
                 itertools.izip(schema.fields, db_row):
+            db_value = value
             try:
                 value = self._converter.from_sql(schema, name, schema_item,
                         value)
@@ -1116,14 +1303,26 @@ class LiveStorage(signals.SignalEmitter):
                 columns_to_update.append(name)
                 values_to_update.append(self._converter.to_sql(schema, name,
                     schema_item, value))
+            else:
+                if self._converter.is_legacy_value(schema_item, db_value):
+                    # Stored using an old format, convert it to the current
+                    # one while we have the value handy.
+                    columns_to_update.append(name)
+                    values_to_update.append(self._converter.to_sql(schema,
+                        name, schema_item, value))
             restored_data[name] = value
         if columns_to_update:
             # We are using some values that are different than what's stored
             # in disk.  Update the database to make things match.
-            setters = ['%s=?' % c for c in columns_to_update]
-            sql = "UPDATE %s SET %s WHERE id=%s" % (schema.table_name,
-                    ', '.join(setters), restored_data['id'])
-            self.execute(sql, values_to_update)
+            sql = self._update_sql(schema.table_name,
+                    tuple(columns_to_update))
+            self.execute(sql, values_to_update + [restored_data['id']],
+                    is_update=True)
+            updated = dict(itertools.izip(columns_to_update,
+                values_to_update))
+            db_row = [updated.get(name, value) for (name, schema_item), value
+                      in itertools.izip(schema.fields, db_row)]
+        self._remember_sql_values(schema, restored_data['id'], db_row)
         klass = schema.get_ddb_class(restored_data)
         return klass(restored_data=restored_data, db_info=db_info)
 
@@ -1139,6 +1338,7 @@ class LiveStorage(signals.SignalEmitter):
         return self.execute(sql.getvalue(), values)[0][0]
 
     def delete(self, klass, where, values):
+        self.flush_pending_updates()
         schema = self._schema_map[klass]
         sql = StringIO()
         sql.write('DELETE FROM %s' % schema.table_name)
@@ -1171,16 +1371,50 @@ class LiveStorage(signals.SignalEmitter):
         self.finish_transaction(commit=success)
 
     def finish_transaction(self, commit=True):
-        if len(self._statements_in_transaction) == 0:
+        if commit:
+            self.flush_pending_updates()
+        else:
+            # The event failed, drop the changes just like the ROLLBACK
+            # below would have if we had sent them.
+            self._pending_updates = {}
+            # The ROLLBACK may undo writes recorded in _saved_sql_values.
+            # Forget them so that the next update writes those columns.
+            self._saved_sql_values = {}
+        if not self._in_transaction:
             return
         if not self._quitting_from_operational_error:
             if commit:
-                self.cursor.execute("COMMIT TRANSACTION")
+                self._commit_transaction()
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
-        self._statements_in_transaction = []
+        self._reset_transaction()
         self.emit("transaction-finished", commit)
 
+    def _commit_transaction(self):
+        """Send COMMIT for the current transaction.
+
+        If it fails, we handle the error like any other failed update: roll
+        back, then re-run the transaction and try to commit again if the user
+        wants to retry.
+        """
+        while self._in_transaction:
+            try:
+                self.cursor.execute("COMMIT TRANSACTION")
+            except sqlite3.DatabaseError, e:
+                self._log_error("COMMIT TRANSACTION", (), False, e)
+                self._current_select_statement = None
+                self._handle_operational_error(e, True)
+                if self._quitting_from_operational_error:
+                    return
+            else:
+                return
+
+    def _reset_transaction(self):
+        self._statements_in_transaction = []
+        self._rows_in_transaction = 0
+        self._in_transaction = False
+        self._transaction_replayable = True
+
     def execute(self, sql, values=None, is_update=False, many=False):
         """Execute an sql statement and return the results.
 
@@ -1196,14 +1430,29 @@ class LiveStorage(signals.SignalEmitter):
             # We want to avoid updating the database at this point.
             return
 
-        if is_update and len(self._statements_in_transaction) == 0:
+        if not is_update:
+            # make sure SELECT statements see any changes from update_obj()
+            self.flush_pending_updates()
+
+        if is_update and not self._in_transaction:
             self.cursor.execute("BEGIN TRANSACTION")
+            self._in_transaction = True
 
         if values is None:
             values = ()
 
         if is_update:
-            self._statements_in_transaction.append((sql, values, many))
+            if many:
+                self._rows_in_transaction += len(values)
+            else:
+                self._rows_in_transaction += 1
+            if self._rows_in_transaction > self.transaction_replay_limit:
+                # Too big to keep around.  We still commit everything at
+                # the end of the event, we just can't re-run it.
+                self._statements_in_transaction = []
+                self._transaction_replayable = False
+            if self._transaction_replayable:
+                self._statements_in_transaction.append((sql, values, many))
         try:
             self._time_execute(sql, values, many)
         except sqlite3.DatabaseError, e:
@@ -1231,6 +1480,7 @@ class LiveStorage(signals.SignalEmitter):
         else:
             self.cursor.execute(sql, values)
         end = time.time()
+        latencystats.record('sql', latencystats.sql_template(sql), end-start)
         self._check_time(sql, end-start)
 
     def _log_error(self, sql, values, many, e):
@@ -1243,7 +1493,14 @@ class LiveStorage(signals.SignalEmitter):
                           "many: %s\n\n", e, sql, values, many, exc_info=True)
 
     def _try_rerunning_transaction(self):
-        if self._statements_in_transaction:
+        if not self._transaction_replayable:
+            # The ROLLBACK threw away the changes for this event and we didn't
+            # keep the statements to redo them.  Start over with the next
+            # update.
+            logging.error("Transaction too large to re-run, dropping %d "
+                          "changed rows", self._rows_in_transaction)
+            self._reset_transaction()
+        if self._in_transaction:
             # We may have only been trying to execute SELECT statements.  If
             # that's true, don't start a transaction. (#12885)
             self.cursor.execute("BEGIN TRANSACTION")
@@ -1304,7 +1561,9 @@ class LiveStorage(signals.SignalEmitter):
             self._switch_to_temp_mode()
             # reset _statements_in_transaction.  The data for the old DB is
             # now lost
-            self._statements_in_transaction = []
+            self._reset_transaction()
+            self._pending_updates = {}
+            self._saved_sql_values = {}
             self.cursor = self.connection.cursor()
             self._init_database()
             return False
@@ -1313,29 +1572,12 @@ class LiveStorage(signals.SignalEmitter):
             raise
 
     def _check_time(self, sql, query_time):
+        # cumulative query times are tracked by latencystats, see
+        # _time_execute()
         SINGLE_QUERY_LIMIT = 0.5
-        CUMULATIVE_LIMIT = 1.0
         if query_time > SINGLE_QUERY_LIMIT:
             logging.timing("query slow (%0.3f seconds): %s", query_time, sql)
 
-        return # comment out to test cumulative query times
-
-        # more than half a second in the last
-        old_times = self._query_times.setdefault(sql, [])
-        now = time.time()
-        dropoff_time = now - 5
-        cumulative = query_time
-        for i in reversed(xrange(len(old_times))):
-            old_time, old_query_time = old_times[i]
-            if old_time < dropoff_time:
-                old_times = old_times[i+1:]
-                break
-            cumulative += old_query_time
-        old_times.append((now, query_time))
-        if cumulative > CUMULATIVE_LIMIT:
-            logging.timing('query cumulatively slow: %0.2f '
-                    '(%0.03f): %s', cumulative, query_time, sql)
-
     def _calc_created_new(self):
         """Decide if the database that we just opened is new."""
         self.cursor.execute("SELECT COUNT(*) FROM sqlite_master "
@@ -1469,6 +1711,11 @@ class LiveStorage(signals.SignalEmitter):
 
 class DeviceLiveStorage(LiveStorage):
     """Version of LiveStorage used for a device."""
+    def make_converter(self):
+        # Older versions of Miro need to be able to read device databases,
+        # so keep storing pythonrepr columns using repr().
+        return SQLiteConverter(binary_repr=False)
+
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection, 'device_item')
 
@@ -1500,8 +1747,117 @@ class SharingLiveStorage(LiveStorage):
                                              path_column='video_path',
                                              has_entry_description=False)
 
+# Format bytes for pythonrepr columns stored as BLOBs.  The rest of the BLOB
+# is the marshalled value.  marshal can't handle datetime and struct_time
+# objects, so values that contain them get run through
+# _encode_repr_value() first and use _REPR_FORMAT_ENCODED.  So do values
+# that contain subclasses of builtin types.  marshal doesn't raise an error
+# for those, but it can write them out wrong (unicode subclasses come back
+# as the raw bytes of their buffer).
+_REPR_FORMAT_MARSHAL = '\x01'
+_REPR_FORMAT_ENCODED = '\x02'
+
+# types that marshal stores correctly.  We check for the exact type, not
+# subclasses.
+_MARSHAL_SCALAR_TYPES = frozenset([type(None), bool, int, long, float, str,
+                                   unicode])
+
+def _can_marshal(value):
+    """Check if value only contains types that marshal stores correctly."""
+    value_type = type(value)
+    if value_type in _MARSHAL_SCALAR_TYPES:
+        return True
+    elif value_type is dict:
+        for k, v in value.iteritems():
+            if not (_can_marshal(k) and _can_marshal(v)):
+                return False
+        return True
+    elif value_type is list or value_type is tuple:
+        for v in value:
+            if not _can_marshal(v):
+                return False
+        return True
+    else:
+        return False
+
+def _encode_repr_value(value):
+    """Convert a value to something that marshal can store.
+
+    datetime objects become a frozenset holding a tuple of their fields
+    (frozensets are otherwise not valid for SchemaReprContainer).
+    struct_time objects become plain 9-tuples, which is what the old eval()
+    code returned for them.  Subclasses of builtin types become the builtin
+    type.
+    """
+    if type(value) in _MARSHAL_SCALAR_TYPES:
+        return value
+    elif isinstance(value, datetime.datetime):
+        return frozenset([(value.year, value.month, value.day, value.hour,
+            value.minute, value.second, value.microsecond)])
+    elif isinstance(value, time.struct_time):
+        return tuple(value)
+    elif isinstance(value, list):
+        return [_encode_repr_value(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(_encode_repr_value(v) for v in value)
+    elif isinstance(value, dict):
+        return dict((_encode_repr_value(k), _encode_repr_value(v))
+                for k, v in value.iteritems())
+    elif isinstance(value, unicode):
+        return unicode(value)
+    elif isinstance(value, str):
+        return str(value)
+    elif isinstance(value, int):
+        return int(value)
+    elif isinstance(value, long):
+        return long(value)
+    elif isinstance(value, float):
+        return float(value)
+    else:
+        # marshal will raise a ValueError for this
+        return value
+
+# types that _decode_repr_value() needs to look inside of
+_ENCODED_CONTAINER_TYPES = frozenset([dict, list, tuple, frozenset])
+
+def _decode_repr_value(value):
+    """Reverse _encode_repr_value().
+
+    This gets called for every restored value that contains a datetime, so
+    we avoid calling ourselves for values that can't contain one.
+    """
+    value_type = type(value)
+    if value_type is frozenset:
+        return datetime.datetime(*iter(value).next())
+    elif value_type is dict:
+        rv = {}
+        for k, v in value.iteritems():
+            if type(k) in _ENCODED_CONTAINER_TYPES:
+                k = _decode_repr_value(k)
+            if type(v) in _ENCODED_CONTAINER_TYPES:
+                v = _decode_repr_value(v)
+            rv[k] = v
+        return rv
+    elif value_type is list:
+        return [(_decode_repr_value(v)
+                 if type(v) in _ENCODED_CONTAINER_TYPES else v)
+                for v in value]
+    elif value_type is tuple:
+        return tuple([(_decode_repr_value(v)
+                       if type(v) in _ENCODED_CONTAINER_TYPES else v)
+                      for v in value])
+    else:
+        return value
+
 class SQLiteConverter(object):
-    def __init__(self):
+    """Converts python values to/from the values we store in SQLite.
+
+    :param binary_repr: store pythonrepr columns in the binary format.  If
+        this is False, we use the older repr() format.  Both formats can
+        always be read.
+    """
+    def __init__(self, binary_repr=True):
+        self.binary_repr = binary_repr
         self._to_sql_converters = {
                 schema.SchemaBinary: self._binary_to_sql,
                 schema.SchemaFilename: self._filename_to_sql,
@@ -1540,6 +1896,16 @@ class SQLiteConverter(object):
                 self._null_convert)
         return converter(value, schema_item)
 
+    def is_legacy_value(self, schema_item, value):
+        """Check if a value from the DB is stored using an old format.
+
+        This is True for pythonrepr columns stored with repr() when we are
+        writing the binary format.
+        """
+        return (self.binary_repr and isinstance(value, basestring) and
+                self._from_sql_converters.get(schema_item.__class__) ==
+                self._repr_from_sql)
+
     def get_malformed_data_handler(self, schema, name, schema_item, value):
         handler_name = 'handle_malformed_%s' % name
         if hasattr(schema, handler_name):
@@ -1581,9 +1947,26 @@ class SQLiteConverter(object):
         return filename_to_unicode(value)
 
     def _repr_to_sql(self, value, schema_item):
-        return repr(value)
+        if not self.binary_repr:
+            return repr(value)
+        if _can_marshal(value):
+            return buffer(_REPR_FORMAT_MARSHAL + marshal.dumps(value, 2))
+        else:
+            # value contains datetime or struct_time objects, or subclasses
+            # of builtin types
+            return buffer(_REPR_FORMAT_ENCODED +
+                    marshal.dumps(_encode_repr_value(value), 2))
 
     def _repr_from_sql(self, value, schema_item):
+        if isinstance(value, buffer):
+            format = value[:1]
+            if format == _REPR_FORMAT_MARSHAL:
+                return marshal.loads(buffer(value, 1))
+            elif format == _REPR_FORMAT_ENCODED:
+                return _decode_repr_value(marshal.loads(buffer(value, 1)))
+            else:
+                raise ValueError("Unknown pythonrepr format: %r" % format)
+        # Value stored by older versions using repr()
         return eval(value, __builtins__, {'datetime': datetime, 'time': _TIME_MODULE_SHADOW})
 
     def _string_set_to_sql(self, value, schema_item):
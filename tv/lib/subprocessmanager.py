@@ -45,6 +45,7 @@ import os
 import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import trapcall
 import warnings
@@ -72,11 +73,22 @@ def _on_windows():
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Each message is a frame containing a header (frame
+# type and an unsigned long length) followed by the payload.  For normal
+# frames the payload is a binary pickle of the message.  Pickles bigger than
+# LARGE_PAYLOAD_SIZE get written to a temp file and the payload is the path
+# to that file, which the reader deletes once it has loaded it.
+#
+# Several frames are often written at once.  The main process queues up
+# messages and writes them all from an idle callback.  In the subprocess,
+# a thread that finds another thread writing leaves its frame for that
+# thread to write with its own.
 #
 # The communication goes like this:
 #
+#   0) Both sides send a handshake with the message format version and
+#      pickle protocol.  If the other side's handshake doesn't match ours, we
+#      treat it as bad data and quit.
 #   1) The main process sends the StartupInfo then HandlerInfo messages.
 #   2) The subprocess and process exchange messages through stdout/stdin
 #   3) The main process sends None to stdin to indicate that it's through
@@ -261,7 +273,20 @@ class SubprocessResponder(messagetools.MessageHandler):
 class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
-SIZEOF_LONG = struct.calcsize("Q")
+# Version of the message format.  Bump this whenever the handshake or frame
+# format changes.
+PROTOCOL_VERSION = 1
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+HANDSHAKE_MAGIC = 'MIROSUBP'
+HANDSHAKE_FORMAT = "<8sBB"
+HANDSHAKE_SIZE = struct.calcsize(HANDSHAKE_FORMAT)
+FRAME_HEADER = "<BQ"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+# frame types
+FRAME_PICKLE = 0
+FRAME_FILE = 1
+# pickles bigger than this are sent through a temp file rather than the pipe
+LARGE_PAYLOAD_SIZE = 1024 * 1024
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -282,6 +307,49 @@ def _read_bytes_from_pipe(pipe, length):
         data.append(d)
     return ''.join(data)
 
+def _send_handshake(pipe):
+    """Send our handshake to the other side of the pipe.
+
+    :raises IOError: low-level error while writing to the pipe
+    """
+    pipe.write(struct.pack(HANDSHAKE_FORMAT, HANDSHAKE_MAGIC,
+                           PROTOCOL_VERSION, PICKLE_PROTOCOL))
+    pipe.flush()
+
+def _read_handshake(pipe):
+    """Read the handshake from the other side of the pipe.
+
+    :raises IOError: low-level error while reading from the pipe
+    :raises LoadError: the handshake was corrupt or doesn't match ours
+    """
+    data = _read_bytes_from_pipe(pipe, HANDSHAKE_SIZE)
+    if len(data) < HANDSHAKE_SIZE:
+        raise LoadError("EOF reached while reading handshake "
+                "(read %s bytes)" % len(data))
+    magic, version, pickle_protocol = struct.unpack(HANDSHAKE_FORMAT, data)
+    if magic != HANDSHAKE_MAGIC:
+        raise LoadError("Handshake corrupt")
+    if (version, pickle_protocol) != (PROTOCOL_VERSION, PICKLE_PROTOCOL):
+        raise LoadError("Message format mismatch (ours: %s/%s theirs: %s/%s)"
+                % (PROTOCOL_VERSION, PICKLE_PROTOCOL, version,
+                   pickle_protocol))
+
+def _read_payload_file(path):
+    """Read the pickle data for a FRAME_FILE frame, then delete the file."""
+    try:
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError, e:
+        raise LoadError("Error reading payload file: %s" % e)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 def _load_obj(pipe):
     """Load an object from one side of a pipe.
 
@@ -292,15 +360,21 @@ def _load_obj(pipe):
 
     :returns: Python object send from the other side
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
-        raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("Q", size_data)[0]
-    pickle_data = _read_bytes_from_pipe(pipe, size)
-    if len(pickle_data) < size:
-        raise LoadError("EOF reached while reading pickle data "
-                "(read %s bytes)" % len(pickle_data))
+    header = _read_bytes_from_pipe(pipe, FRAME_HEADER_SIZE)
+    if len(header) < FRAME_HEADER_SIZE:
+        raise LoadError("EOF reached while reading frame header "
+                "(read %s bytes)" % len(header))
+    frame_type, size = struct.unpack(FRAME_HEADER, header)
+    payload = _read_bytes_from_pipe(pipe, size)
+    if len(payload) < size:
+        raise LoadError("EOF reached while reading frame payload "
+                "(read %s bytes)" % len(payload))
+    if frame_type == FRAME_PICKLE:
+        pickle_data = payload
+    elif frame_type == FRAME_FILE:
+        pickle_data = _read_payload_file(payload)
+    else:
+        raise LoadError("Unknown frame type: %s" % frame_type)
     try:
         return pickle.loads(pickle_data)
     except pickle.PickleError:
@@ -312,25 +386,51 @@ def _load_obj(pipe):
         send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
 
-def _dump_obj(obj, pipe):
-    """Dump an object to the other side of the pipe.
+def _encode_obj(obj):
+    """Convert an object to a frame to send over the pipe.
 
-    :raises IOError: low-level error while writing to the pipe
     :raises pickle.PickleError: obj could not be pickled
+    :returns: frame data as a string
     """
+    pickle_data = pickle.dumps(obj, PICKLE_PROTOCOL)
+    if len(pickle_data) > LARGE_PAYLOAD_SIZE:
+        try:
+            fd, path = tempfile.mkstemp(prefix='miro-subprocess-')
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(pickle_data)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            logging.warn("Error writing payload file (%s), sending %d "
+                         "bytes through the pipe", e, len(pickle_data))
+        else:
+            return struct.pack(FRAME_HEADER, FRAME_FILE, len(path)) + path
+    return struct.pack(FRAME_HEADER, FRAME_PICKLE,
+                       len(pickle_data)) + pickle_data
+
+def _write_frames(frames, pipe):
+    """Write a list of frames from _encode_obj() to the pipe at once.
 
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("Q", len(pickle_data))
+    :raises IOError: low-level error while writing to the pipe
+    """
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
     # pushing the data into a Queue.  However, there's some chance that the
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    pipe.write(''.join(frames))
     pipe.flush()
 
+def _dump_obj(obj, pipe):
+    """Dump an object to the other side of the pipe.
+
+    :raises IOError: low-level error while writing to the pipe
+    :raises pickle.PickleError: obj could not be pickled
+    """
+    _write_frames([_encode_obj(obj)], pipe)
+
 class SubprocessManager(object):
     """Manages a running subprocess
 
@@ -368,6 +468,8 @@ class SubprocessManager(object):
         self.thread = None
         self.start_time = 0
         self.restart_delay = restart_delay
+        # frames waiting to be written by flush_messages()
+        self.outgoing_frames = []
 
     # Process management
 
@@ -382,6 +484,7 @@ class SubprocessManager(object):
         """Does the work to startup a new process/thread."""
         # create our child process.
         self.process = self._start_subprocess()
+        _send_handshake(self.process.stdin)
         # create thread to handle the subprocess's output.  It would be nice
         # to eliminate this thread, but I don't see an easy way to integrate
         # it into the eventloop, since windows doesn't have support for
@@ -509,27 +612,50 @@ class SubprocessManager(object):
         self.thread = None
         self.process = None
         self.is_running = False
+        # anything we haven't written was for the old process
+        self.outgoing_frames = []
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        Messages are queued up and written together by flush_messages(),
+        which runs in an idle callback.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            frame = _encode_obj(msg)
+        except pickle.PickleError:
+            logging.warn("Error pickling message in send_message() (%s)", msg)
+            return
+        if not self.outgoing_frames:
+            eventloop.add_idle(self.flush_messages,
+                               'flush subprocess messages')
+        self.outgoing_frames.append(frame)
+
+    def flush_messages(self):
+        """Write all messages queued by send_message() to our subprocess."""
+        if not self.outgoing_frames or self.process is None:
+            return
+        frames = self.outgoing_frames
+        self.outgoing_frames = []
+        try:
+            _write_frames(frames, self.process.stdin)
         except IOError:
-            logging.warn("Broken pipe in send_message()")
+            logging.warn("Broken pipe in flush_messages()")
             # we could try to restart our subprocess here, but if the pipe is
             # really broken, then our thread will quit soon and this will
             # cause a restart.
-        except pickle.PickleError:
-            logging.warn("Error pickling message in send_message() (%s)", msg)
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        # flush now, shutdown() waits for the process to quit without
+        # running the eventloop.
+        self.flush_messages()
         self.sent_quit = True
 
     def _send_startup_info(self):
@@ -601,6 +727,7 @@ class SubprocessResponderThread(threading.Thread):
 
     def run(self):
         try:
+            _read_handshake(self.subprocess_stdout)
             for msg in _read_from_pipe(self.subprocess_stdout):
                 self.responder.handle(msg)
         except LoadError, e:
@@ -696,6 +823,10 @@ def _subprocess_setup(stdin, stdout):
     # setup MessageHandler for messages going to the main process
     msg_handler = PipeMessageProxy(stdout)
     SubprocessResponse.install_handler(msg_handler)
+    # send our handshake first, so that the main process can tell if we don't
+    # match it, even if we fail to read its handshake.
+    _send_handshake(stdout)
+    _read_handshake(stdin)
     # load startup info
     msg = _load_obj(stdin)
     if not isinstance(msg, StartupInfo):
@@ -744,18 +875,31 @@ class PipeMessageProxy(object):
     This is used in the subprocess to send messages back to the main process
     over it's stdout pipe
 
-    It's safe for multiple threads in the subprocess to use this at once
+    It's safe for multiple threads in the subprocess to use this at once.
+    Messages are pickled outside of the lock.  If another thread is busy
+    writing, our frame waits in pending_frames and whichever thread gets the
+    lock next writes all pending frames at once.
     """
     def __init__(self, fileobj):
         self.fileobj = fileobj
         self.lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending_frames = []
 
     def handle(self, msg):
         try:
-            with self.lock:
-                _dump_obj(msg, self.fileobj)
+            frame = _encode_obj(msg)
         except pickle.PickleError:
             send_subprocess_error_for_exception()
+            return
+        with self.pending_lock:
+            self.pending_frames.append(frame)
+        with self.lock:
+            with self.pending_lock:
+                frames = self.pending_frames
+                self.pending_frames = []
+            if frames:
+                _write_frames(frames, self.fileobj)
         # NOTE: we don't handle IOError here because what can we do about
         # that?  Just let it propagate up to the top and which should cause us
         # to shutdown.
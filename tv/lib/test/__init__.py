@@ -58,6 +58,7 @@ from miro.test.schedulertest import *
 from miro.test.networktest import *
 from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
+from miro.test.dldaemontest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
 from miro.test.feedparsertest import *
@@ -90,6 +91,7 @@ from miro.test.itemrenderertest import *
 from miro.test.sharingtest import *
 from miro.test.databaseerrortest import *
 from miro.test.playbacktest import *
+from miro.test.latencystatstest import *
 
 # platform specific tests
 
@@ -1,5 +1,6 @@
 import logging
 
+from miro.test import mock
 from miro.test.framework import MiroTestCase
 from miro import app
 from miro import database
@@ -159,6 +160,102 @@ class ViewTrackerTest(DatabaseTestCase):
         self.clear_ddb_object_cache()
         tracker.check_all_objects()
 
+class InMemoryViewTrackerTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.add_callbacks = []
+        self.remove_callbacks = []
+        self.tracker = item.Item.make_view('feed_id=?',
+                                           (self.feed.id,)).make_tracker()
+        self.tracker.connect('added', self.on_add)
+        self.tracker.connect('removed', self.on_remove)
+
+    def on_add(self, tracker, obj):
+        self.add_callbacks.append(obj)
+
+    def on_remove(self, tracker, obj):
+        self.remove_callbacks.append(obj)
+
+    def test_check_without_query(self):
+        with mock.patch.object(app.db, 'query_count',
+                               wraps=app.db.query_count) as query_count:
+            self.i3.feed_id = self.feed.id
+            self.i3.signal_change()
+            self.i1.feed_id = self.feed2.id
+            self.i1.signal_change()
+            self.assertEquals(query_count.call_count, 0)
+        self.assertEquals(self.add_callbacks, [self.i3])
+        self.assertEquals(self.remove_callbacks, [self.i1])
+
+    def test_fallback_to_sql(self):
+        tracker = item.Item.make_view("feed.userTitle='booya'",
+                joins={'feed': 'feed.id=item.feed_id'}).make_tracker()
+        with mock.patch.object(app.db, 'query_count',
+                               wraps=app.db.query_count) as query_count:
+            self.i1.signal_change()
+            self.assert_(query_count.call_count > 0)
+        tracker.unlink()
+
+class WhereClauseCompilerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.compiler = database.WhereClauseCompiler('test', {
+            'num': (int, long),
+            'flag': (bool, int, long),
+            'name': (unicode,),
+        })
+
+    def check(self, where, values, correct_result, **attrs):
+        obj = mock.Mock()
+        obj.num = obj.flag = obj.name = None
+        for name, value in attrs.items():
+            setattr(obj, name, value)
+        predicate = self.compiler.compile(where, values)
+        self.assertEquals(predicate(obj), correct_result)
+
+    def check_not_supported(self, where, values=()):
+        self.assertRaises(database.WhereClauseNotSupported,
+                          self.compiler.compile, where, values)
+
+    def test_equality(self):
+        self.check('num=?', (1,), True, num=1)
+        self.check('test.num = ?', (1,), False, num=2)
+        self.check("name='foo'", (), True, name=u'foo')
+        self.check("name != 'foo'", (), False, name=u'foo')
+        self.check('num=?', (1,), None)
+
+    def test_in(self):
+        self.check("name IN ('a', 'b')", (), True, name=u'b')
+        self.check("name in (?, ?)", (u'a', u'b'), False, name=u'c')
+        self.check("name NOT IN ('a', 'it''s')", (), False, name=u"it's")
+        self.check("name IN ('a')", (), None)
+
+    def test_null(self):
+        self.check('num IS NULL', (), True)
+        self.check('num IS NOT NULL', (), True, num=0)
+
+    def test_boolean_logic(self):
+        self.check('flag AND num=?', (1,), False, flag=False, num=1)
+        self.check('NOT flag OR num=?', (1,), True, flag=True, num=1)
+        self.check('(num=? OR num=?) AND flag', (1, 2), True, flag=True,
+                   num=2)
+        # test SQL's three-valued logic
+        self.check('NOT flag', (), None)
+        self.check('flag OR num=?', (1,), True, num=1)
+        self.check('flag AND num=?', (1,), None, num=1)
+
+    def test_not_supported(self):
+        self.check_not_supported('name LIKE ?', (u'foo%',))
+        self.check_not_supported('name')
+        self.check_not_supported('other.num=?', (1,))
+        self.check_not_supported('unknown_column=?', (1,))
+        self.check_not_supported('num IN (SELECT id FROM test)')
+        self.check_not_supported('num=?', (u'1',))
+        self.check_not_supported('num=?', (None,))
+        self.check_not_supported('num=?', (1, 2))
+        self.check_not_supported('num=? AND flag=?', (1,))
+        self.check_not_supported('name="foo"')
+
 # class TestViewLimiter(database.ViewLimiter):
 #     def __init__(self, *feeds_to_include):
 #         self.feeds_to_include = feeds_to_include
@@ -0,0 +1,331 @@
+import cPickle
+import os
+import struct
+import time
+
+import libtorrent as lt
+
+from miro import app
+from miro import config
+from miro import prefs
+from miro.dl_daemon import command
+from miro.dl_daemon import daemon
+from miro.dl_daemon import download
+from miro.dl_daemon import protocol
+from miro.test import mock
+from miro.test.framework import EventLoopTest, MiroTestCase
+
+class FakeDaemonStream(object):
+    def __init__(self, closeCallback=None):
+        self.sent = []
+
+    def isOpen(self):
+        return True
+
+    def startReading(self, read_callback):
+        pass
+
+    def stopReading(self):
+        pass
+
+    def send_data(self, data, callback=None):
+        self.sent.append((data, callback))
+
+    def close_connection(self):
+        pass
+
+class TestingDaemon(daemon.Daemon):
+    stream_factory = FakeDaemonStream
+
+    def __init__(self):
+        daemon.Daemon.__init__(self)
+        self.commands = []
+        self.on_connection(None)
+
+    def process_command(self, comm):
+        self.commands.append(comm)
+
+    def handle_close(self, type_):
+        pass
+
+class DaemonFramingTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.sender = TestingDaemon()
+        self.receiver = TestingDaemon()
+
+    def sent_data(self):
+        return ''.join(data for data, callback in self.sender.stream.sent)
+
+    def test_batching(self):
+        self.sender.send(command.Command(self.sender, 1))
+        self.sender.send(command.Command(self.sender, 2))
+        self.runPendingIdles()
+        # both commands should go out in one frame
+        self.assertEquals(len(self.sender.stream.sent), 1)
+        self.receiver.handleData(self.sent_data())
+        self.assertEquals([c.args for c in self.receiver.commands],
+                [(1,), (2,)])
+        self.assertEquals(self.receiver.state, 'ready')
+
+    def test_partial_frames(self):
+        for i in range(3):
+            self.sender.send(command.Command(self.sender, i))
+            self.runPendingIdles()
+        data = self.sent_data()
+        for i in range(len(data)):
+            self.receiver.handleData(data[i])
+        self.assertEquals([c.args for c in self.receiver.commands],
+                [(0,), (1,), (2,)])
+
+    def test_callbacks(self):
+        called = []
+        self.sender.send(command.Command(self.sender),
+                lambda: called.append(1))
+        self.sender.send(command.Command(self.sender))
+        self.sender.send(command.Command(self.sender),
+                lambda: called.append(2))
+        self.runPendingIdles()
+        data, callback = self.sender.stream.sent[0]
+        callback()
+        self.assertEquals(called, [1, 2])
+
+    def test_queued_until_connected(self):
+        self.sender.change_state('initializing')
+        self.sender.send(command.Command(self.sender))
+        self.runPendingIdles()
+        self.assertEquals(self.sender.stream.sent, [])
+        self.sender.on_connection(None)
+        self.runPendingIdles()
+        self.assertEquals(len(self.sender.stream.sent), 1)
+
+    def test_version_mismatch(self):
+        body = cPickle.dumps([command.Command(self.sender)])
+        data = (struct.pack(protocol.FRAME_HEADER,
+                            protocol.PROTOCOL_VERSION + 1, len(body)) + body)
+        with self.allow_warnings():
+            self.assertRaises(daemon.DaemonError, self.receiver.handleData,
+                    data)
+        self.assertEquals(self.receiver.commands, [])
+
+class StatusDeltaTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.encoder = protocol.StatusEncoder()
+        self.decoder = protocol.StatusDecoder()
+        self.status = {
+            'dlid': 'dlid-1',
+            'url': u'http://example.com/movie.mp4',
+            'state': u'downloading',
+            'current_size': 0,
+            'total_size': 1000,
+            'rate': 0,
+            'type': 'HTTP',
+        }
+
+    def send(self, status):
+        delta = self.encoder.encode(status)
+        # simulate sending the delta over the wire
+        delta = cPickle.loads(cPickle.dumps(delta))
+        return delta, self.decoder.decode(delta)
+
+    def test_round_trip(self):
+        delta, status = self.send(self.status)
+        self.assertEquals(status, self.status)
+        self.status['current_size'] = 500
+        self.status['rate'] = 100
+        delta, status = self.send(self.status.copy())
+        self.assertEquals(status, self.status)
+        # only the changed fields should have been sent
+        self.assertEquals(delta[2], (500, 100))
+
+    def test_no_changes(self):
+        self.send(self.status.copy())
+        delta, status = self.send(self.status.copy())
+        self.assertEquals(delta, ('dlid-1', 0, (), None))
+        self.assertEquals(status, self.status)
+
+    def test_multiple_downloads(self):
+        other = self.status.copy()
+        other['dlid'] = 'dlid-2'
+        other['state'] = u'paused'
+        self.send(self.status.copy())
+        self.send(other.copy())
+        self.status['current_size'] = 100
+        delta, status = self.send(self.status.copy())
+        self.assertEquals(status, self.status)
+        delta, status = self.send(other.copy())
+        self.assertEquals(status, other)
+
+    def test_transient_fields(self):
+        self.status['metainfo'] = 'd4:infod4:name4:testee'
+        delta, status = self.send(self.status.copy())
+        self.assertEquals(status['metainfo'], self.status['metainfo'])
+        # metainfo only gets passed on for the update that had it
+        del self.status['metainfo']
+        delta, status = self.send(self.status.copy())
+        self.assert_('metainfo' not in status)
+
+    def test_extra_fields(self):
+        self.status['new_field'] = 'value'
+        delta, status = self.send(self.status.copy())
+        self.assertEquals(status, self.status)
+
+    def test_decoded_status_is_a_copy(self):
+        delta, status = self.send(self.status.copy())
+        status['state'] = u'changed'
+        delta, status = self.send(self.status.copy())
+        self.assertEquals(status['state'], u'downloading')
+
+def make_alert(class_name, **attrs):
+    # TorrentSession dispatches alerts by their class name
+    alert = type(class_name, (object,), {})()
+    alert.__dict__.update(attrs)
+    return alert
+
+class TorrentSessionAlertTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.torrent_session = download.TorrentSession()
+        self.torrent_session.session = mock.Mock()
+        self.torrent_session.use_state_updates = True
+        self.downloaders = [self.make_downloader('%040x' % i)
+                            for i in range(1, 4)]
+
+    def make_downloader(self, info_hash):
+        downloader = mock.Mock()
+        downloader.torrent.info_hash.return_value = info_hash
+        self.torrent_session.add_torrent(downloader)
+        return downloader
+
+    def send_alerts(self, *alerts):
+        self.torrent_session.session.pop_alerts.return_value = list(alerts)
+        self.torrent_session.update_torrents()
+
+    def test_state_update(self):
+        status = mock.Mock()
+        status.handle = self.downloaders[1].torrent
+        self.send_alerts(make_alert('state_update_alert', status=[status]))
+        self.assertEquals(
+            self.torrent_session.session.post_torrent_updates.call_count, 1)
+        # only the torrent that changed should get updated
+        self.downloaders[1].update_status.assert_called_once_with(status)
+        self.assertEquals(self.downloaders[0].update_status.call_count, 0)
+        self.assertEquals(self.downloaders[2].update_status.call_count, 0)
+
+    def test_polling(self):
+        # if libtorrent doesn't have state_update_alert, we poll every
+        # torrent
+        self.torrent_session.use_state_updates = False
+        self.send_alerts()
+        for downloader in self.downloaders:
+            downloader.update_status.assert_called_once_with()
+
+    def test_resume_data(self):
+        self.send_alerts(make_alert('save_resume_data_alert',
+                                    handle=self.downloaders[0].torrent,
+                                    resume_data={'foo': 'bar'}))
+        self.downloaders[0].on_resume_data.assert_called_once_with(
+            {'foo': 'bar'})
+
+    def test_finished(self):
+        self.send_alerts(make_alert('torrent_finished_alert',
+                                    handle=self.downloaders[2].torrent))
+        self.downloaders[2].update_status.assert_called_once_with()
+
+    def test_removed_torrent(self):
+        # alerts for torrents that we removed should be ignored
+        downloader = self.downloaders[0]
+        self.torrent_session.remove_torrent(downloader)
+        self.send_alerts(make_alert('torrent_finished_alert',
+                                    handle=downloader.torrent),
+                         make_alert('some_other_alert'))
+        self.assertEquals(downloader.update_status.call_count, 0)
+
+    def test_pop_alert(self):
+        # older libtorrents only have pop_alert()
+        alerts = [make_alert('torrent_finished_alert',
+                             handle=self.downloaders[0].torrent), None]
+        self.torrent_session.session = mock.Mock(
+                spec=['post_torrent_updates', 'pop_alert'])
+        self.torrent_session.session.pop_alert.side_effect = alerts
+        self.torrent_session.update_torrents()
+        self.downloaders[0].update_status.assert_called_once_with()
+
+class FakeBTDownloader(object):
+    """Stands in for BTDownloader in TorrentSession."""
+    def __init__(self, torrent):
+        self.torrent = torrent
+        self.statuses = []
+        self.finished = False
+
+    def update_status(self, status=None):
+        if status is None:
+            status = self.torrent.status()
+        self.statuses.append(status)
+        if status.state == lt.torrent_status.states.seeding:
+            self.finished = True
+
+    def on_metadata_received(self):
+        pass
+
+    def on_resume_data(self, resume_data):
+        pass
+
+    def on_resume_data_failed(self, message):
+        pass
+
+class TorrentLoopbackTest(MiroTestCase):
+    """Download a torrent from another libtorrent session over loopback,
+    without a tracker.
+    """
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.USE_UPNP, False)
+        app.config.set(prefs.USE_DHT, False)
+        app.downloader_config_watcher = config.ConfigWatcher(
+            lambda func, *args: func(*args))
+        self.torrent_session = download.TorrentSession()
+        self.torrent_session.startup()
+        self.seeder = lt.session()
+        self.seeder.listen_on(6881, 6981)
+
+    def tearDown(self):
+        self.torrent_session.shutdown()
+        self.torrent_session = self.seeder = None
+        MiroTestCase.tearDown(self)
+
+    def make_torrent(self):
+        seed_dir = self.make_temp_dir_path()
+        self.data = os.urandom(256 * 1024)
+        path = os.path.join(seed_dir, 'data.bin')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        storage = lt.file_storage()
+        lt.add_files(storage, path)
+        torrent = lt.create_torrent(storage, 16 * 1024)
+        lt.set_piece_hashes(torrent, seed_dir)
+        self.metainfo = lt.bencode(torrent.generate())
+        self.seeder.add_torrent({
+            'ti': lt.torrent_info(lt.bdecode(self.metainfo)),
+            'save_path': seed_dir,
+        })
+
+    def test_download(self):
+        self.make_torrent()
+        download_dir = self.make_temp_dir_path()
+        handle = self.torrent_session.session.add_torrent({
+            'ti': lt.torrent_info(lt.bdecode(self.metainfo)),
+            'save_path': download_dir,
+        })
+        handle.connect_peer(('127.0.0.1', self.seeder.listen_port()), 0)
+        downloader = FakeBTDownloader(handle)
+        self.torrent_session.add_torrent(downloader)
+        end_time = time.time() + 20
+        while not downloader.finished and time.time() < end_time:
+            self.torrent_session.update_torrents()
+            time.sleep(0.1)
+        self.assert_(downloader.finished)
+        self.assertNotEquals(downloader.statuses, [])
+        with open(os.path.join(download_dir, 'data.bin'), 'rb') as f:
+            self.assertEquals(f.read(), self.data)
@@ -133,6 +133,43 @@ class DownloaderTest(MiroTestCase):
         self.item.expire()
         self.assertEquals(self.feed.downloaded_items.count(), 0)
 
+    def test_dlid_lookup(self):
+        self.start_download()
+        self.assertEquals(downloader.get_downloader_by_dlid(self.dlid),
+                          self.item.downloader)
+        # lookups shouldn't need to query the database
+        mock_make_view = self.patch_for_test(
+            'miro.downloader.RemoteDownloader.make_view')
+        self.assertEquals(downloader.get_downloader_by_dlid(self.dlid),
+                          self.item.downloader)
+        self.assertEquals(mock_make_view.call_count, 0)
+
+    def test_dlid_lookup_after_remove(self):
+        self.run_download()
+        self.item.expire()
+        self.assertEquals(downloader.get_downloader_by_dlid(self.dlid), None)
+
+    def test_dlid_lookup_not_loaded(self):
+        # If the downloader isn't loaded yet, we should find it in the
+        # database, then cache it.
+        self.start_download()
+        downloader_id = self.item.downloader.id
+        self.clear_ddb_object_cache()
+        rd = downloader.get_downloader_by_dlid(self.dlid)
+        self.assertEquals(rd.id, downloader_id)
+        self.assertEquals(app.db.cache.get('downloader-dlid', self.dlid), rd)
+
+    def test_unchanged_status(self):
+        self.start_download()
+        self.update_status(0.3, 10)
+        mock_stats_changed = self.patch_for_test(
+            'miro.item.Item.download_stats_changed')
+        # nothing changed, so we shouldn't bother our items
+        self.update_status(0.3, 10)
+        self.assertEquals(mock_stats_changed.call_count, 0)
+        self.update_status(0.5, 20)
+        self.assertEquals(mock_stats_changed.call_count, 1)
+
     ## def test_resume(self):
     ##     # FIXME - implement this
     ##     pass
@@ -3,13 +3,16 @@ import sys
 import os
 import tempfile
 import shutil
+import threading
 
 from miro import prefs
 from miro import app
 from miro.test.framework import MiroTestCase
+from miro.dl_daemon import download
 from miro.dl_daemon.download import (save_fast_resume_data,
                                      load_fast_resume_data,
-                                     generate_fast_resume_filename)
+                                     generate_fast_resume_filename,
+                                     FastResumeWriter)
 
 FAKE_INFO_HASH = 'PINKPASTA'
 FAKE_RESUME_DATA = 'BEER'
@@ -50,3 +53,84 @@ class FastResumeTest(MiroTestCase):
             data = load_fast_resume_data(FAKE_INFO_HASH)
         self.assertEquals(data, None)
         os.chmod(filename, old_mode)
+
+class FastResumeWriterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.writer = FastResumeWriter()
+        self.filename = generate_fast_resume_filename(FAKE_INFO_HASH)
+
+    def test_save(self):
+        self.writer.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        # the data shouldn't get written right away, but we should still be
+        # able to load it.
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEquals(self.writer.load(FAKE_INFO_HASH), FAKE_RESUME_DATA)
+        self.writer.flush()
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA)
+
+    def test_batching(self):
+        self.writer.save(FAKE_INFO_HASH, 'old data')
+        self.writer.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.writer.save('OTHERHASH', 'other data')
+        self.writer.flush()
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA)
+        self.assertEquals(load_fast_resume_data('OTHERHASH'), 'other data')
+        self.assertEquals(self.writer.pending, {})
+
+    def test_remove(self):
+        save_fast_resume_data(FAKE_INFO_HASH, 'old data')
+        self.writer.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.writer.remove(FAKE_INFO_HASH)
+        self.writer.flush()
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEquals(self.writer.load(FAKE_INFO_HASH), None)
+
+    def test_flush_doesnt_hold_lock(self):
+        # Writing shouldn't block save() and load() from the event loop
+        real_save = download.save_fast_resume_data
+        def save_fast_resume_data_intercept(info_hash, fast_resume_data):
+            self.assert_(self.writer.lock.acquire(False))
+            self.writer.lock.release()
+            self.assertEquals(self.writer.load(info_hash), fast_resume_data)
+            real_save(info_hash, fast_resume_data)
+        save_mock = self.patch_for_test(
+            'miro.dl_daemon.download.save_fast_resume_data')
+        save_mock.side_effect = save_fast_resume_data_intercept
+        self.writer.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.writer.flush()
+        self.assertEquals(save_mock.call_count, 1)
+        self.assertEquals(load_fast_resume_data(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA)
+
+    def test_remove_while_writing(self):
+        # Calling remove() while flush() is writing shouldn't leave files
+        # behind for the removed torrents.
+        real_save = download.save_fast_resume_data
+        remove_threads = []
+        def save_fast_resume_data_intercept(info_hash, fast_resume_data):
+            if not remove_threads:
+                # remove the torrent that we're writing from another
+                # thread and the one that's waiting to be written from
+                # this one.
+                thread = threading.Thread(target=self.writer.remove,
+                                          args=(info_hash,))
+                thread.start()
+                remove_threads.append(thread)
+                for other in (FAKE_INFO_HASH, 'OTHERHASH'):
+                    if other != info_hash:
+                        self.writer.remove(other)
+            real_save(info_hash, fast_resume_data)
+        save_mock = self.patch_for_test(
+            'miro.dl_daemon.download.save_fast_resume_data')
+        save_mock.side_effect = save_fast_resume_data_intercept
+        self.writer.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.writer.save('OTHERHASH', 'other data')
+        self.writer.flush()
+        remove_threads[0].join()
+        self.assertEquals(save_mock.call_count, 1)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(
+            generate_fast_resume_filename('OTHERHASH')))
@@ -1,3 +1,4 @@
+import cPickle
 import os
 import unittest
 import pprint
@@ -68,6 +69,21 @@ class FeedParserDictTest(MiroTestCase):
         self.assertEqual(a.equal(d), False)
         self.assertEqual(d.equal(a), False)
 
+    def test_pickle(self):
+        entry = feedparserutil.FeedParserDict()
+        entry["description"] = "hello"
+        entry["enclosures"] = [feedparserutil.FeedParserDict({"url": "x"})]
+        for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+            copy = cPickle.loads(cPickle.dumps(entry, protocol))
+            self.assert_(isinstance(copy, feedparserutil.FeedParserDict))
+            self.assert_(isinstance(copy["enclosures"][0],
+                                    feedparserutil.FeedParserDict))
+            # the underlying keys should be unchanged
+            self.assertEqual(sorted(dict.keys(copy)), ["enclosures",
+                                                       "summary"])
+            self.assertEqual(copy["description"], "hello")
+            self.assertEqual(copy["enclosures"][0]["href"], "x")
+
 @dynamic_test(expected_cases=9)
 class FeedParserTest(MiroTestCase):
     def eq_output(self, str1, str2):
@@ -109,6 +125,19 @@ class FeedParserTest(MiroTestCase):
         # this should kick up a KeyError and NOT a TypeError
         self.assertRaises(KeyError, lambda: d['url'])
 
+    def test_strip_entries(self):
+        # stripping the entries shouldn't change the values we use
+        for path in os.listdir(FPTESTINPUT):
+            fn = os.path.join(FPTESTINPUT, path)
+            entries = feedparserutil.parse(fn)['entries']
+            stripped = feedparserutil.strip_entries(
+                feedparserutil.parse(fn))['entries']
+            self.assertEquals(len(entries), len(stripped))
+            for entry, stripped_entry in zip(entries, stripped):
+                self.assertEquals(FeedParserValues(entry).data,
+                                  FeedParserValues(stripped_entry).data)
+                self.assert_('content' not in stripped_entry.keys())
+
     @classmethod
     def generate_tests(cls):
         for path in os.listdir(FPTESTINPUT):
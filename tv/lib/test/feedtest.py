@@ -7,8 +7,11 @@ from miro import prefs
 from miro import dialogs
 from miro import feedparserutil
 from miro.item import Item
+from miro import feed
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
 
+from miro.test import mock
+from miro.test import testobjects
 from miro.test.framework import MiroTestCase, EventLoopTest
 
 class FakeDownloader(object):
@@ -461,5 +464,70 @@ by-nd/1.0</creativeCommons:license>
         self.save_then_restore_db()
         self.assertEquals(self.item.get_rss_id(), None)
 
+class FeedItemCountsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed1, self.items1 = testobjects.make_feed_with_items(4)
+        self.feed2, self.items2 = testobjects.make_feed_with_items(
+            3, file_items=True)
+        self.empty_feed = testobjects.make_feed()
+        self.items2[0].mark_watched()
+        app.db.finish_transaction()
+
+    def check_counts(self, feed_obj):
+        self.assertEquals(feed_obj.num_downloaded(),
+                          feed_obj.downloaded_items.count())
+        self.assertEquals(feed_obj.num_downloading(),
+                          feed_obj.downloading_items.count())
+        self.assertEquals(feed_obj.num_unwatched(),
+                          feed_obj.unwatched_items.count())
+        self.assertEquals(feed_obj.num_available(),
+                          feed_obj.available_items.count() -
+                          feed_obj.auto_pending_items.count())
+
+    def test_counts(self):
+        for feed_obj in (self.feed1, self.feed2, self.empty_feed):
+            self.check_counts(feed_obj)
+        self.assertEquals(self.feed2.num_downloaded(), 3)
+        self.assertEquals(self.feed2.num_unwatched(), 2)
+        self.assertEquals(self.empty_feed.num_downloaded(), 0)
+
+    def test_single_query(self):
+        self.feed1.num_downloaded()
+        feed.item_counts.reset()
+        execute = mock.Mock(wraps=app.db.execute)
+        app.db.execute = execute
+        for feed_obj in (self.feed1, self.feed2, self.empty_feed):
+            feed_obj.num_downloaded()
+            feed_obj.num_downloading()
+            feed_obj.num_unwatched()
+            feed_obj.num_available()
+        self.assertEquals(execute.call_count, 1)
+        # invalidating feeds should recalculate them with one more query
+        self.feed1.invalidate_counts()
+        self.feed2.invalidate_counts()
+        self.feed1.num_unwatched()
+        self.feed2.num_unwatched()
+        self.assertEquals(execute.call_count, 2)
+
+    def test_recalc_counts(self):
+        self.assertEquals(self.feed2.num_unwatched(), 2)
+        self.items2[1].mark_watched()
+        self.feed2.recalc_counts()
+        self.assertEquals(self.feed2.num_unwatched(), 1)
+        self.check_counts(self.feed2)
+
+    def test_mark_as_viewed(self):
+        self.check_counts(self.feed1)
+        self.feed1.mark_as_viewed()
+        self.assertEquals(self.feed1.num_available(), 0)
+        self.check_counts(self.feed1)
+
+    def test_remove_feed(self):
+        self.feed2.num_downloaded()
+        feed2_id = self.feed2.id
+        self.feed2.remove()
+        self.assert_(feed2_id not in feed.item_counts.counts)
+
 if __name__ == "__main__":
     unittest.main()
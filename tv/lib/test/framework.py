@@ -360,8 +360,7 @@ class MiroTestCase(unittest.TestCase):
         self.destroy_connection_pools()
         # shutdown workerprocess if we started it for some reason.
         workerprocess.shutdown()
-        workerprocess._subprocess_manager = \
-                workerprocess.WorkerSubprocessManager()
+        workerprocess._worker_pool = workerprocess.WorkerProcessPool()
         workerprocess._miro_task_queue.reset()
         self.reset_log_filter()
         signals.system.disconnect_all()
@@ -486,9 +485,9 @@ class MiroTestCase(unittest.TestCase):
     def make_temp_dir_path(self):
         return tempfile.mkdtemp(dir=self.tempdir)
 
-    def start_http_server(self):
+    def start_http_server(self, threaded=False):
         self.stop_http_server()
-        self.httpserver = testhttpserver.HTTPServer()
+        self.httpserver = testhttpserver.HTTPServer(threaded)
         self.httpserver.start()
 
     def last_http_info(self, info_name):
@@ -705,8 +704,8 @@ class EventLoopTest(MiroTestCase):
         eventloop.add_idle(function, name, args=None, kwargs=None)
 
     def hasIdles(self):
-        return not (eventloop._eventloop.idle_queue.queue.empty() and
-                    eventloop._eventloop.urgent_queue.queue.empty())
+        return (eventloop._eventloop.idle_queue.has_pending_idle() or
+                eventloop._eventloop.urgent_queue.has_pending_idle())
 
     def processThreads(self):
         eventloop._eventloop.threadpool.init_threads()
@@ -3,6 +3,7 @@ import os
 import logging
 import pycurl
 import pickle
+import time
 from cStringIO import StringIO
 
 from miro import app
@@ -14,7 +15,9 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test import testhttpserver
+from miro.test.framework import (MiroTestCase, EventLoopTest,
+                                 uses_httpclient)
 
 from miro.gtcache import gettext as _
 
@@ -106,6 +109,71 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url('test.txt.gz'))
         self.assertEquals(self.grab_url_info['body'], self.test_response_data)
 
+    @uses_httpclient
+    def test_accept_encoding(self):
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.check_header('accept-encoding', 'gzip, deflate')
+        # transfers to a file are usually media, so we don't ask for
+        # compression for them
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename)
+        self.check_header_not_present('accept-encoding')
+
+    def _test_compressed_get(self, encoding):
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        plain_stats = self.client.get_stats()
+        self.httpserver.enable_compression(encoding)
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assertEquals(self.grab_url_info['content-encoding'], encoding)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        stats = self.client.get_stats()
+        self.assertEquals(stats.decoded_bytes, len(self.test_response_data))
+        self.assertEquals(plain_stats.decoded_bytes,
+                len(self.test_response_data))
+        self.assert_(stats.wire_bytes < plain_stats.wire_bytes)
+
+    @uses_httpclient
+    def test_gzip_compressed_get(self):
+        self._test_compressed_get('gzip')
+
+    @uses_httpclient
+    def test_deflate_compressed_get(self):
+        self._test_compressed_get('deflate')
+
+    @uses_httpclient
+    def test_spool_body(self):
+        self.httpserver.enable_compression('gzip')
+        self.grab_url(self.httpserver.build_url('test.txt'), spool_body=True)
+        self.assert_('body' not in self.grab_url_info)
+        path = self.grab_url_info['body-path']
+        try:
+            self.assertEquals(open(path).read(), self.test_response_data)
+        finally:
+            os.remove(path)
+
+    @uses_httpclient
+    def test_spool_body_error(self):
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'),
+                spool_body=True)
+        self.check_errback_called()
+        # the temp file should be removed if the transfer fails
+        self.assertEquals(self.client.transfer.spool_path, None)
+
+    @uses_httpclient
+    def test_compressed_content_checker(self):
+        self.httpserver.enable_compression('gzip')
+        data_seen = []
+        def content_checker(data):
+            data_seen.append(data)
+            return True
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                content_check_callback=content_checker)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        # the content checker should see the decompressed data
+        self.assert_(self.test_response_data.startswith(data_seen[-1]))
+
     @uses_httpclient
     def test_unicode_url(self):
         self.grab_url(unicode(self.httpserver.build_url('test.txt')))
@@ -443,6 +511,43 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url('test.txt'),
                 write_file=filename, resume=True)
         self.assertEquals(open(filename).read(), self.test_response_data)
+
+    @uses_httpclient
+    def test_byte_range(self):
+        filename = self.make_temp_path(".txt")
+        size = len(self.test_response_data)
+        open(filename, 'wb').write('X' * size)
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, byte_range=(10, 19))
+        self.check_header('Range', 'bytes=10-19')
+        self.assertEquals(self.grab_url_info['status'], 206)
+        self.assertEquals(open(filename).read(),
+                'X' * 10 + self.test_response_data[10:20] + 'X' * (size - 20))
+        self.assertEquals(self.client.get_stats().initial_size, 10)
+        self.assertEquals(self.client.get_stats().decoded_bytes, 10)
+
+    @uses_httpclient
+    def test_byte_range_ignored(self):
+        self.httpserver.disable_resume()
+        self.expecting_errback = True
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, byte_range=(10, 19))
+        self.assert_(isinstance(self.grab_url_error, httpclient.ResumeFailed))
+
+    @uses_httpclient
+    def test_set_range_end(self):
+        filename = self.make_temp_path(".txt")
+        self.grab_url_error = self.grab_url_info = None
+        self.client = httpclient.grab_url(
+                self.httpserver.build_url('test.txt'),
+                self.grab_url_callback, self.grab_url_errback,
+                write_file=filename)
+        self.client.set_range_end(99)
+        self.runEventLoop(timeout=self.event_loop_timeout)
+        self.assertNotEquals(self.grab_url_info, None)
+        self.assertEquals(open(filename).read(),
+                self.test_response_data[:100])
  
     @uses_httpclient
     def test_cancel(self):
@@ -483,6 +588,56 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+    @uses_httpclient
+    def test_handle_reuse(self):
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assert_(not self.client.get_stats().handle_reused)
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.assert_(self.client.get_stats().handle_reused)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        stats = httpclient.curl_manager.get_stats()
+        self.assertEquals(stats['handles_created'], 1)
+        self.assertEquals(stats['handles_reused'], 1)
+        self.assertEquals(stats['handle_reuse_rate'], 0.5)
+        self.assertEquals(stats['handle_pool_size'], 1)
+
+    @uses_httpclient
+    def test_connection_reuse(self):
+        handlers_created = testhttpserver.MiroHTTPRequestHandler.handlers_created
+        for i in xrange(3):
+            self.grab_url(self.httpserver.build_url('test.txt'))
+            self.assertEquals(self.grab_url_info['body'],
+                    self.test_response_data)
+        # all 3 transfers should go over the same keep-alive connection
+        self.assertEquals(testhttpserver.MiroHTTPRequestHandler.handlers_created,
+                handlers_created + 1)
+        self.assert_(self.client.get_stats().connection_reused)
+        stats = httpclient.curl_manager.get_stats()
+        self.assertEquals(stats['connections_created'], 1)
+        self.assertEquals(stats['connections_reused'], 2)
+
+    @uses_httpclient
+    def test_cookie_handles_not_pooled(self):
+        options = httpclient.TransferOptions(
+                self.httpserver.build_url('test.txt'))
+        options.requires_cookies = True
+        transfer = httpclient.CurlTransfer(options, self.grab_url_callback,
+                self.grab_url_errback)
+        transfer.start()
+        self.runEventLoop(timeout=self.event_loop_timeout)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        self.assertEquals(
+                httpclient.curl_manager.get_stats()['handle_pool_size'], 0)
+
+    @uses_httpclient
+    def test_scheduled_transfer(self):
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                priority=httpclient.TRANSFER_PRIORITY_NORMAL)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        stats = httpclient.curl_manager.get_stats()
+        self.assertEquals(stats['scheduled_running'], 0)
+        self.assertEquals(stats['scheduled_pending'], 0)
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -1092,3 +1247,186 @@ class LimitProtocolTest(HTTPClientTestBase):
         self.check_errback_called()
         self.assert_(isinstance(self.grab_url_error,
                                 httpclient.InvalidRedirect))
+
+class BandwidthLimitTest(HTTPClientTestBase):
+    def setUp(self):
+        HTTPClientTestBase.setUp(self)
+        self.event_loop_timeout = 10.0
+        self.filename = self.make_temp_path(".txt")
+        # 100KB, so that at 50KB/s the download should take 2 seconds
+        self.data = 'a' * (100 * 1024)
+        source = self.make_temp_path(".txt")
+        open(source, 'wb').write(self.data)
+        self.httpserver.add_file('big.txt', source)
+
+    def timed_download(self, **kwargs):
+        start = time.time()
+        self.grab_url(self.httpserver.build_url('big.txt'),
+                write_file=self.filename, **kwargs)
+        self.assertNotEquals(self.grab_url_info, None)
+        self.assertEquals(open(self.filename, 'rb').read(), self.data)
+        return time.time() - start
+
+    @uses_httpclient
+    def test_rate_limit(self):
+        httpclient.set_download_rate_limit(50 * 1024)
+        elapsed = self.timed_download(bandwidth_weight=1.0)
+        # allow for some slop from the burst size and timer resolution
+        self.assert_(1.5 < elapsed < 3.0, "elapsed: %s" % elapsed)
+
+    @uses_httpclient
+    def test_unweighted_transfers_not_limited(self):
+        httpclient.set_download_rate_limit(10 * 1024)
+        elapsed = self.timed_download()
+        self.assert_(elapsed < 1.0, "elapsed: %s" % elapsed)
+
+class BandwidthAllocatorTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.allocator = httpclient.BandwidthAllocator()
+        self.allocator.set_rate(1000)
+        self.allocator.refill(0.0)
+
+    def make_transfer(self, weight=1.0, group=None):
+        # The allocator only looks at the options of the transfer
+        transfer = mock.Mock()
+        transfer.options = httpclient.TransferOptions('http://a.com/',
+                bandwidth_weight=weight, bandwidth_group=group)
+        self.allocator.add(transfer)
+        return transfer
+
+    def check_tokens(self, transfer, tokens):
+        self.assertAlmostEquals(self.allocator.tokens[transfer], tokens)
+
+    def test_pause(self):
+        transfer = self.make_transfer()
+        # new transfers start with no tokens
+        self.assert_(self.allocator.should_pause(transfer, 100))
+        self.assertEquals(self.allocator.calc_timeout(),
+                httpclient.BANDWIDTH_TICK)
+        self.assertEquals(self.allocator.refill(0.1), [transfer])
+        self.check_tokens(transfer, 100)
+        # a transfer can go ahead as long as it has some tokens
+        self.assert_(not self.allocator.should_pause(transfer, 150))
+        self.check_tokens(transfer, -50)
+        self.assert_(self.allocator.should_pause(transfer, 100))
+        self.assertEquals(self.allocator.refill(0.15), [])
+        self.assertEquals(self.allocator.refill(0.2), [transfer])
+        self.assertEquals(self.allocator.calc_timeout(), None)
+
+    def test_weights(self):
+        transfer1 = self.make_transfer(1.0)
+        transfer2 = self.make_transfer(3.0)
+        self.allocator.refill(0.2)
+        self.check_tokens(transfer1, 50)
+        self.check_tokens(transfer2, 150)
+
+    def test_groups(self):
+        # transfers in a group split the weight of one transfer
+        segments = [self.make_transfer(group='dl') for i in range(3)]
+        other = self.make_transfer()
+        self.allocator.refill(0.3)
+        for segment in segments:
+            self.check_tokens(segment, 50)
+        self.check_tokens(other, 150)
+
+    def test_burst_limit(self):
+        # tokens that a full transfer can't use go to the others
+        transfer1 = self.make_transfer()
+        transfer2 = self.make_transfer()
+        self.allocator.tokens[transfer1] = 450
+        self.allocator.refill(0.2)
+        self.check_tokens(transfer1, 500)
+        self.check_tokens(transfer2, 150)
+        # nobody can save up more than BANDWIDTH_BURST_TIME of bandwidth
+        self.allocator.refill(10.0)
+        self.check_tokens(transfer1, 500)
+        self.check_tokens(transfer2, 500)
+
+    def test_no_limit(self):
+        transfer = self.make_transfer()
+        self.assert_(self.allocator.should_pause(transfer, 100))
+        self.assertEquals(self.allocator.set_rate(None), [transfer])
+        self.assert_(not self.allocator.should_pause(transfer, 100))
+        self.assertEquals(self.allocator.refill(1.0), [])
+
+    def test_remove(self):
+        transfer = self.make_transfer()
+        self.assert_(self.allocator.should_pause(transfer, 100))
+        self.allocator.remove(transfer)
+        self.assertEquals(self.allocator.refill(0.1), [])
+        # transfers that we don't know about never get paused
+        self.assert_(not self.allocator.should_pause(transfer, 100))
+
+class TransferSchedulerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.scheduler = httpclient.TransferScheduler(max_transfers=4,
+                max_per_host=2)
+
+    def make_transfer(self, host, priority=httpclient.TRANSFER_PRIORITY_NORMAL):
+        # The scheduler only looks at the options of the transfer
+        transfer = mock.Mock()
+        transfer.options = httpclient.TransferOptions(
+                'http://%s/feed.rss' % host, priority=priority)
+        self.scheduler.add(transfer)
+        return transfer
+
+    def test_per_host_limit(self):
+        transfers = [self.make_transfer('a.com') for i in xrange(3)]
+        self.assertEquals(self.scheduler.next_transfers(), transfers[:2])
+        self.assertEquals(self.scheduler.next_transfers(), [])
+        self.scheduler.transfer_done(transfers[0])
+        self.assertEquals(self.scheduler.next_transfers(), transfers[2:])
+        self.assertEquals(self.scheduler.pending_count(), 0)
+
+    def test_global_limit(self):
+        for host in ('a.com', 'b.com', 'c.com'):
+            for i in xrange(2):
+                self.make_transfer(host)
+        self.assertEquals(len(self.scheduler.next_transfers()), 4)
+        self.assertEquals(self.scheduler.pending_count(), 2)
+        self.assertEquals(self.scheduler.next_transfers(), [])
+
+    def test_round_robin(self):
+        a_transfers = [self.make_transfer('a.com') for i in xrange(2)]
+        b_transfers = [self.make_transfer('b.com') for i in xrange(2)]
+        # hosts should take turns, rather than a.com's transfers all running
+        # first
+        self.assertEquals(self.scheduler.next_transfers(),
+                [a_transfers[0], b_transfers[0],
+                 a_transfers[1], b_transfers[1]])
+
+    def test_priority(self):
+        low = self.make_transfer('a.com', httpclient.TRANSFER_PRIORITY_LOW)
+        normal = self.make_transfer('b.com')
+        high = self.make_transfer('c.com', httpclient.TRANSFER_PRIORITY_HIGH)
+        self.assertEquals(self.scheduler.next_transfers(),
+                [high, normal, low])
+
+    def test_priority_waits_for_host(self):
+        # a high priority transfer waiting on a busy host shouldn't block
+        # lower priority transfers for other hosts
+        running = [self.make_transfer('a.com') for i in xrange(2)]
+        self.assertEquals(self.scheduler.next_transfers(), running)
+        high = self.make_transfer('a.com', httpclient.TRANSFER_PRIORITY_HIGH)
+        low = self.make_transfer('b.com', httpclient.TRANSFER_PRIORITY_LOW)
+        self.assertEquals(self.scheduler.next_transfers(), [low])
+        self.scheduler.transfer_done(running[0])
+        self.assertEquals(self.scheduler.next_transfers(), [high])
+
+    def test_remove(self):
+        transfers = [self.make_transfer('a.com') for i in xrange(3)]
+        self.assertEquals(self.scheduler.next_transfers(), transfers[:2])
+        # removing a pending transfer
+        self.scheduler.remove(transfers[2])
+        self.assertEquals(self.scheduler.pending_count(), 0)
+        # removing a running transfer frees up its slot
+        self.scheduler.remove(transfers[0])
+        new_transfer = self.make_transfer('a.com')
+        self.assertEquals(self.scheduler.next_transfers(), [new_transfer])
+        # transfer_done() should be safe to call for transfers that aren't
+        # running
+        self.scheduler.transfer_done(transfers[0])
+        self.scheduler.transfer_done(transfers[2])
+        self.assertEquals(len(self.scheduler.running), 2)
@@ -165,3 +165,102 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+class SegmentedDownloaderTest(EventLoopTest):
+    FILE_SIZE = 256 * 1024
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        download.chatter = False
+        download.next_free_filename = lambda x: self.make_temp_path_fileobj()
+        download._downloads = {}
+        self.old_min_segment_size = download.HTTPDownloader.MIN_SEGMENT_SIZE
+        download.HTTPDownloader.MIN_SEGMENT_SIZE = 16 * 1024
+        # the server needs to handle several connections at once, and each
+        # of them should be slow, like a CDN that throttles connections.
+        self.start_http_server(threaded=True)
+        self.httpserver.throttle(64 * 1024)
+        self.data = ''.join(chr(i % 251) for i in xrange(self.FILE_SIZE))
+        path = self.make_temp_path('.bin')
+        open(path, 'wb').write(self.data)
+        self.httpserver.add_file('big-file.bin', path)
+        self.download_url = unicode(self.httpserver.build_url('big-file.bin'))
+        self.max_segments = 0
+
+    def tearDown(self):
+        EventLoopTest.tearDown(self)
+        download.next_free_filename = download_utils.next_free_filename
+        download.HTTPDownloader.MIN_SEGMENT_SIZE = self.old_min_segment_size
+        download.chatter = True
+
+    def start_downloader(self, **kwargs):
+        downloader = TestingDownloader(self, **kwargs)
+        def status_callback():
+            if downloader.segments is not None:
+                self.max_segments = max(self.max_segments,
+                                        len(downloader.segments))
+            if downloader.state == 'finished':
+                self.stopEventLoop(False)
+        downloader.statusCallback = status_callback
+        return downloader
+
+    def check_downloaded(self, downloader):
+        self.assertEquals(downloader.state, 'finished')
+        self.assertEquals(open(downloader.filename, 'rb').read(), self.data)
+        self.assertEquals(downloader.current_size, self.FILE_SIZE)
+        self.assertEquals(downloader.total_size, self.FILE_SIZE)
+        self.assert_(not os.path.exists(
+            download.segment_data_filename(downloader.filename)))
+
+    @uses_httpclient
+    def test_segmented_download(self):
+        downloader = self.start_downloader(url=self.download_url,
+                                           dlid="ID1")
+        self.runEventLoop(timeout=10)
+        self.check_downloaded(downloader)
+        self.assert_(self.max_segments > 1)
+        self.assert_(self.max_segments <= download.HTTPDownloader.MAX_SEGMENTS)
+
+    @uses_httpclient
+    def test_range_ignored(self):
+        self.httpserver.disable_resume()
+        self.httpserver.throttle(256 * 1024)
+        downloader = self.start_downloader(url=self.download_url,
+                                           dlid="ID1")
+        self.runEventLoop(timeout=10)
+        self.check_downloaded(downloader)
+        self.assertEquals(downloader.use_segments, False)
+
+    @uses_httpclient
+    def test_restore(self):
+        downloader = self.start_downloader(url=self.download_url,
+                                           dlid="ID1")
+        def pause_when_segmented():
+            if (downloader.segments is not None and
+                    len(downloader.segments) > 1 and
+                    downloader.current_size > self.FILE_SIZE // 4):
+                downloader.pause()
+                self.stopEventLoop(False)
+        downloader.statusCallback = pause_when_segmented
+        self.runEventLoop(timeout=10)
+        self.assertEquals(downloader.state, 'paused')
+        segment_data = download.load_segment_data(downloader.filename)
+        self.assertNotEquals(segment_data, None)
+        self.assertEquals(segment_data[0], self.FILE_SIZE)
+        self.assert_(len(segment_data[1]) > 1)
+        # simulate restarting the downloader daemon
+        restore = downloader.lastStatus.copy()
+        restore['state'] = 'downloading'
+        download._downloads = {}
+        self.wait_for_libcurl_manager()
+        self.restarted = False
+        def start_new_download_intercept():
+            self.restarted = True
+            self.stopEventLoop(False)
+        downloader2 = self.start_downloader(restore=restore)
+        downloader2.start_new_download = start_new_download_intercept
+        self.assertNotEquals(downloader2.segments, None)
+        self.runEventLoop(timeout=10)
+        self.assert_(not self.restarted)
+        self.check_downloaded(downloader2)
+
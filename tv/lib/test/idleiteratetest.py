@@ -41,3 +41,21 @@ class IdleIterateTest(EventLoopTest):
                 yield
         foo()
         self.check_idle_iterator(0, 1, 2, 3, 4)
+
+    def test_priority(self):
+        # steps should keep the priority that the iterator started with
+        calls = []
+        def foo():
+            for x in xrange(2):
+                calls.append(x)
+                yield
+        eventloop.add_idle(calls.append, "normal priority", args=('normal',))
+        eventloop.idle_iterate(foo, "test idle iterator",
+                               priority=eventloop.IDLE_PRIORITY_HIGH)
+        self.run_idles_for_this_loop()
+        self.assertEquals(calls, [0, 'normal'])
+        idle_queue = eventloop._eventloop.idle_queue
+        self.assertEquals(
+            len(idle_queue.queues[eventloop.IDLE_PRIORITY_HIGH]), 1)
+        self.run_idles_for_this_loop()
+        self.assertEquals(calls, [0, 'normal', 1])
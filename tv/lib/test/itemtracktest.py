@@ -365,6 +365,60 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_list_change_after_message()
         self.check_tracker_items()
 
+    def loaded_rows(self):
+        return set(i for i in xrange(len(self.tracker))
+                   if self.tracker._row_loaded(i))
+
+    def test_background_fetch_order(self):
+        # test that the idle callbacks fetch the rows around the last
+        # requested row first, then the rest in order
+        self.tracker.idle_fetch_size = 2
+        self.tracker.IDLE_FETCH_MIN_ROWS = 2
+        self.tracker.IDLE_FETCH_MAX_ROWS = 2
+        self.tracker.IDLE_FETCH_PRIORITY_ROWS = 4
+        self.tracker.FETCH_ROW_CHUNK_SIZE = 1
+        self.tracker.get_row(8)
+        self.assertEquals(self.loaded_rows(), set([8, 9]))
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set([6, 7, 8, 9]))
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set([0, 1, 6, 7, 8, 9]))
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), set(xrange(10)))
+        self.check_tracker_items()
+
+    def test_background_fetch_after_uncache(self):
+        # test that rows that get uncached after the idle callbacks have
+        # passed them get fetched again
+        self.tracker.idle_fetch_size = 5
+        self.tracker.IDLE_FETCH_MIN_ROWS = 5
+        self.tracker.IDLE_FETCH_MAX_ROWS = 5
+        self.run_tracker_idle()
+        self.assertEquals(self.loaded_rows(), set(xrange(5)))
+        changed_id = self.tracker.id_list[0]
+        for item_obj in self.tracked_items:
+            if item_obj.id == changed_id:
+                item_obj.title = u'new title'
+                item_obj.signal_change()
+        self.process_items_changed_messages()
+        self.assert_(0 not in self.loaded_rows())
+        self.run_all_tracker_idles()
+        self.assertEquals(self.loaded_rows(), set(xrange(10)))
+        self.check_tracker_items()
+
+    def test_adjust_idle_fetch_size(self):
+        self.tracker.idle_fetch_size = 100
+        # fast fetches should make us fetch more rows
+        self.tracker._adjust_idle_fetch_size(100, 0.001)
+        self.assert_(self.tracker.idle_fetch_size > 100)
+        self.assert_(self.tracker.idle_fetch_size <=
+                     self.tracker.IDLE_FETCH_MAX_ROWS)
+        # slow fetches should make us fetch fewer rows
+        for i in xrange(10):
+            self.tracker._adjust_idle_fetch_size(100, 1.0)
+        self.assertEquals(self.tracker.idle_fetch_size,
+                          self.tracker.IDLE_FETCH_MIN_ROWS)
+
     def test_item_changes_after_finished(self):
         # test item changes after we've finished fetching all rows
         while not self.tracker.idle_work_scheduled:
@@ -962,6 +1016,86 @@ class ItemInfoAttributeTest(MiroTestCase):
                    "attributes: (%s)" % missing_attributes)
             raise AssertionError(msg)
 
+class ItemInfoProfileTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        self.feed, self.items = testobjects.make_feed_with_items(3)
+        for i, obj in enumerate(self.items):
+            obj.entry_description = u'description-%s' % i
+            obj.signal_change()
+        app.db.finish_transaction()
+        self.item_ids = [obj.id for obj in self.items]
+
+    def fetch_item_infos(self, item_source):
+        with item_source.connection_pool.context() as connection:
+            rows = item._fetch_item_rows(connection, self.item_ids,
+                                         item_source.select_info).fetchall()
+        return [item_source.make_item_info(row) for row in rows]
+
+    def test_select_columns(self):
+        details = item.ItemSource().select_info
+        for profile in ('list', 'standard'):
+            select_info = item.ItemSource(profile=profile).select_info
+            selected = set(c.attr_name for c in select_info.select_columns)
+            deferred = set(c.attr_name for c in select_info.deferred_columns)
+            self.assertEquals(deferred, set(
+                item.ItemSelectInfo.column_profiles[profile]))
+            self.assertEquals(selected.intersection(deferred), set())
+            self.assertEquals(len(selected) + len(deferred),
+                              len(details.select_columns))
+        self.assertEquals(details.deferred_columns, ())
+
+    def test_standard_profile_has_row_columns(self):
+        # The item renderers read these for each row.  Deferring them would
+        # mean a query for each row we display.
+        select_info = item.ItemSource(profile='standard').select_info
+        deferred = set(c.attr_name for c in select_info.deferred_columns)
+        for name in ('title', 'entry_description', 'metadata_description',
+                     'feed_thumbnail_path_unicode'):
+            self.assert_(name not in deferred)
+
+    def test_profile_class_cached(self):
+        self.assert_(item.ItemInfo.profile_class('details') is item.ItemInfo)
+        list_class = item.ItemInfo.profile_class('list')
+        self.assert_(issubclass(list_class, item.ItemInfo))
+        self.assert_(item.ItemInfo.profile_class('list') is list_class)
+
+    def test_deferred_values(self):
+        details_infos = self.fetch_item_infos(item.ItemSource())
+        list_infos = self.fetch_item_infos(item.ItemSource(profile='list'))
+        self.assertEquals(len(details_infos), len(list_infos))
+        for details_info, list_info in zip(details_infos, list_infos):
+            self.assert_(len(list_info.row_data) <
+                         len(details_info.row_data))
+            self.assertEquals(list_info.id, details_info.id)
+            self.assertEquals(list_info.title, details_info.title)
+            # nothing should be fetched until we access a deferred column
+            self.assertEquals(list_info._deferred_values, None)
+            self.assertEquals(list_info.description,
+                              details_info.description)
+            self.assertEquals(list_info.entry_description,
+                              u'description-%s' %
+                              self.item_ids.index(list_info.id))
+            for name in item.ItemSelectInfo.column_profiles['list']:
+                self.assertEquals(getattr(list_info, name),
+                                  getattr(details_info, name))
+
+    def test_deferred_values_fetched_once(self):
+        list_info = self.fetch_item_infos(item.ItemSource(profile='list'))[0]
+        fetch = mock.Mock(wraps=list_info._fetch_deferred_values)
+        list_info._fetch_deferred_values = fetch
+        list_info.entry_description
+        list_info.license
+        list_info.permalink
+        self.assertEquals(fetch.call_count, 1)
+
+    def test_deleted_item(self):
+        list_info = self.fetch_item_infos(item.ItemSource(profile='list'))[0]
+        self.items[0].remove()
+        app.db.finish_transaction()
+        self.assertEquals(list_info.entry_description, None)
+
 class BackendItemTrackerTest(MiroTestCase):
     def setUp(self):
         MiroTestCase.setUp(self)
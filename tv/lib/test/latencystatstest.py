@@ -0,0 +1,137 @@
+import os
+import signal
+
+from miro import eventloop
+from miro import latencystats
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+class HistogramTest(MiroTestCase):
+    def test_empty(self):
+        histogram = latencystats.Histogram()
+        self.assertEquals(histogram.count, 0)
+        self.assertEquals(histogram.mean(), 0.0)
+        self.assertEquals(histogram.percentile(50), 0.0)
+
+    def test_percentiles(self):
+        histogram = latencystats.Histogram()
+        # 90 fast calls and 10 slow ones
+        for i in xrange(90):
+            histogram.add(0.00005)
+        for i in xrange(10):
+            histogram.add(0.3)
+        self.assertEquals(histogram.count, 100)
+        self.assertAlmostEquals(histogram.total, 3.0045)
+        self.assertEquals(histogram.max, 0.3)
+        # percentiles give the upper bound of the bucket, capped by max
+        self.assertEquals(histogram.percentile(50),
+                          latencystats.BUCKET_BOUNDS[0])
+        self.assertEquals(histogram.percentile(90),
+                          latencystats.BUCKET_BOUNDS[0])
+        self.assertEquals(histogram.percentile(99), 0.3)
+
+    def test_overflow_bucket(self):
+        histogram = latencystats.Histogram()
+        histogram.add(1000.0)
+        self.assertEquals(histogram.counts[-1], 1)
+        self.assertEquals(histogram.percentile(50), 1000.0)
+
+class LatencyStatsTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        latencystats.reset()
+
+    def tearDown(self):
+        latencystats.reset()
+        MiroTestCase.tearDown(self)
+
+    def test_record(self):
+        latencystats.record('test', 'foo', 0.1)
+        latencystats.record('test', 'foo', 0.2)
+        latencystats.record('test', 'bar', 0.1)
+        self.assertEquals(latencystats.get_histogram('test', 'foo').count, 2)
+        self.assertEquals(latencystats.get_histogram('test', 'bar').count, 1)
+        self.assertEquals(latencystats.get_histogram('test', 'baz'), None)
+        self.assertEquals(latencystats.get_histogram('other', 'foo'), None)
+
+    def test_key_limit(self):
+        limit = latencystats.MAX_KEYS_PER_CATEGORY
+        for i in xrange(limit + 10):
+            latencystats.record('test', 'key-%d' % i, 0.1)
+        self.assertEquals(latencystats.get_histogram('test', 'key-0').count,
+                          1)
+        self.assertEquals(latencystats.get_histogram('test',
+                                                     'key-%d' % limit), None)
+        other = latencystats.get_histogram('test', latencystats.OTHER_KEY)
+        self.assertEquals(other.count, 10)
+        # keys that we're already tracking still get recorded
+        latencystats.record('test', 'key-0', 0.1)
+        self.assertEquals(latencystats.get_histogram('test', 'key-0').count,
+                          2)
+
+    def test_report(self):
+        latencystats.record('test', 'fast', 0.001)
+        latencystats.record('test', 'slow', 0.5)
+        report = latencystats.report()
+        self.assert_('test (2 keys)' in report)
+        # keys are sorted by total time
+        self.assert_(report.index('slow') < report.index('fast'))
+
+    def test_dump_to_file(self):
+        latencystats.record('test', 'foo', 0.1)
+        path = os.path.join(self.tempdir, 'latency-stats.txt')
+        latencystats.dump_to_file(path)
+        self.assertEquals(open(path).read(), latencystats.report())
+
+    def test_sql_template(self):
+        self.assertEquals(latencystats.sql_template(
+            "SELECT id FROM item WHERE feed_id=12 AND id IN (1, 2, 3)"),
+            "SELECT id FROM item WHERE feed_id=? AND id IN (...)")
+        self.assertEquals(latencystats.sql_template(
+            "UPDATE item SET title=? WHERE id=?"),
+            "UPDATE item SET title=? WHERE id=?")
+        self.assertEquals(latencystats.sql_template(
+            "INSERT INTO item (id, title)\n   VALUES (?, ?)"),
+            "INSERT INTO item (id, title) VALUES (...)")
+        # names with numbers in them aren't changed
+        self.assertEquals(latencystats.sql_template(
+            "SELECT * FROM item_fts3"),
+            "SELECT * FROM item_fts3")
+
+class EventLoopLatencyTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        latencystats.reset()
+
+    def tearDown(self):
+        latencystats.reset()
+        EventLoopTest.tearDown(self)
+
+    def test_signal_with_lock_held(self):
+        # Getting SIGUSR1 while a thread is inside record() shouldn't
+        # deadlock.  The stats should get dumped from the eventloop.
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+        path = os.path.join(self.tempdir, 'latency-stats.txt')
+        old_handler = signal.getsignal(signal.SIGUSR1)
+        latencystats.install_signal_handler(path)
+        try:
+            latencystats.record('test', 'foo', 0.1)
+            with latencystats._stats.lock:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            self.assert_(not os.path.exists(path))
+            self.runEventLoop(0.1, timeoutNormal=True)
+            self.assert_('foo' in open(path).read())
+        finally:
+            signal.signal(signal.SIGUSR1, old_handler)
+            eventloop.disconnect('begin-loop', latencystats._on_begin_loop)
+
+    def test_eventloop_recording(self):
+        eventloop.add_idle(lambda: None, 'latency test idle')
+        eventloop.add_timeout(-1, lambda: None, 'latency test timeout')
+        self.run_pending_timeouts()
+        self.run_idles_for_this_loop()
+        for name in ('idle (latency test idle)',
+                     'timeout (latency test timeout)'):
+            histogram = latencystats.get_histogram('eventloop', name)
+            self.assertNotEquals(histogram, None)
+            self.assertEquals(histogram.count, 1)
@@ -1702,6 +1702,8 @@ class TestEchonestQueries(MiroTestCase):
         """
         self.assertEquals(mock_grab_url.call_count, 1)
         args, kwargs = mock_grab_url.call_args
+        self.assertEquals(kwargs.pop('priority'),
+                          httpclient.TRANSFER_PRIORITY_LOW)
         if post_vars is not None:
             grab_url_post_vars = kwargs.pop('post_vars')
             # handle query specially, since it's a json encoded dict so it can
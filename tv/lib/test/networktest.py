@@ -339,6 +339,38 @@ class NetworkBufferTest(MiroTestCase):
         # check to make sure the value doesn't change as a result
         self.assertEquals(self.buffer.getValue(), "ONETWOTHREE")
 
+    def test_unread(self):
+        self.buffer.addData("ONE\nTWO\n")
+        line = self.buffer.readline()
+        self.buffer.unread(line + "\n")
+        self.assertEquals(self.buffer.getValue(), "ONE\nTWO\n")
+        self.buffer.unread("ZERO\n")
+        self.assertEquals(self.buffer.readline(), "ZERO")
+        self.assertEquals(self.buffer.readline(), "ONE")
+        self.assertEquals(self.buffer.readline(), "TWO")
+        self.assertEquals(self.buffer.readline(), None)
+
+    def test_line_in_pieces(self):
+        # readline() shouldn't lose track of data that it already scanned
+        for i in xrange(100):
+            self.buffer.addData("A" * 100)
+            self.assertEquals(self.buffer.readline(), None)
+        self.buffer.unread("B\r\n")
+        self.assertEquals(self.buffer.readline(), "B")
+        self.buffer.addData("\r\nREST")
+        self.assertEquals(self.buffer.readline(), "A" * 10000)
+        self.assertEquals(self.buffer.read(), "REST")
+
+    def test_compact(self):
+        piece = "0123456789" * 100
+        for i in xrange(20):
+            self.buffer.addData(piece)
+            self.assertEquals(self.buffer.read(len(piece) - 1), piece[:-1])
+            self.assertEquals(self.buffer.read(1), piece[-1])
+        threshold = net.NetworkBuffer.COMPACT_THRESHOLD
+        self.assert_(len(self.buffer.data) < threshold * 2)
+        self.assertEquals(self.buffer.length, 0)
+
 
 class WeirdCloseConnectionTest(AsyncSocketTest):
     def test_close_during_open_connection(self):
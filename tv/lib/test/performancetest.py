@@ -0,0 +1,519 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""performancetest -- Benchmarks for performance sensitive code.
+
+These tests are only run when they are named on the command line, for
+example::
+
+    ./run.sh --unittest performancetest
+
+They report their timings rather than assert on them, since the numbers
+depend a lot on the machine running them.
+"""
+
+import cPickle
+import datetime
+import os
+import struct
+import time
+from cStringIO import StringIO
+
+from miro import app
+from miro import eventloop
+from miro import feedparserutil
+from miro import models
+from miro import net
+from miro import storedatabase
+from miro import subprocessmanager
+from miro import util
+from miro import workerprocess
+from miro.data import item
+from miro.data import itemtrack
+from miro.dl_daemon import command
+from miro.dl_daemon import protocol
+from miro.plat import resources
+from miro.test import testobjects
+from miro.test.dldaemontest import TestingDaemon
+from miro.test.framework import MiroTestCase, EventLoopTest
+
+def report_timing(name, total_time, count):
+    """Print the total and per-call time for a benchmark."""
+    print
+    print "%s: %d calls in %0.3f secs (%0.3f ms per call)" % (
+        name, count, total_time, total_time * 1000.0 / count)
+
+class ViewTrackerPerformanceTest(MiroTestCase):
+    """Measure the cost of an object change with many active ViewTrackers.
+    """
+    ITEM_COUNT = 50000
+    TRACKER_COUNT = 200
+    CHANGE_COUNT = 500
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feeds = [testobjects.make_feed()
+                      for i in xrange(self.TRACKER_COUNT)]
+        app.bulk_sql_manager.start()
+        self.items = []
+        for i in xrange(self.ITEM_COUNT):
+            feed = self.feeds[i % len(self.feeds)]
+            self.items.append(testobjects.make_item(feed, u'item-%d' % i))
+        app.bulk_sql_manager.finish()
+        self.trackers = [
+            models.Item.make_view('feed_id=?', (feed.id,)).make_tracker()
+            for feed in self.feeds
+        ]
+
+    def tearDown(self):
+        for tracker in self.trackers:
+            tracker.unlink()
+        MiroTestCase.tearDown(self)
+
+    def time_changes(self):
+        start = time.time()
+        for i in xrange(self.CHANGE_COUNT):
+            item = self.items[i * 97 % len(self.items)]
+            item.feed_id = self.feeds[i % len(self.feeds)].id
+            item.signal_change()
+            app.db.finish_transaction()
+        return time.time() - start
+
+    def test_in_memory_predicates(self):
+        report_timing('ViewTracker check (in-memory)', self.time_changes(),
+                      self.CHANGE_COUNT)
+
+    def test_sql_predicates(self):
+        for tracker in self.trackers:
+            tracker._predicate = None
+            tracker._predicate_compiled = True
+        report_timing('ViewTracker check (SQL)', self.time_changes(),
+                      self.CHANGE_COUNT)
+
+class ReprCodecPerformanceTest(MiroTestCase):
+    """Measure reading pythonrepr columns with the binary and repr() formats.
+
+    RemoteDownloader no longer stores its status as a pythonrepr column, so
+    we time the converter on a value shaped like the old status dicts.
+    """
+    ROW_COUNT = 10000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.value = {
+            'dlid': u'ad3c8f0e', 'url': u'http://example.com/movie.mpeg',
+            'state': u'downloading', 'currentSize': 123456789L,
+            'totalSize': 987654321L, 'rate': 51234.5, 'eta': 60,
+            'startTime': datetime.datetime(2011, 6, 5, 1, 30),
+            'endTime': None, 'shortFilename': u'movie.mpeg',
+            'reasonFailed': u'', 'retryTime': None, 'retryCount': -1,
+            'channelName': None, 'infohash': None, 'metainfo': None,
+            'activity': None, 'uploaded': 0, 'seeders': None,
+        }
+
+    def time_restore(self, converter):
+        sql_values = [converter._repr_to_sql(self.value, None)
+                      for i in xrange(self.ROW_COUNT)]
+        start = time.time()
+        for sql_value in sql_values:
+            converter._repr_from_sql(sql_value, None)
+        return time.time() - start
+
+    def test_binary_format(self):
+        converter = storedatabase.SQLiteConverter()
+        report_timing('pythonrepr restore (binary)',
+                      self.time_restore(converter), self.ROW_COUNT)
+
+    def test_repr_format(self):
+        converter = storedatabase.SQLiteConverter(binary_repr=False)
+        report_timing('pythonrepr restore (repr)',
+                      self.time_restore(converter), self.ROW_COUNT)
+
+class ItemTrackerPerformanceTest(MiroTestCase):
+    """Measure loading all rows of a large item list in idle callbacks."""
+    ITEM_COUNT = 20000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        self.feed = testobjects.make_feed()
+        app.bulk_sql_manager.start()
+        for i in xrange(self.ITEM_COUNT):
+            testobjects.make_item(self.feed, u'item-%d' % i)
+        app.bulk_sql_manager.finish()
+        app.db.finish_transaction()
+        self.idle_callbacks = []
+
+    def test_background_fetch(self):
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', self.feed.id)
+        query.set_order_by(['release_date'])
+        tracker = itemtrack.ItemTracker(self.idle_callbacks.append, query,
+                                        item.ItemSource())
+        callback_count = 0
+        longest_callback = 0
+        start = time.time()
+        while self.idle_callbacks:
+            callback = self.idle_callbacks.pop(0)
+            callback_start = time.time()
+            callback()
+            longest_callback = max(longest_callback,
+                                   time.time() - callback_start)
+            callback_count += 1
+        report_timing('ItemTracker idle fetch', time.time() - start,
+                      callback_count)
+        print "longest idle callback: %0.3f ms" % (longest_callback * 1000)
+        tracker.destroy()
+
+class PollerPerformanceTest(MiroTestCase):
+    """Measure the cost of waiting on many idle sockets with each poller.
+
+    select() can't handle fds past FD_SETSIZE, so we report that rather than
+    a timing if it fails.
+    """
+    SOCKET_COUNT = 2000
+    POLL_COUNT = 1000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.raise_fd_limit(self.SOCKET_COUNT * 2 + 100)
+        self.sockets = []
+        for i in xrange(self.SOCKET_COUNT):
+            self.sockets.extend(util.make_dummy_socket_pair())
+        self.idle_fds = [sock.fileno() for sock in self.sockets[::2]]
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        MiroTestCase.tearDown(self)
+
+    def raise_fd_limit(self, needed):
+        try:
+            import resource
+        except ImportError:
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            if hard != resource.RLIM_INFINITY:
+                needed = min(needed, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+    def time_poller(self, poller_name):
+        poller = eventloop.make_poller(poller_name)
+        for fd in self.idle_fds:
+            poller.update(fd, True, False)
+        try:
+            start = time.time()
+            for i in xrange(self.POLL_COUNT):
+                poller.poll(0)
+            total_time = time.time() - start
+        except ValueError, e:
+            print
+            print "%s poller with %d sockets: %s" % (poller_name,
+                                                      len(self.idle_fds), e)
+        else:
+            report_timing("%s poller with %d idle sockets" %
+                          (poller_name, len(self.idle_fds)),
+                          total_time, self.POLL_COUNT)
+        poller.close()
+
+    def test_select(self):
+        self.time_poller('select')
+
+    def test_poll(self):
+        if 'poll' in eventloop.available_pollers():
+            self.time_poller('poll')
+
+    def test_epoll(self):
+        if 'epoll' in eventloop.available_pollers():
+            self.time_poller('epoll')
+
+class IdleLatencyPerformanceTest(EventLoopTest):
+    """Measure event loop latency while many idle iterators are running.
+
+    We run ITERATOR_COUNT low-priority idle iterators, each step of which
+    takes STEP_TIME.  Meanwhile a timeout fires every PROBE_INTERVAL and
+    schedules a high-priority idle.  We report the worst-case lateness of
+    the timeouts and the worst-case wait for the idles.
+    """
+    ITERATOR_COUNT = 20
+    STEP_TIME = 0.005
+    PROBE_INTERVAL = 0.01
+    RUN_TIME = 2.0
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.timeout_latencies = []
+        self.idle_latencies = []
+        self.finished = False
+
+    def busy_iterator(self):
+        while not self.finished:
+            end = time.time() + self.STEP_TIME
+            while time.time() < end:
+                pass
+            yield
+
+    def probe(self, scheduled_time):
+        now = time.time()
+        self.timeout_latencies.append(now - scheduled_time)
+        eventloop.add_idle(self.idle_probe, "idle latency probe",
+                           args=(now,), priority=self.probe_priority)
+        if not self.finished:
+            self.schedule_probe()
+
+    def idle_probe(self, added_time):
+        self.idle_latencies.append(time.time() - added_time)
+
+    def schedule_probe(self):
+        eventloop.add_timeout(self.PROBE_INTERVAL, self.probe,
+                              "timeout latency probe",
+                              args=(time.time() + self.PROBE_INTERVAL,))
+
+    def stop(self):
+        self.finished = True
+        eventloop.add_timeout(0.1, eventloop.shutdown, "stop event loop")
+
+    def run_load(self, iterator_priority, probe_priority):
+        self.probe_priority = probe_priority
+        for i in xrange(self.ITERATOR_COUNT):
+            eventloop.idle_iterate(self.busy_iterator, "busy iterator",
+                                   priority=iterator_priority)
+        self.schedule_probe()
+        eventloop.add_timeout(self.RUN_TIME, self.stop, "stop load")
+        self.runEventLoop(timeout=self.RUN_TIME + 5)
+        print
+        print ("%d idle iterators: max timeout latency %0.1f ms, "
+               "max idle latency %0.1f ms (%d probes)" % (
+                   self.ITERATOR_COUNT, max(self.timeout_latencies) * 1000,
+                   max(self.idle_latencies) * 1000,
+                   len(self.idle_latencies)))
+
+    def test_priorities(self):
+        self.run_load(eventloop.IDLE_PRIORITY_LOW,
+                      eventloop.IDLE_PRIORITY_HIGH)
+
+    def test_no_priorities(self):
+        self.run_load(eventloop.IDLE_PRIORITY_NORMAL,
+                      eventloop.IDLE_PRIORITY_NORMAL)
+
+class SchedulerPerformanceTest(MiroTestCase):
+    """Measure timeouts that keep getting cancelled and rescheduled.
+
+    This simulates things like status polling and save timers, which leave
+    cancelled DelayedCalls in the Scheduler.
+    """
+    TIMER_COUNT = 1000
+    RESCHEDULE_COUNT = 100000
+
+    def run_churn(self, scheduler, delay):
+        def func():
+            pass
+        # spread the delays out, so that the timeouts we cancel aren't
+        # always at the top of the heap
+        delays = [delay * (1 + (i * 7919 % self.TIMER_COUNT) /
+                           float(self.TIMER_COUNT))
+                  for i in xrange(self.TIMER_COUNT)]
+        dcs = [scheduler.add_timeout(delays[i], func, 'timer')
+               for i in xrange(self.TIMER_COUNT)]
+        start = time.time()
+        for i in xrange(self.RESCHEDULE_COUNT):
+            index = (i * 7) % self.TIMER_COUNT
+            dcs[index].cancel()
+            dcs[index] = scheduler.add_timeout(delays[index], func, 'timer')
+            scheduler.next_timeout()
+        total_time = time.time() - start
+        report_timing("reschedule with %0.1fs delay %s" % (
+            delay, scheduler.get_stats()), total_time, self.RESCHEDULE_COUNT)
+
+    def test_heap(self):
+        self.run_churn(eventloop.Scheduler(), 1.0)
+
+    def test_timer_wheel(self):
+        self.run_churn(eventloop.Scheduler(use_timer_wheel=True), 60.0)
+
+class NetworkBufferPerformanceTest(MiroTestCase):
+    """Measure NetworkBuffer with a 10 MB stream fed in 1 KB pieces."""
+    STREAM_SIZE = 10 * 1024 * 1024
+    PIECE_SIZE = 1024
+
+    def feed_pieces(self, buf, piece, reader):
+        count = self.STREAM_SIZE // len(piece)
+        start = time.time()
+        for i in xrange(count):
+            buf.addData(piece)
+            reader(buf)
+        report_timing(self._testMethodName, time.time() - start, count)
+
+    def test_read(self):
+        def reader(buf):
+            # read a bit less than we add, so there's always leftover data
+            buf.read(self.PIECE_SIZE - 1)
+        self.feed_pieces(net.NetworkBuffer(), 'A' * self.PIECE_SIZE, reader)
+
+    def test_readline(self):
+        # 100 byte lines, which don't line up with the pieces
+        line = 'A' * 98 + '\r\n'
+        data = line * (self.PIECE_SIZE // len(line) + 1)
+        def reader(buf):
+            while buf.readline() is not None:
+                pass
+        self.feed_pieces(net.NetworkBuffer(), data[:self.PIECE_SIZE], reader)
+
+    def test_large_message(self):
+        # This is what the downloader daemon does: wait for the whole
+        # message to arrive, then read it in one go.
+        def reader(buf):
+            if buf.length >= self.STREAM_SIZE:
+                buf.read(self.STREAM_SIZE)
+            elif buf.readline() is not None:
+                self.fail("unexpected newline")
+        self.feed_pieces(net.NetworkBuffer(), 'A' * self.PIECE_SIZE, reader)
+
+    def test_read_unread(self):
+        # read a header and put it back because the body isn't there yet
+        def reader(buf):
+            header = buf.read(8)
+            buf.unread(header)
+        self.feed_pieces(net.NetworkBuffer(), 'A' * self.PIECE_SIZE, reader)
+
+class DaemonStatusPerformanceTest(EventLoopTest):
+    """Measure sending a second's worth of status updates for 300 torrents
+    from the downloader to the controller, using mock daemons.
+    """
+    DOWNLOAD_COUNT = 300
+    UPDATE_COUNT = 100
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.statuses = []
+        for i in xrange(self.DOWNLOAD_COUNT):
+            self.statuses.append({
+                'dlid': 'dlid-%08d' % i,
+                'url': u'http://example.com/torrents/%d.torrent' % i,
+                'state': u'downloading',
+                'total_size': 700 * 1024 * 1024,
+                'current_size': 0,
+                'eta': 1000,
+                'rate': 0,
+                'upload_rate': 0,
+                'upload_size': 0,
+                'filename': '/home/user/Movies/Incomplete Downloads/%d' % i,
+                'start_time': 1300000000.0,
+                'end_time': None,
+                'short_filename': 'Some Movie %d.avi' % i,
+                'reason_failed': u'',
+                'short_reason_failed': u'',
+                'type': 'BitTorrent',
+                'retry_time': None,
+                'retry_count': -1,
+                'activity': u'downloading',
+                'seeders': 10,
+                'leechers': 20,
+                'connections': 30,
+                'info_hash': '%040x' % i,
+            })
+
+    def update_statuses(self, count):
+        for status in self.statuses:
+            status['current_size'] += 1024 * 1024
+            status['rate'] = 1024 * 1024 + count
+            status['eta'] -= 1
+            if count % 5 == 0:
+                status['seeders'] += 1
+
+    def run_updates(self, encode, decode):
+        sender = TestingDaemon()
+        receiver = TestingDaemon()
+        bytes_sent = 0
+        start = time.time()
+        for i in xrange(self.UPDATE_COUNT):
+            self.update_statuses(i)
+            statuses = [encode(status.copy()) for status in self.statuses]
+            sender.send(command.BatchUpdateDownloadStatus(sender, statuses,
+                                                          False))
+            sender.flush_commands()
+            data = sender.stream.sent.pop()[0]
+            bytes_sent += len(data)
+            receiver.handleData(data)
+            for status in receiver.commands.pop().args[0]:
+                decode(status)
+        report_timing(self._testMethodName, time.time() - start,
+                      self.UPDATE_COUNT)
+        print "%d bytes per update" % (bytes_sent // self.UPDATE_COUNT)
+
+    def test_full_status(self):
+        # What we used to do: send every field every time
+        self.run_updates(lambda status: status, lambda status: status)
+
+    def test_status_delta(self):
+        encoder = protocol.StatusEncoder()
+        decoder = protocol.StatusDecoder()
+        self.run_updates(encoder.encode, decoder.decode)
+
+class SubprocessMessagePerformanceTest(MiroTestCase):
+    """Measure sending FeedparserTask results from the worker process."""
+    MESSAGE_COUNT = 200
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        parsed_feed = feedparserutil.parse(open(path).read())
+        feedparserutil.strip_entries(parsed_feed)
+        parsed_feed['bozo_exception'] = None
+        parsed_feed['peak_rss'] = None
+        self.result = workerprocess.TaskResult(0, parsed_feed)
+
+    def run_messages(self, encode, decode):
+        bytes_sent = 0
+        start = time.time()
+        for i in xrange(self.MESSAGE_COUNT):
+            data = encode(self.result)
+            bytes_sent += len(data)
+            decode(data)
+        total_time = time.time() - start
+        report_timing(self._testMethodName, total_time, self.MESSAGE_COUNT)
+        print "%0.0f messages per sec, %d bytes per message" % (
+            self.MESSAGE_COUNT / total_time,
+            bytes_sent // self.MESSAGE_COUNT)
+
+    def test_text_pickle(self):
+        # What we used to do: protocol 0 pickles with a length prefix
+        def encode(obj):
+            pickle_data = cPickle.dumps(obj)
+            return struct.pack("Q", len(pickle_data)) + pickle_data
+        def decode(data):
+            return cPickle.loads(data[struct.calcsize("Q"):])
+        self.run_messages(encode, decode)
+
+    def test_binary_pickle(self):
+        def decode(data):
+            return subprocessmanager._load_obj(StringIO(data))
+        self.run_messages(subprocessmanager._encode_obj, decode)
@@ -2,6 +2,7 @@ from time import time, sleep
 import threading
 
 from miro import eventloop
+from miro import util
 from miro.test.framework import EventLoopTest
 
 class SchedulerTest(EventLoopTest):
@@ -57,3 +58,274 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class PollerTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        EventLoopTest.tearDown(self)
+
+    def make_socket_pair(self):
+        pair = util.make_dummy_socket_pair()
+        self.sockets.extend(pair)
+        return pair
+
+    def check_poller(self, poller_name):
+        poller = eventloop.make_poller(poller_name)
+        reader, writer = self.make_socket_pair()
+        idle, idle2 = self.make_socket_pair()
+        poller.update(reader.fileno(), True, False)
+        poller.update(idle.fileno(), True, False)
+        self.assertEquals(poller.poll(0), ([], []))
+        writer.send("a")
+        self.assertEquals(poller.poll(1.0), ([reader.fileno()], []))
+        # switch to waiting for writes
+        poller.update(reader.fileno(), False, True)
+        self.assertEquals(poller.poll(1.0), ([], [reader.fileno()]))
+        poller.update(reader.fileno(), False, False)
+        self.assertEquals(poller.poll(0), ([], []))
+        poller.close()
+
+    def test_select(self):
+        self.check_poller('select')
+
+    def test_poll(self):
+        if 'poll' in eventloop.available_pollers():
+            self.check_poller('poll')
+
+    def test_epoll(self):
+        if 'epoll' in eventloop.available_pollers():
+            self.check_poller('epoll')
+
+    def test_unknown_poller(self):
+        self.assertRaises(ValueError, eventloop.make_poller, 'foo')
+
+    def test_closed_fd_reused(self):
+        # If a socket is closed without removing its callback, a new socket
+        # with the same fd should still get its callbacks
+        for poller_name in eventloop.available_pollers():
+            poller = eventloop.make_poller(poller_name)
+            reader, writer = util.make_dummy_socket_pair()
+            fd = reader.fileno()
+            poller.update(fd, True, False)
+            reader.close()
+            writer.close()
+            reader, writer = self.make_socket_pair()
+            if reader.fileno() != fd:
+                reader, writer = writer, reader
+            if reader.fileno() != fd:
+                poller.close()
+                continue
+            poller.update(fd, True, False)
+            writer.send("a")
+            self.assertEquals(poller.poll(1.0), ([fd], []))
+            poller.close()
+
+    def test_callbacks(self):
+        for poller_name in eventloop.available_pollers():
+            eventloop.set_poller(poller_name)
+            reader, writer = self.make_socket_pair()
+            calls = []
+            def on_read():
+                calls.append(reader.recv(1024))
+                eventloop.remove_read_callback(reader)
+                eventloop.add_write_callback(reader, on_write)
+            def on_write():
+                calls.append('write')
+                eventloop.stop_handling_socket(reader)
+                eventloop.shutdown()
+            eventloop.add_read_callback(reader, on_read)
+            eventloop.add_timeout(0.05, writer.send, "send", args=("a",))
+            self.runEventLoop()
+            self.assertEquals(calls, ["a", "write"])
+
+class IdleQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.queue = eventloop.IdleQueue()
+        self.calls = []
+        self.current_time = 100.0
+        self.old_clock = eventloop.clock
+        eventloop.clock = lambda: self.current_time
+
+    def tearDown(self):
+        eventloop.clock = self.old_clock
+        EventLoopTest.tearDown(self)
+
+    def add_idle(self, name, priority):
+        self.queue.add_idle(self.calls.append, name, args=(name,),
+                            priority=priority)
+
+    def test_priority_order(self):
+        self.add_idle('low1', eventloop.IDLE_PRIORITY_LOW)
+        self.add_idle('normal1', eventloop.IDLE_PRIORITY_NORMAL)
+        self.add_idle('high1', eventloop.IDLE_PRIORITY_HIGH)
+        self.add_idle('normal2', eventloop.IDLE_PRIORITY_NORMAL)
+        self.add_idle('high2', eventloop.IDLE_PRIORITY_HIGH)
+        self.queue.process_idles()
+        self.assertEquals(self.calls,
+                          ['high1', 'high2', 'normal1', 'normal2', 'low1'])
+        self.assert_(not self.queue.has_pending_idle())
+
+    def test_aging(self):
+        self.add_idle('low', eventloop.IDLE_PRIORITY_LOW)
+        # after waiting 2 aging periods, the low priority callback should
+        # tie with new high priority ones, which still go first.
+        self.current_time += eventloop.IDLE_AGING_TIME * 2
+        self.add_idle('high1', eventloop.IDLE_PRIORITY_HIGH)
+        self.queue.process_next_idle()
+        self.assertEquals(self.calls, ['high1'])
+        # after 3 periods, it should run before them
+        self.current_time += eventloop.IDLE_AGING_TIME
+        self.add_idle('high2', eventloop.IDLE_PRIORITY_HIGH)
+        self.queue.process_next_idle()
+        self.assertEquals(self.calls, ['high1', 'low'])
+
+    def test_time_budget(self):
+        # generate_events() should stop running idles once it's used up
+        # IDLE_TIME_BUDGET, and the next loop shouldn't block.
+        loop = eventloop.EventLoop()
+        def slow_idle(name):
+            self.calls.append(name)
+            self.current_time += eventloop.IDLE_TIME_BUDGET / 2
+        for i in range(5):
+            loop.idle_queue.add_idle(slow_idle, 'slow', args=(i,))
+        for event in loop.generate_events([], []):
+            event()
+        self.assertEquals(self.calls, [0, 1])
+        self.assertEquals(loop.calc_timeout(), 0)
+        for event in loop.generate_events([], []):
+            event()
+        self.assertEquals(self.calls, [0, 1, 2, 3])
+
+class SchedulerTimeoutTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.calls = []
+        self.current_time = 1000.0
+        self.old_clock = eventloop.clock
+        eventloop.clock = lambda: self.current_time
+
+    def tearDown(self):
+        eventloop.clock = self.old_clock
+        EventLoopTest.tearDown(self)
+
+    def add_timeout(self, scheduler, delay, name):
+        return scheduler.add_timeout(delay, self.calls.append, name,
+                                     args=(name,))
+
+    def run_timeouts(self, scheduler):
+        while scheduler.has_pending_timeout():
+            scheduler.process_next_timeout()
+
+    def test_compaction(self):
+        scheduler = eventloop.Scheduler()
+        count = eventloop.SCHEDULER_COMPACT_MIN * 2
+        dcs = [self.add_timeout(scheduler, 10 + i, i) for i in xrange(count)]
+        for dc in dcs[:-1]:
+            dc.cancel()
+        self.assertEquals(scheduler.get_stats()['cancelled'], count - 1)
+        # the next timeout calculation should compact the heap
+        self.assertEquals(scheduler.next_timeout(), 10 + count - 1)
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['heap_size'], 1)
+        self.assertEquals(stats['cancelled'], 0)
+        self.assertEquals(stats['compactions'], 1)
+        self.current_time += 10 + count
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, [count - 1])
+
+    def test_cancelled_head_dropped(self):
+        scheduler = eventloop.Scheduler()
+        self.add_timeout(scheduler, 1, 'first').cancel()
+        self.add_timeout(scheduler, 2, 'second')
+        self.assertEquals(scheduler.next_timeout(), 2)
+        self.assertEquals(scheduler.get_stats()['cancelled'], 0)
+
+    def test_timer_wheel(self):
+        scheduler = eventloop.Scheduler(use_timer_wheel=True)
+        long_delay = eventloop.TIMER_WHEEL_MIN_DELAY + 0.5
+        self.add_timeout(scheduler, 0.5, 'short')
+        self.add_timeout(scheduler, long_delay, 'long')
+        self.add_timeout(scheduler, 10000.25, 'very-long')
+        self.add_timeout(scheduler, long_delay, 'cancelled').cancel()
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['heap_size'], 1)
+        self.assertEquals(stats['timer_wheel_size'], 3)
+        self.current_time += 1
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, ['short'])
+        # The wheel should move long timeouts to the heap, but they
+        # shouldn't run early
+        self.current_time += long_delay - 1.25
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, ['short'])
+        self.assertEquals(scheduler.next_timeout(), 0.25)
+        self.current_time += 0.5
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, ['short', 'long'])
+        # timeouts more than a full turn of the wheel away should wait for
+        # their turn.
+        self.current_time = 1000.0 + 10000
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, ['short', 'long'])
+        self.current_time += 0.5
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, ['short', 'long', 'very-long'])
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['heap_size'], 0)
+        self.assertEquals(stats['timer_wheel_size'], 0)
+
+    def test_timer_wheel_next_timeout(self):
+        # We shouldn't wake up for each tick of the wheel, just when a
+        # timeout is coming up.
+        scheduler = eventloop.Scheduler(use_timer_wheel=True)
+        self.add_timeout(scheduler, 100.25, 'first')
+        self.add_timeout(scheduler, 200.25, 'second')
+        self.assertEquals(scheduler.next_timeout(), 100.25)
+        self.add_timeout(scheduler, 50.25, 'earlier')
+        self.assertEquals(scheduler.next_timeout(), 50.25)
+        self.current_time += 50.5
+        self.run_timeouts(scheduler)
+        self.assertEquals(self.calls, ['earlier'])
+        self.assertEquals(scheduler.next_timeout(), 49.75)
+        # timeouts more than a turn of the wheel away should only make us
+        # check at the start of the next turn
+        scheduler = eventloop.Scheduler(use_timer_wheel=True)
+        self.add_timeout(scheduler, 10000, 'very-long')
+        self.assert_(500 < scheduler.next_timeout() < 600)
+
+    def test_cancel_takes_lock(self):
+        scheduler = eventloop.Scheduler(use_timer_wheel=True)
+        dcs = [self.add_timeout(scheduler, 1, 'heap'),
+               self.add_timeout(scheduler, 100, 'wheel')]
+        for dc in dcs:
+            scheduler.lock.acquire()
+            thread = threading.Thread(target=dc.cancel)
+            thread.start()
+            thread.join(0.1)
+            self.assert_(thread.isAlive())
+            scheduler.lock.release()
+            thread.join()
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['cancelled'], 1)
+        self.assertEquals(stats['timer_wheel_cancelled'], 1)
+
+    def test_timer_wheel_compaction(self):
+        scheduler = eventloop.Scheduler(use_timer_wheel=True)
+        delay = eventloop.TIMER_WHEEL_MIN_DELAY * 2
+        count = eventloop.SCHEDULER_COMPACT_MIN * 2
+        for i in xrange(count):
+            self.add_timeout(scheduler, delay, i).cancel()
+        self.add_timeout(scheduler, delay, 'last')
+        self.assertEquals(scheduler.get_stats()['timer_wheel_cancelled'],
+                          count)
+        scheduler.next_timeout()
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['timer_wheel_size'], 1)
+        self.assertEquals(stats['timer_wheel_cancelled'], 0)
+        self.assertEquals(stats['compactions'], 1)
@@ -177,6 +177,33 @@ class EmptyDBTest(StoreDatabaseTest):
             app.db.cursor.execute("SELECT count(*) FROM %s" % table)
             self.assertEquals(app.db.cursor.fetchone()[0], correct_count)
 
+class FullTextSearchTriggerTest(StoreDatabaseTest):
+    def setUp(self):
+        StoreDatabaseTest.setUp(self)
+        self.feed = feed.Feed(u"dtv:savedsearch/all?q=dogs")
+        self.item = item.Item(item.FeedParserValues({'title': u'item1'}),
+                       feed_id=self.feed.id)
+        app.db.finish_transaction()
+
+    def rows_changed(self, sql):
+        # total_changes includes rows changed by triggers
+        start = app.db.connection.total_changes
+        app.db.cursor.execute(sql, (self.item.id,))
+        return app.db.connection.total_changes - start
+
+    def test_unindexed_column(self):
+        # changing a column that's not in item_fts shouldn't touch it
+        self.assertEquals(self.rows_changed(
+            "UPDATE item SET resume_time=10 WHERE id=?"), 1)
+
+    def test_indexed_column(self):
+        # changing title should delete and re-insert the item_fts row
+        self.assert_(self.rows_changed(
+            "UPDATE item SET title='new title' WHERE id=?") > 1)
+        app.db.cursor.execute("SELECT docid FROM item_fts "
+                              "WHERE item_fts MATCH 'new'")
+        self.assertEquals(app.db.cursor.fetchall(), [(self.item.id,)])
+
 class DBUpgradeTest(StoreDatabaseTest):
     def setUp(self):
         StoreDatabaseTest.setUp(self)
@@ -548,6 +575,218 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+class PendingUpdateTest(FakeSchemaTest):
+    # Test that UPDATE statements get coalesced until the end of the
+    # transaction
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        self.executed = []
+        real_time_execute = app.db._time_execute
+        def time_execute_intercept(sql, values, many):
+            self.executed.append((sql, values, many))
+            return real_time_execute(sql, values, many)
+        app.db._time_execute = time_execute_intercept
+
+    def update_statements(self):
+        return [(sql, values, many) for (sql, values, many) in self.executed
+                if sql.startswith("UPDATE")]
+
+    def test_updates_coalesced(self):
+        for i in xrange(10):
+            self.lee.age = 30 + i
+            self.lee.signal_change()
+        # nothing should be sent until we finish the transaction
+        self.assertEquals(self.update_statements(), [])
+        app.db.finish_transaction()
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(len(updates[0][1]), 1)
+        self.assertEquals(self.reload_object(self.lee).age, 39)
+
+    def test_updates_grouped(self):
+        lee2 = Human(u"lee2", 25, 1.4, [], {})
+        app.db.finish_transaction()
+        self.executed = []
+        self.lee.age = 30
+        self.lee.signal_change()
+        lee2.age = 31
+        lee2.signal_change()
+        app.db.finish_transaction()
+        # both rows changed the same columns, so they should be sent with
+        # one executemany() call.
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 1)
+        self.assert_(updates[0][2])
+        self.assertEquals(len(updates[0][1]), 2)
+        self.assertEquals(self.reload_object(self.lee).age, 30)
+        self.assertEquals(self.reload_object(lee2).age, 31)
+
+    def test_only_changed_columns_written(self):
+        self.lee.age = 30
+        self.lee.signal_change()
+        self.lee.name = u'lee2'
+        self.lee.signal_change()
+        app.db.finish_transaction()
+        sql = self.update_statements()[0][0]
+        self.assert_('age=?' in sql)
+        self.assert_('name=?' in sql)
+        self.assert_('meters_tall=?' not in sql)
+        # unchanged non-simple columns shouldn't be written either
+        self.assert_('high_scores=?' not in sql)
+        self.assert_('stuff=?' not in sql)
+
+    def test_in_place_change_written(self):
+        self.lee.high_scores[u'pong'] = 5
+        self.lee.signal_change()
+        app.db.finish_transaction()
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 1)
+        self.assert_('high_scores=?' in updates[0][0])
+        self.assert_('age=?' not in updates[0][0])
+        self.assertEquals(self.reload_object(self.lee).high_scores,
+                          {u'virtual bowling': 212, u'pong': 5})
+        # signaling a change without changing anything writes nothing
+        self.executed = []
+        lee = Human.get_by_id(self.lee.id)
+        lee.signal_change()
+        app.db.finish_transaction()
+        self.assertEquals(self.update_statements(), [])
+
+    def test_in_place_change_after_rollback(self):
+        self.lee.high_scores[u'pong'] = 5
+        self.lee.signal_change()
+        app.db.flush_pending_updates()
+        app.db.finish_transaction(commit=False)
+        # The ROLLBACK undid our write, so the next update should write the
+        # column again, even though it's the same value.
+        self.lee.signal_change()
+        app.db.finish_transaction()
+        self.assertEquals(self.reload_object(self.lee).high_scores,
+                          {u'virtual bowling': 212, u'pong': 5})
+
+    def test_sql_reused(self):
+        lee2 = Human(u"lee2", 25, 1.4, [], {})
+        app.db.finish_transaction()
+        self.lee.age = 30
+        self.lee.signal_change()
+        app.db.finish_transaction()
+        lee2.age = 31
+        lee2.signal_change()
+        app.db.finish_transaction()
+        updates = self.update_statements()
+        self.assertEquals(len(updates), 2)
+        self.assert_(updates[0][0] is updates[1][0])
+
+    def test_query_sees_pending_updates(self):
+        self.lee.name = u'new lee'
+        self.lee.signal_change()
+        view = Human.make_view('name=?', (u'new lee',))
+        self.assertEquals(view.count(), 1)
+
+    def test_update_then_remove(self):
+        self.lee.age = 30
+        self.lee.signal_change()
+        self.lee.remove()
+        app.db.finish_transaction()
+        self.assertEquals(self.update_statements(), [])
+        self.assertEquals(Human.make_view().count(), 0)
+
+    def test_update_missing_row(self):
+        # Updating an object whose row was removed should still fail
+        lee2 = Human(u"lee2", 25, 1.4, [], {})
+        app.db.finish_transaction()
+        app.db.cursor.execute("DELETE FROM human WHERE id=?", (self.lee.id,))
+        self.lee.age = 30
+        self.lee.signal_change()
+        lee2.age = 30
+        lee2.signal_change()
+        app.controller.failed_soft_okay = True
+        app.db.finish_transaction()
+        self.check_failed_soft_count(1)
+        self.assertEquals(self.reload_object(lee2).age, 30)
+
+    def test_rollback(self):
+        self.lee.age = 30
+        self.lee.signal_change()
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(self.update_statements(), [])
+        self.assertEquals(self.reload_object(self.lee).age, 25)
+
+class TransactionRetryTest(FakeSchemaTest):
+    # Test re-running a transaction after an error like SQLITE_FULL
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        app.db.transaction_replay_limit = 10
+        app.db.error_handler = mock.Mock()
+        app.db.error_handler.handle_save_error.return_value = (
+            storedatabase.LiveStorageErrorHandler.ACTION_RETRY)
+        self.insert_count = 0
+        self.fail_on_insert = None
+        real_time_execute = app.db._time_execute
+        def time_execute_intercept(sql, values, many):
+            if sql.startswith("INSERT"):
+                self.insert_count += 1
+                if self.insert_count == self.fail_on_insert:
+                    raise sqlite3.OperationalError("database or disk is full")
+            return real_time_execute(sql, values, many)
+        app.db._time_execute = time_execute_intercept
+
+    def make_humans(self, count):
+        for i in xrange(count):
+            Human(u"human-%d" % i, i, 1.5, [], {})
+
+    def count_humans(self):
+        return Human.make_view("name LIKE 'human-%'").count()
+
+    def test_statements_bounded(self):
+        self.make_humans(35)
+        self.assert_(len(app.db._statements_in_transaction) <= 10)
+        app.db.finish_transaction()
+        self.assertEquals(self.count_humans(), 35)
+
+    def test_commit_at_end_of_event(self):
+        # going over the replay limit shouldn't commit in the middle of an
+        # event
+        self.make_humans(35)
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(self.count_humans(), 0)
+
+    def test_error_retry(self):
+        self.fail_on_insert = 5
+        with self.allow_warnings():
+            self.make_humans(8)
+        app.db.finish_transaction()
+        self.assertEquals(app.db.error_handler.handle_save_error.call_count, 1)
+        self.assertEquals(
+            app.db.error_handler.handle_save_succeeded.call_count, 1)
+        # we should have re-run inserts 1-5
+        self.assertEquals(self.insert_count, 13)
+        self.reload_test_database()
+        self.assertEquals(self.count_humans(), 8)
+
+    def test_error_past_replay_limit(self):
+        self.fail_on_insert = 25
+        with self.allow_warnings():
+            self.make_humans(30)
+        app.db.finish_transaction()
+        self.assertEquals(app.db.error_handler.handle_save_error.call_count, 1)
+        # We couldn't re-run the first 25 inserts.  They should have been
+        # rolled back together rather than partly committed.
+        self.assertEquals(self.insert_count, 30)
+        self.reload_test_database()
+        self.assertEquals(self.count_humans(), 5)
+
+    def test_executemany_counts_rows(self):
+        # bulk inserts count each row towards the replay limit
+        app.bulk_sql_manager.start()
+        self.make_humans(15)
+        app.bulk_sql_manager.finish()
+        self.assertEquals(app.db._statements_in_transaction, [])
+        app.db.finish_transaction()
+        self.assertEquals(self.count_humans(), 15)
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -623,7 +862,8 @@ class CorruptReprTest(FakeSchemaTest):
         self.assertEqual(restored_lee.stuff, 'testing123')
         app.db.cursor.execute("SELECT stuff from human WHERE name='lee'")
         row = app.db.cursor.fetchone()
-        self.assertEqual(row[0], "'testing123'")
+        self.assertEqual(row[0], app.db._converter._repr_to_sql('testing123',
+                                                                None))
 
     def test_repr_failure_no_handler(self):
         app.db.cursor.execute("UPDATE pcf_programmer SET stuff='{baddata' "
@@ -650,6 +890,85 @@ tm_isdst=0)}"""
         self.assertEquals(val, {"updated_parsed":
                                 (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
 
+    def test_binary_repr(self):
+        converter = storedatabase.SQLiteConverter()
+        values = [
+            'abc',
+            {u'foo': [1, 2L, 3.5, None, True], 'bar': (u'x', 'y')},
+            {'updated_parsed': datetime(2009, 6, 5, 1, 30, 0, 123)},
+            [(datetime(2011, 1, 2), {1: datetime(2011, 1, 3)})],
+            ]
+        for value in values:
+            sql_value = converter._repr_to_sql(value, None)
+            self.assert_(isinstance(sql_value, buffer))
+            self.assertEquals(converter._repr_from_sql(sql_value, None),
+                              value)
+        # struct_time objects are stored as 9-tuples, like with the old
+        # repr() format
+        value = {'updated_parsed': time.struct_time(
+            (2009, 6, 5, 1, 30, 0, 4, 156, 0))}
+        sql_value = converter._repr_to_sql(value, None)
+        val = converter._repr_from_sql(sql_value, None)
+        self.assertEquals(val, {"updated_parsed":
+                                (2009, 6, 5, 1, 30, 0, 4, 156, 0)})
+        self.assertEquals(type(val['updated_parsed']), tuple)
+
+    def test_binary_repr_subclasses(self):
+        # marshal accepts subclasses of builtin types, but doesn't always
+        # store them correctly.  Make sure we convert them.
+        class UnicodeSubclass(unicode):
+            pass
+        class DictSubclass(dict):
+            pass
+        converter = storedatabase.SQLiteConverter()
+        value = DictSubclass({u'title': UnicodeSubclass(u'abc'),
+                              'list': [UnicodeSubclass(u'def')]})
+        sql_value = converter._repr_to_sql(value, None)
+        restored = converter._repr_from_sql(sql_value, None)
+        self.assertEquals(restored, {u'title': u'abc', 'list': [u'def']})
+        self.assertEquals(type(restored), dict)
+        self.assertEquals(type(restored[u'title']), unicode)
+        self.assertEquals(type(restored['list'][0]), unicode)
+        sql_value = converter._repr_to_sql(UnicodeSubclass(u'abc'), None)
+        restored = converter._repr_from_sql(sql_value, None)
+        self.assertEquals(restored, u'abc')
+        self.assertEquals(type(restored), unicode)
+
+    def test_legacy_repr(self):
+        converter = storedatabase.SQLiteConverter(binary_repr=False)
+        value = {u'foo': [1, 2], 'bar': datetime(2009, 6, 5, 1, 30, 0)}
+        sql_value = converter._repr_to_sql(value, None)
+        self.assertEquals(sql_value, repr(value))
+        self.assertEquals(converter._repr_from_sql(sql_value, None), value)
+
+    def test_unknown_format(self):
+        converter = storedatabase.SQLiteConverter()
+        self.assertRaises(ValueError, converter._repr_from_sql,
+                          buffer('\xffbaddata'), None)
+
+class LegacyReprMigrationTest(FakeSchemaTest):
+    # Test that values stored with repr() get converted as objects are
+    # restored.
+    def test_migrate_on_restore(self):
+        stuff = {'a': [1, 2], 'b': datetime(2011, 1, 2)}
+        app.db.cursor.execute("UPDATE human SET stuff=?, high_scores=? "
+                              "WHERE name='lee'",
+                              (repr(stuff), repr({u'pong': 5})))
+        restored_lee = self.reload_object(self.lee)
+        self.assertEquals(restored_lee.stuff, stuff)
+        self.assertEquals(restored_lee.high_scores, {u'pong': 5})
+        app.db.cursor.execute("SELECT stuff, high_scores FROM human "
+                              "WHERE name='lee'")
+        row = app.db.cursor.fetchone()
+        self.assert_(isinstance(row[0], buffer))
+        self.assert_(isinstance(row[1], buffer))
+        self.assertEquals(app.db._converter._repr_from_sql(row[0], None),
+                          stuff)
+        # the migrated values should be written out like any other update
+        app.db.finish_transaction()
+        self.reload_test_database()
+        self.assertEquals(Human.get_by_id(self.lee.id).stuff, stuff)
+
 class CorruptDDBObjectReprTest(StoreDatabaseTest):
     # test corrupt SchemaReprContainer columns in real DDBObjects
     def setUp(self):
@@ -1,6 +1,8 @@
 import os
+import struct
 import time
 import Queue
+from cStringIO import StringIO
 
 from miro import app
 from miro import moviedata
@@ -8,7 +10,8 @@ from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (MiroTestCase, EventLoopTest,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -226,6 +229,124 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class FakePipe(object):
+    """Pipe-like object that stores what's written to it."""
+    def __init__(self):
+        self.data = StringIO()
+        self.write_count = 0
+
+    def write(self, data):
+        self.write_count += 1
+        self.data.write(data)
+
+    def flush(self):
+        pass
+
+    def reader(self):
+        return StringIO(self.data.getvalue())
+
+class PipeProtocolTest(MiroTestCase):
+    """Test the message format used on the subprocess pipes."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.pipe = FakePipe()
+        self.old_large_payload_size = subprocessmanager.LARGE_PAYLOAD_SIZE
+
+    def tearDown(self):
+        subprocessmanager.LARGE_PAYLOAD_SIZE = self.old_large_payload_size
+        MiroTestCase.tearDown(self)
+
+    def test_round_trip(self):
+        feed = {'entries': [{'title': u'entry %d' % i} for i in range(10)],
+                'bozo': False}
+        for obj in (SawEvent('startup'), feed, None):
+            subprocessmanager._dump_obj(obj, self.pipe)
+        reader = self.pipe.reader()
+        self.assertEquals(subprocessmanager._load_obj(reader).event,
+                          'startup')
+        self.assertEquals(subprocessmanager._load_obj(reader), feed)
+        self.assertEquals(subprocessmanager._load_obj(reader), None)
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._load_obj, reader)
+
+    def test_binary_pickle(self):
+        subprocessmanager._dump_obj(u'foo', self.pipe)
+        data = self.pipe.data.getvalue()
+        start = subprocessmanager.FRAME_HEADER_SIZE
+        # binary pickles start with the PROTO opcode
+        self.assertEquals(data[start:start+2],
+                          '\x80' + chr(subprocessmanager.PICKLE_PROTOCOL))
+
+    def test_large_payload(self):
+        subprocessmanager.LARGE_PAYLOAD_SIZE = 100
+        obj = 'a' * 1000
+        subprocessmanager._dump_obj(obj, self.pipe)
+        data = self.pipe.data.getvalue()
+        header_size = subprocessmanager.FRAME_HEADER_SIZE
+        frame_type, size = struct.unpack(subprocessmanager.FRAME_HEADER,
+                                         data[:header_size])
+        self.assertEquals(frame_type, subprocessmanager.FRAME_FILE)
+        path = data[header_size:]
+        self.assertEquals(len(path), size)
+        self.assert_(os.path.exists(path))
+        # loading the object should read and delete the file
+        self.assertEquals(subprocessmanager._load_obj(self.pipe.reader()),
+                          obj)
+        self.assert_(not os.path.exists(path))
+
+    def test_unknown_frame_type(self):
+        self.pipe.write(struct.pack(subprocessmanager.FRAME_HEADER, 100, 0))
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._load_obj, self.pipe.reader())
+
+    def test_handshake(self):
+        subprocessmanager._send_handshake(self.pipe)
+        # this shouldn't raise an error
+        subprocessmanager._read_handshake(self.pipe.reader())
+
+    def test_handshake_mismatch(self):
+        self.pipe.write(struct.pack(subprocessmanager.HANDSHAKE_FORMAT,
+                                    subprocessmanager.HANDSHAKE_MAGIC,
+                                    subprocessmanager.PROTOCOL_VERSION + 1,
+                                    subprocessmanager.PICKLE_PROTOCOL))
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._read_handshake,
+                          self.pipe.reader())
+
+    def test_handshake_from_old_process(self):
+        # processes from before the handshake start with a frame
+        self.pipe.write(struct.pack("Q", 4) + 'N.')
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._read_handshake,
+                          self.pipe.reader())
+
+    def test_send_message_coalesces(self):
+        manager = subprocessmanager.SubprocessManager(TestMessage,
+                TestSubprocessResponder(), TestSubprocessHandler)
+        manager.process = mock.Mock()
+        manager.process.stdin = self.pipe
+        manager.is_running = True
+        for i in range(3):
+            manager.send_message(i)
+        # messages should be queued until flush_messages() runs
+        self.assertEquals(self.pipe.write_count, 0)
+        manager.flush_messages()
+        self.assertEquals(self.pipe.write_count, 1)
+        reader = self.pipe.reader()
+        self.assertEquals([subprocessmanager._load_obj(reader)
+                           for i in range(3)], [0, 1, 2])
+
+    def test_proxy_writes_pending_frames(self):
+        proxy = subprocessmanager.PipeMessageProxy(self.pipe)
+        # simulate another thread queueing a frame while we were writing
+        proxy.pending_frames.append(subprocessmanager._encode_obj('first'))
+        proxy.handle('second')
+        self.assertEquals(self.pipe.write_count, 1)
+        self.assertEquals(proxy.pending_frames, [])
+        reader = self.pipe.reader()
+        self.assertEquals(subprocessmanager._load_obj(reader), 'first')
+        self.assertEquals(subprocessmanager._load_obj(reader), 'second')
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -243,9 +364,9 @@ class WorkerProcessTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         # override the normal handler class with our own
-        workerprocess._subprocess_manager.handler_class = (
+        workerprocess._worker_pool.handler_class = (
                 UnittestWorkerProcessHandler)
-        workerprocess._subprocess_manager.restart_delay = 0
+        workerprocess._worker_pool.restart_delay = 0
         self.reset_results()
 
     def tearDown(self):
@@ -288,6 +409,20 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+    def test_feedparser_file(self):
+        # test feedparser reading the feed from a file
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        workerprocess.startup()
+        msg = workerprocess.FeedparserTask(path=path, charset='utf-8')
+        workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(4.0)
+        self.check_successful_result()
+        self.assertNotEquals(len(self.result['entries']), 0)
+        for entry in self.result['entries']:
+            self.assert_('content' not in entry.keys())
+        self.assert_('peak_rss' in self.result)
+
     def test_feedparser_error(self):
         # test feedparser failing to parse a feed
         workerprocess.startup()
@@ -299,17 +434,39 @@ class FeedParserTest(WorkerProcessTest):
 
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
-        workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        workerprocess.startup(process_count=1)
+        manager = workerprocess._worker_pool.managers[0]
+        original_pid = manager.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        manager.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, manager.process.pid)
         self.check_successful_result()
 
+    def test_pool(self):
+        # test running tasks with several processes
+        workerprocess.startup(process_count=2)
+        managers = workerprocess._worker_pool.managers
+        self.assertEquals(len(managers), 2)
+        self.assertNotEqual(managers[0].process.pid, managers[1].process.pid)
+        results = []
+        def callback(msg, result):
+            results.append(result)
+            if len(results) == 10:
+                self.stopEventLoop(abnormal=False)
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        html = open(path).read()
+        for i in range(10):
+            workerprocess.send(workerprocess.FeedparserTask(html), callback,
+                               self.errback)
+        self.runEventLoop(8.0)
+        if self.error is not None:
+            raise self.error
+        self.assertEquals(len(results), 10)
+
     def test_queue_before_start(self):
         # test sending tasks before we start the worker process
 
@@ -320,6 +477,120 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class FakeWorkerSubprocessManager(workerprocess.WorkerSubprocessManager):
+    """WorkerSubprocessManager that stores messages instead of sending them
+    to a process.
+    """
+    def __init__(self):
+        workerprocess.WorkerSubprocessManager.__init__(self)
+        self.available = True
+        self.sent = []
+
+    def is_available(self):
+        return self.available
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+class WorkerProcessPoolTest(MiroTestCase):
+    """Test dispatching tasks to the worker processes."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.pool = workerprocess._worker_pool
+        self.pool.tasks_per_process = 2
+        self.managers = [FakeWorkerSubprocessManager(),
+                         FakeWorkerSubprocessManager()]
+        self.pool.managers = self.managers[:]
+        self.finished = []
+
+    def callback(self, msg, result):
+        self.finished.append(msg)
+
+    def send(self, msg):
+        workerprocess.send(msg, self.callback, self.callback)
+        return msg
+
+    def sent_tasks(self, manager):
+        return [msg for msg in manager.sent
+                if isinstance(msg, workerprocess.TaskMessage)]
+
+    def test_dispatch(self):
+        tasks = [self.send(workerprocess.FeedparserTask('feed'))
+                 for i in range(5)]
+        # we should spread the tasks out, but only send tasks_per_process
+        # tasks to each process
+        self.assertEquals(self.sent_tasks(self.managers[0]),
+                          [tasks[0], tasks[2]])
+        self.assertEquals(self.sent_tasks(self.managers[1]),
+                          [tasks[1], tasks[3]])
+        # when a task finishes, the next one should be sent
+        self.pool.task_finished(workerprocess.TaskResult(tasks[1].task_id,
+                                                         None))
+        self.assertEquals(self.finished, [tasks[1]])
+        self.assertEquals(self.sent_tasks(self.managers[1]),
+                          [tasks[1], tasks[3], tasks[4]])
+
+    def test_priority(self):
+        for manager in self.managers:
+            manager.available = False
+        slow = self.send(SlowRunningTask())
+        mutagen = self.send(workerprocess.MutagenTask('/foo.mp3', '/tmp'))
+        feed = self.send(workerprocess.FeedparserTask('feed'))
+        self.assertEquals(self.sent_tasks(self.managers[0]), [])
+        self.managers[0].available = True
+        self.pool.dispatch_tasks()
+        # tasks should be sent in priority order
+        self.assertEquals(self.sent_tasks(self.managers[0]),
+                          [feed, mutagen])
+        self.managers[1].available = True
+        self.pool.dispatch_tasks()
+        self.assertEquals(self.sent_tasks(self.managers[1]), [slow])
+
+    def test_requeue(self):
+        tasks = [self.send(workerprocess.FeedparserTask('feed'))
+                 for i in range(6)]
+        # simulate a process quiting.  Its tasks should go the other
+        # process before any of the tasks still in the queue
+        self.managers[0].available = False
+        self.managers[0].requeue_tasks()
+        self.pool.task_finished(workerprocess.TaskResult(tasks[1].task_id,
+                                                         None))
+        self.assertEquals(self.sent_tasks(self.managers[1]),
+                          [tasks[1], tasks[3], tasks[0]])
+        self.assertEquals(self.managers[0].tasks_in_flight, {})
+        # the next task should be the other one we requeued
+        next_task = self.pool.task_queue.pop_next_task()
+        self.assertEquals(next_task[1], tasks[2])
+
+    def test_result_for_requeued_task(self):
+        task = self.send(workerprocess.FeedparserTask('feed'))
+        self.managers[0].requeue_tasks()
+        result = workerprocess.TaskResult(task.task_id, None)
+        self.pool.task_finished(result)
+        # if a result comes back for a task again, we should ignore it
+        self.pool.task_finished(result)
+        self.assertEquals(self.finished, [task])
+
+    def test_cancel(self):
+        for manager in self.managers:
+            manager.available = False
+        canceled = self.send(workerprocess.MutagenTask('/foo.mp3', '/tmp'))
+        other = self.send(workerprocess.MutagenTask('/bar.mp3', '/tmp'))
+        self.managers[0].available = True
+        workerprocess.cancel_tasks_for_files(['/foo.mp3'])
+        # we should remove the task from our queue and forget about it
+        self.assert_(canceled.task_id not in
+                     workerprocess._miro_task_queue.tasks_in_progress)
+        self.pool.dispatch_tasks()
+        self.assertEquals(self.sent_tasks(self.managers[0])[-1], other)
+        # we should tell the processes that are running to cancel it
+        cancel_messages = [msg for msg in self.managers[0].sent
+                           if isinstance(msg,
+                                         workerprocess.CancelFileOperations)]
+        self.assertEquals(len(cancel_messages), 1)
+        self.assertEquals(cancel_messages[0].paths, ['/foo.mp3'])
+        self.assertEquals(self.managers[1].sent, [])
+
 class MovieDataTest(WorkerProcessTest):
 
     def setUp(self):
@@ -425,4 +696,3 @@ class MutagenTest(WorkerProcessTest):
 
 # TODO:
 #   Test task priority system in worker process
-#   Test that the CancelFileOperations message is handled properly
@@ -5,13 +5,18 @@ The code here is based off of the standard SimpleHTTPServer code.
 
 
 import BaseHTTPServer
+import gzip
 import hashlib
 import cgi
 import os
 import posixpath
 import urllib
 import socket
+import SocketServer
 import threading
+import time
+import zlib
+from cStringIO import StringIO
 
 from miro.plat import utils
 from miro.plat import resources
@@ -55,19 +60,31 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if self.start_pos > 0:
                     f.seek(self.start_pos, os.SEEK_CUR)
                 if self.end_pos > 0:
-                    count = self.end_pos - self.start_pos
+                    count = self.end_pos - max(self.start_pos, 0) + 1
                 else:
                     count = -1
                 data = f.read(count)
                 if self.server.pause_after >= 0:
                     data = data[:self.server.pause_after]
-                self.wfile.write(data)
+                self.write_data(data)
             f.close()
         if self.server.close_connection:
             self.close_connection = 1
             self.rfile.close()
             self.wfile.close()
 
+    def write_data(self, data):
+        rate = self.server.throttle_rate
+        if rate is None:
+            self.wfile.write(data)
+            return
+        # send 10 chunks a second
+        chunk_size = max(rate // 10, 1)
+        for pos in xrange(0, len(data), chunk_size):
+            self.wfile.write(data[pos:pos+chunk_size])
+            self.wfile.flush()
+            time.sleep(0.1)
+
     def do_GET(self):
         """Serve a GET request."""
         self.server.last_info = {
@@ -217,7 +234,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         else:
             code = 200
             path = self.translate_path(self.path)
-        if 'range' in self.headers and self.server.allow_resume:
+        if (code == 200 and 'range' in self.headers and
+                self.server.allow_resume):
             range = self.headers['range']
             if range.startswith("bytes="):
                 byte_range = range[len('bytes='):]
@@ -227,22 +245,30 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if end != '':
                     self.end_pos = int(end)
                 code = 206
-                headers_to_send.append(('Content-Range', range))
         f = None
         try:
             f = open(path, 'rb')
         except IOError:
             self.send_error(404, "File not found")
             return None
+        fs = os.fstat(f.fileno())
+        length = fs[6]
+        encoding = self.choose_content_encoding(code)
+        if encoding is not None:
+            f = self.compress_file(f, encoding)
+            length = len(f.getvalue())
+            headers_to_send.append(('Content-Encoding', encoding))
         self.send_response(code)
         if location_header is not None:
             self.send_header("Location", location_header)
-        fs = os.fstat(f.fileno())
-        length = fs[6]
-        if self.end_pos > 0:
-            length = min(self.end_pos, length)
-        if self.start_pos > 0:
-            length -= self.start_pos
+        if code == 206:
+            total_size = length
+            last_pos = length - 1
+            if self.end_pos > 0:
+                last_pos = min(self.end_pos, last_pos)
+            length = last_pos - max(self.start_pos, 0) + 1
+            headers_to_send.append(('Content-Range', 'bytes %d-%d/%d' % (
+                max(self.start_pos, 0), last_pos, total_size)))
         if 'content-length' not in self.server.headers_to_send:
             self.send_header("Content-Length", str(length))
         self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
@@ -253,6 +279,30 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
         return f
 
+    def choose_content_encoding(self, code):
+        if code != 200 or not self.server.compression:
+            return None
+        accept_encoding = self.headers.get('accept-encoding', '')
+        accepted = [e.strip() for e in accept_encoding.split(',')]
+        for encoding in self.server.compression:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def compress_file(self, f, encoding):
+        data = f.read()
+        f.close()
+        if encoding == 'gzip':
+            out = StringIO()
+            gzip_file = gzip.GzipFile(fileobj=out, mode='wb')
+            gzip_file.write(data)
+            gzip_file.close()
+            return StringIO(out.getvalue())
+        elif encoding == 'deflate':
+            return StringIO(zlib.compress(data))
+        else:
+            raise ValueError("Unknown encoding: %s" % encoding)
+
     def parse_client_digest_auth(self):
         try:
             client_auth = self.headers['authorization']
@@ -283,6 +333,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         path = path.split('?',1)[0]
         path = path.split('#',1)[0]
         path = posixpath.normpath(urllib.unquote(path))
+        if path.lstrip('/') in self.server.extra_files:
+            return self.server.extra_files[path.lstrip('/')]
         return resources.path("testdata/httpserver/%s" % path)
 
     def log_request(self, code):
@@ -291,10 +343,20 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_error(self, *args):
         pass
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
 class HTTPServer(threading.Thread):
-    def __init__(self):
+    def __init__(self, threaded=False):
+        """Create a HTTPServer
+
+        :param threaded: handle each connection in its own thread.  Use this
+            to test clients that open several connections at once.
+        """
         threading.Thread.__init__(self)
         self.event = threading.Event()
+        self.threaded = threaded
 
     def start(self):
         threading.Thread.start(self)
@@ -312,7 +374,11 @@ class HTTPServer(threading.Thread):
         else:
             utils.finish_thread_loop(self)
             raise AssertionError("Can't find an open port")
-        self.httpserver = BaseHTTPServer.HTTPServer(('', self.port),
+        if self.threaded:
+            server_class = ThreadingHTTPServer
+        else:
+            server_class = BaseHTTPServer.HTTPServer
+        self.httpserver = server_class(('', self.port),
                 MiroHTTPRequestHandler)
         self.httpserver.allow_head = True
         self.httpserver.headers_to_send = []
@@ -321,6 +387,9 @@ class HTTPServer(threading.Thread):
         self.httpserver.allow_resume = True
         self.httpserver.pause_after = -1
         self.httpserver.custom_redirect_url = None
+        self.httpserver.compression = []
+        self.httpserver.throttle_rate = None
+        self.httpserver.extra_files = {}
         self.event.set()
         try:
             self.httpserver.serve_forever()
@@ -375,3 +444,18 @@ class HTTPServer(threading.Thread):
 
     def custom_redirect_url(self, url):
         self.httpserver.custom_redirect_url = url
+
+    def enable_compression(self, *encodings):
+        """Compress responses if the client accepts one of encodings."""
+        self.httpserver.compression = list(encodings)
+
+    def throttle(self, bytes_per_second):
+        """Limit how fast each connection sends response bodies.
+
+        Pass None to remove the limit.
+        """
+        self.httpserver.throttle_rate = bytes_per_second
+
+    def add_file(self, name, path):
+        """Serve the file at path as /name."""
+        self.httpserver.extra_files[name] = path
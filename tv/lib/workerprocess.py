@@ -32,13 +32,25 @@
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
 tasks to this process.  See #17328 for more details.  Right now this just
 includes feedparser, but we could pretty easily extend this to other tasks.
+
+We run a pool of worker processes, by default one for each logical CPU.  The
+main process keeps tasks in a WorkerTaskQueue and hands them to the processes
+as they have room, so tasks get dispatched in the same priority order that the
+worker threads inside each process use.
 """
 
 from collections import deque, namedtuple
 import itertools
 import logging
+import sys
 import threading
 
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
 from miro import clock
 from miro import eventloop
 from miro import feedparserutil
@@ -47,6 +59,7 @@ from miro import messagetools
 from miro import moviedata
 from miro import subprocessmanager
 from miro import util
+from miro.xhtmltools import fix_xml_header
 
 from miro.plat import utils
 
@@ -71,10 +84,29 @@ class TaskMessage(WorkerMessage):
         self.task_id = TaskMessage._id_counter.next()
 
 class FeedparserTask(TaskMessage):
+    """Parse a feed.
+
+    Either html is the feed data, or path is a file that contains it.  For
+    large feeds, using path avoids sending the data through the pipe.  If
+    charset is given, the XML header of the data from path will be fixed to
+    use it.
+
+    The result is the parsed feed, with only the entry values that the
+    backend uses (see feedparserutil.strip_entries()).  It also has a
+    "peak_rss" key with the peak RSS of the worker process in bytes, after
+    the parse, or None if we can't calculate it.
+    """
     priority = 20
-    def __init__(self, html):
+    def __init__(self, html=None, path=None, charset=None):
         TaskMessage.__init__(self)
         self.html = html
+        self.path = path
+        self.charset = charset
+
+    def __str__(self):
+        if self.path is not None:
+            return 'FeedparserTask (path: %s)' % self.path
+        return 'FeedparserTask'
 
 class MovieDataProgramTask(TaskMessage):
     priority = 10
@@ -192,8 +224,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque((method, msg)
+                               for (method, msg) in self.main_thread_tasks
+                               if msg.source_path not in path_set)
         self.main_thread_tasks = filtered_tasks
         return None
 
@@ -209,10 +242,26 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
     # worker threads, so they should only call thread-safe functions
 
     def handle_feedparser_task(self, msg):
-        parsed_feed = feedparserutil.parse(msg.html)
+        if msg.path is not None:
+            f = open(msg.path, 'rb')
+            try:
+                html = f.read()
+            finally:
+                f.close()
+            if msg.charset is not None:
+                html = fix_xml_header(html, msg.charset)
+        else:
+            html = msg.html
+        parsed_feed = feedparserutil.parse(html)
+        # don't keep the document around while we strip the entries
+        del html
+        feedparserutil.strip_entries(parsed_feed)
         # bozo_exception is sometimes C object that is not picklable.  We
         # don't use it anyways, so just unset the value
         parsed_feed['bozo_exception'] = None
+        parsed_feed['peak_rss'] = peak_rss()
+        logging.info("%s: %d entries, peak RSS: %s", msg,
+                     len(parsed_feed['entries']), parsed_feed['peak_rss'])
         return parsed_feed
 
     def handle_mutagen_task(self, msg):
@@ -242,8 +291,11 @@ class _SinglePriorityQueue(object):
         self.fifo_cycler = itertools.cycle(self.fifo_map.values())
         self.fifo_count = len(self.fifo_map)
 
-    def add_task(self, handler_method, msg):
-        self.fifo_map[msg.__class__].append((handler_method, msg))
+    def add_task(self, handler_method, msg, front=False):
+        if front:
+            self.fifo_map[msg.__class__].appendleft((handler_method, msg))
+        else:
+            self.fifo_map[msg.__class__].append((handler_method, msg))
 
     def get_next_task(self):
         for i, fifo in enumerate(self.fifo_cycler):
@@ -258,12 +310,15 @@ class _SinglePriorityQueue(object):
 
         :param filterfunc: function to determine if messages should stay
         :param message_class: type of messages to filter
+        :returns: list of messages removed
         """
         fifo = self.fifo_map[message_class]
         new_items = tuple((method, msg) for (method, msg) in fifo
                          if filterfunc(msg))
+        removed = [msg for (method, msg) in fifo if not filterfunc(msg)]
         fifo.clear()
         fifo.extend(new_items)
+        return removed
 
 class WorkerTaskQueue(object):
     """Store the pending tasks for the worker process.
@@ -292,10 +347,15 @@ class WorkerTaskQueue(object):
             self.queues_by_priority.append(queue)
             self.queue_map[queue.priority] = queue
 
-    def add_task(self, handler_method, msg):
-        """Add a new task to the queue.  """
+    def add_task(self, handler_method, msg, front=False):
+        """Add a new task to the queue.
+
+        :param front: put the task ahead of the other tasks of its class.
+        Use this to requeue tasks that were taken out of the queue, but not
+        finished.
+        """
         with self.condition:
-            self.queue_map[msg.priority].add_task(handler_method, msg)
+            self.queue_map[msg.priority].add_task(handler_method, msg, front)
             self.condition.notify()
 
     def get_next_task(self):
@@ -322,6 +382,15 @@ class WorkerTaskQueue(object):
                 return None
             return self._get_next_task()
 
+    def pop_next_task(self):
+        """Get the next task to be processed without blocking.
+
+        :returns: (handler_method, message) tuple, or None if there are no
+        tasks in the queue
+        """
+        with self.condition:
+            return self._get_next_task()
+
     def _get_next_task(self):
         for queue in self.queues_by_priority:
             next_for_queue = queue.get_next_task()
@@ -331,15 +400,20 @@ class WorkerTaskQueue(object):
         return None
 
     def cancel_file_operations(self, path_set):
-        """Cancels all mutagen/movie data tasks for a list of paths."""
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        :returns: list of messages removed from the queue
+        """
         # Acquire our lock as soon as possible.  We want to prevent other
         # tasks from getting tasks, since they may be about to deleted.
+        removed = []
         with self.condition:
             def filter_func(msg):
                 return msg.source_path not in path_set
             for cls in (MutagenTask, MovieDataProgramTask):
                 queue = self.queue_map[cls.priority]
-                queue.filter_messages(filter_func, cls)
+                removed.extend(queue.filter_messages(filter_func, cls))
+        return removed
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -347,6 +421,19 @@ class WorkerTaskQueue(object):
             self.should_quit = True
             self.condition.notify_all()
 
+def peak_rss():
+    """Get the peak resident set size of this process in bytes.
+
+    :returns: peak RSS, or None if we can't calculate it on this platform
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # OS X reports bytes, everything else uses kilobytes
+        return max_rss
+    return max_rss * 1024
+
 def handle_task(handler_method, msg):
     """Process a TaskMessage."""
     # If we are running movie data, send the MovieDataTaskStatus message.
@@ -388,12 +475,10 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
     def __init__(self):
         subprocessmanager.SubprocessResponder.__init__(self)
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        _worker_pool.dispatch_tasks()
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -404,7 +489,7 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        _worker_pool.task_finished(msg)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -433,44 +518,96 @@ class MiroTaskQueue(object):
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        _worker_pool.add_task(msg)
+
+    def discard_tasks(self, messages):
+        """Forget about tasks that were cancelled before they ran."""
+        for msg in messages:
+            self.tasks_in_progress.pop(msg.task_id, None)
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # We can get results for tasks that we don't know about.
+            # CancelFileOperations is sent to every process, so there's a
+            # result from each of them.  Also, a task that was requeued
+            # because its process quit may have finished anyway.
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
-
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
+# Manage subprocesses
 class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
+    """Manages one of the processes in our pool.
+
+    :ivar tasks_in_flight: maps task_ids to the messages we've sent to the
+    process, but haven't gotten a result for.
+    """
+    def __init__(self, handler_class=WorkerProcessHandler, thread_count=3,
+                 restart_delay=60):
         subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+                WorkerProcessResponder(), handler_class,
+                restart_delay=restart_delay)
+        self.thread_count = thread_count
+        self.tasks_in_flight = {}
         self.check_hung_timeout = None
 
     def _start(self):
+        # tasks that the last process didn't finish get sent again
+        self.requeue_tasks()
         subprocessmanager.SubprocessManager._start(self)
         self.schedule_check_subprocess_hung()
 
+    def _send_startup_info(self):
+        subprocessmanager.SubprocessManager._send_startup_info(self)
+        self.send_message(WorkerStartupInfo(self.thread_count))
+
+    def _on_thread_quit(self, thread):
+        if thread is self.thread:
+            # Let the other processes run our tasks while we wait to restart
+            self.requeue_tasks()
+        subprocessmanager.SubprocessManager._on_thread_quit(self, thread)
+        _worker_pool.dispatch_tasks()
+
     def shutdown(self):
         self.cancel_check_subprocess_hung()
         subprocessmanager.SubprocessManager.shutdown(self)
+        # keep unfinished tasks around in case we start up again
+        self.requeue_tasks()
 
     def restart(self, clean=False):
         self.cancel_check_subprocess_hung()
         self.responder.movie_data_task_status = None
         subprocessmanager.SubprocessManager.restart(self, clean)
 
+    def is_available(self):
+        """Can we send tasks to this process?
+
+        This is False if our process has quit, even if we haven't restarted
+        it yet.
+        """
+        return (self.is_running and self.thread is not None and
+                self.thread.quit_type is None)
+
+    def send_task(self, msg):
+        self.tasks_in_flight[msg.task_id] = msg
+        self.send_message(msg)
+
+    def requeue_tasks(self):
+        """Put our unfinished tasks back in the pool's queue."""
+        if not self.tasks_in_flight:
+            return
+        messages = sorted(self.tasks_in_flight.values(),
+                          key=lambda msg: msg.task_id)
+        self.tasks_in_flight = {}
+        _worker_pool.requeue_tasks(messages)
+
     def schedule_check_subprocess_hung(self):
         self.check_hung_timeout = eventloop.add_timeout(90,
                 self.check_subprocess_hung, 'check workerprocess hung')
@@ -493,18 +630,129 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         else:
             self.schedule_check_subprocess_hung()
 
-_subprocess_manager = WorkerSubprocessManager()
+class WorkerProcessPool(object):
+    """Runs a pool of worker processes and dispatches tasks to them.
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+    Tasks wait in a WorkerTaskQueue until one of our processes has room for
+    them.  Each process gets at most tasks_per_process tasks at once, so
+    tasks are dispatched by priority across the pool.  Tasks sent to the
+    same process are still ordered by the WorkerTaskQueue inside it.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    :ivar handler_class: SubprocessHandler subclass for new processes
+    :ivar restart_delay: restart_delay for new processes
+    """
+    def __init__(self):
+        self.managers = []
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.thread_count = 3
+        self.tasks_per_process = 0
+        # created on first use, so that it knows about all TaskMessage
+        # subclasses
+        self._task_queue = None
+
+    @property
+    def task_queue(self):
+        if self._task_queue is None:
+            self._task_queue = WorkerTaskQueue()
+        return self._task_queue
+
+    @property
+    def is_running(self):
+        return len(self.managers) > 0
+
+    def startup(self, process_count, thread_count):
+        if self.is_running:
+            return
+        self.thread_count = thread_count
+        # keep some tasks waiting in each process, so that its threads
+        # don't sit idle while a result goes back and forth.
+        self.tasks_per_process = thread_count * 2
+        for i in xrange(process_count):
+            self.managers.append(WorkerSubprocessManager(self.handler_class,
+                    thread_count, self.restart_delay))
+        logging.info("starting %d worker processes", process_count)
+        for manager in self.managers:
+            manager.start()
+
+    def shutdown(self):
+        for manager in self.managers:
+            manager.shutdown()
+        self.managers = []
+
+    def restart(self, clean=False):
+        for manager in self.managers:
+            if manager.is_running:
+                manager.restart(clean)
+
+    def add_task(self, msg):
+        self.task_queue.add_task(None, msg)
+        self.dispatch_tasks()
+
+    def requeue_tasks(self, messages):
+        """Put tasks back at the front of the queue.
+
+        :param messages: tasks to requeue, in the order they were sent
+        """
+        for msg in reversed(messages):
+            self.task_queue.add_task(None, msg, front=True)
+
+    def dispatch_tasks(self):
+        """Send queued tasks to processes with room for them."""
+        while True:
+            manager = self._least_busy_manager()
+            if manager is None:
+                return
+            next_task = self.task_queue.pop_next_task()
+            if next_task is None:
+                return
+            manager.send_task(next_task[1])
+
+    def _least_busy_manager(self):
+        best = None
+        for manager in self.managers:
+            if (not manager.is_available() or
+                len(manager.tasks_in_flight) >= self.tasks_per_process):
+                continue
+            if (best is None or
+                len(manager.tasks_in_flight) < len(best.tasks_in_flight)):
+                best = manager
+        return best
+
+    def task_finished(self, reply):
+        for manager in self.managers:
+            if manager.tasks_in_flight.pop(reply.task_id, None) is not None:
+                break
+        _miro_task_queue.process_result(reply)
+        self.dispatch_tasks()
+
+    def cancel_file_operations(self, paths):
+        """Cancel mutagen and movie data tasks for a list of paths."""
+        removed = self.task_queue.cancel_file_operations(set(paths))
+        _miro_task_queue.discard_tasks(removed)
+        # Tasks that we've already sent need to be cancelled in each
+        # process.  We don't care about the results for this.
+        msg = CancelFileOperations(paths)
+        for manager in self.managers:
+            if manager.is_available():
+                manager.send_message(msg)
+
+_worker_pool = WorkerProcessPool()
+
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
+
+    :param thread_count: number of worker threads in each process
+    :param process_count: number of processes to run.  By default we use one
+    process for each logical CPU.
+    """
+    if process_count is None:
+        process_count = utils.get_logical_cpu_count()
+    _worker_pool.startup(process_count, thread_count)
 
 def shutdown():
-    """Shutdown the worker process."""
-    _subprocess_manager.shutdown()
+    """Shutdown the worker processes."""
+    _worker_pool.shutdown()
 
 # API for sending tasks
 def send(msg, callback, errback):
@@ -518,9 +766,4 @@ def send(msg, callback, errback):
 
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""
-    msg = CancelFileOperations(paths)
-    # we don't care about the return value, but we still want to use the task
-    # queue to queue up this message.
-    def null_callback(msg, result):
-        pass
-    send(msg, null_callback, null_callback)
+    _worker_pool.cancel_file_operations(paths)